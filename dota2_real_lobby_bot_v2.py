@@ -6,32 +6,46 @@ Dota 2 Real Lobby Bot v2 - УЛУЧШЕННАЯ ВЕРСИЯ
 """
 
 import os
+import base64
 import logging
 import random
 import string
 import json
+import heapq
 import time
 import threading
 import asyncio
 import multiprocessing
+import multiprocessing.connection
+import select
 import signal
-from multiprocessing import Process, Queue
+import socket
+import sqlite3
+from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
+
+# Отсчёт времени старта (см. _mark_startup)
+_STARTUP_T0 = time.perf_counter()
+
 from dotenv import load_dotenv
 import pytz
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
 
-# Steam и Dota 2
-import gevent
-from steam.client import SteamClient
-from steam.enums import EResult
-from dota2.client import Dota2Client
-from dota2.enums import DOTA_GameMode, EServerRegion
+# Шифрование кэша входа Steam (CredentialCache). Пакет необязательный:
+# без него кэш не ведётся и воркеры всегда входят по паролю
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+# Steam, Dota 2 и gevent нужны только воркерам - импортируются в них
+# (steam_worker_process, _account_session, _run_lobby), бот-супервизор их не загружает.
+# APScheduler импортируется в setup_scheduler.
 
 # Telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -54,6 +68,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Модули, которые шаблонный процесс forkserver загружает один раз для всех воркеров
+WORKER_PRELOAD_MODULES = [
+    '__main__',
+    'gevent',
+    'gevent.event',
+    'gevent.select',
+    'steam.client',
+    'steam.enums',
+    'dota2.client',
+    'dota2.enums',
+]
+
 # Состояния
 (WAITING_LOBBY_COUNT, WAITING_ACCOUNT_DATA, WAITING_START_CODE, 
  WAITING_LOBBY_NAME, WAITING_SELECT_BOTS, WAITING_EDIT_BOT_DATA,
@@ -63,97 +89,378 @@ logger = logging.getLogger(__name__)
  WAITING_MATCH_SERIES, WAITING_MATCH_LIST) = range(17)
 
 
-def steam_worker_process(username: str, password: str, lobby_name: str, 
-                         lobby_password: str, server: str, mode: str, series_type: str,
-                         result_queue: Queue, shutdown_event):
+def _lobby_teams_assigned(lobby_obj, username: str, local_logger) -> bool:
+    """Пытаемся определить назначение команд максимально широко.
+    Возвращает True, если у Radiant и Dire есть ненулевые team_id/объекты команды.
     """
-    Функция для запуска в отдельном процессе.
-    Выполняет вход в Steam, запуск Dota 2 и создание лобби.
-    shutdown_event - для корректного удаления лобби перед выходом.
-    series_type - тип серии: "bo1", "bo2", "bo3", "bo5"
-    Автозапуск:
-      - 1v1 Solo Mid: при 2 игроках (1 vs 1)
-      - Остальные режимы: при 10 игроках (5 vs 5)
+    try:
+        # 1) Прямые поля ID на лобби
+        candidates = [
+            (
+                getattr(lobby_obj, 'team_id_radiant', None) or getattr(lobby_obj, 'radiant_team_id', None),
+                getattr(lobby_obj, 'team_id_dire', None) or getattr(lobby_obj, 'dire_team_id', None),
+            )
+        ]
+        # 2) Объекты команд (radiant_team/dire_team) с полями team_id/id
+        r_obj = getattr(lobby_obj, 'radiant_team', None)
+        d_obj = getattr(lobby_obj, 'dire_team', None)
+        if r_obj or d_obj:
+            r_tid = getattr(r_obj, 'team_id', None) or getattr(r_obj, 'id', None)
+            d_tid = getattr(d_obj, 'team_id', None) or getattr(d_obj, 'id', None)
+            candidates.append((r_tid, d_tid))
+        # 3) team_details (официальное место хранения команд в лобби)
+        # team_details - это массив, где индекс 0 = Radiant, индекс 1 = Dire
+        try:
+            details = getattr(lobby_obj, 'team_details', None)
+            if details:
+                details_list = list(details)
+                # Проверяем оба элемента массива по индексу
+                if len(details_list) >= 2:
+                    # Radiant (индекс 0)
+                    td_radiant = details_list[0]
+                    radiant_id = getattr(td_radiant, 'team_id', None) or getattr(td_radiant, 'id', None)
+                    radiant_tag = getattr(td_radiant, 'team_tag', None) or getattr(td_radiant, 'tag', None)
+                    radiant_ok = (radiant_id is not None and radiant_id != 0) or (radiant_tag is not None and radiant_tag != '')
+                    
+                    # Dire (индекс 1)
+                    td_dire = details_list[1]
+                    dire_id = getattr(td_dire, 'team_id', None) or getattr(td_dire, 'id', None)
+                    dire_tag = getattr(td_dire, 'team_tag', None) or getattr(td_dire, 'tag', None)
+                    dire_ok = (dire_id is not None and dire_id != 0) or (dire_tag is not None and dire_tag != '')
+                    
+                    if radiant_ok and dire_ok:
+                        return True
+                # Альтернативная проверка: если team_details содержит элементы с team=0 и team=1
+                radiant_ok, dire_ok = False, False
+                for td in details_list:
+                    t_side = getattr(td, 'team', None)
+                    t_id = getattr(td, 'team_id', None) or getattr(td, 'id', None)
+                    t_tag = getattr(td, 'team_tag', None) or getattr(td, 'tag', None)
+                    if t_side == 0 and ((t_id is not None and t_id != 0) or (t_tag is not None and t_tag != '')):
+                        radiant_ok = True
+                    if t_side == 1 and ((t_id is not None and t_id != 0) or (t_tag is not None and t_tag != '')):
+                        dire_ok = True
+                if radiant_ok and dire_ok:
+                    return True
+        except Exception:
+            pass
+
+        # 4) По членам лобби (team/tag/id)
+        has_r, has_d = False, False
+        for mem in getattr(lobby_obj, 'all_members', []) or []:
+            t = getattr(mem, 'team', None)
+            # встречаются разные варианты имён атрибутов
+            tid = (
+                getattr(mem, 'team_id', 0)
+                or getattr(mem, 'teamid', 0)
+                or getattr(mem, 'teamId', 0)
+            )
+            tag = getattr(mem, 'team_tag', None) or getattr(mem, 'teamTag', None)
+            if t == 0 and (tid or tag):
+                has_r = True
+            if t == 1 and (tid or tag):
+                has_d = True
+        if has_r and has_d:
+            return True
+        # Проверяем кандидатов
+        for r_tid, d_tid in candidates:
+            if (isinstance(r_tid, int) and r_tid > 0) and (isinstance(d_tid, int) and d_tid > 0):
+                return True
+        # Если не смогли определить — выводим диагностический лог
+        try:
+            local_logger.info(
+                f"[{username}] 🔍 Нет явных team_id. Атрибуты lobby с 'team': "
+            )
+            for name in dir(lobby_obj):
+                if 'team' in name.lower():
+                    val = getattr(lobby_obj, name)
+                    if isinstance(val, (int, str)):
+                        local_logger.info(f"    lobby.{name} = {val}")
+                    else:
+                        local_logger.info(f"    lobby.{name} = {type(val).__name__}")
+            # Вывести team_details содержимое
+            details = getattr(lobby_obj, 'team_details', None)
+            if details:
+                for idx, td in enumerate(list(details)):
+                    try:
+                        local_logger.info(
+                            f"    team_details[{idx}]: team={getattr(td,'team',None)} id={getattr(td,'team_id',None) or getattr(td,'id',None)} tag={getattr(td,'team_tag',None) or getattr(td,'tag',None)} name={getattr(td,'team_name',None) or getattr(td,'name',None)}"
+                        )
+                    except Exception:
+                        pass
+        except Exception:
+            pass
+        return False
+    except Exception:
+        return False
+
+
+def _build_lobby_options(lobby_name: str, lobby_password: str, server: str,
+                         mode: str, series_type: str) -> dict:
+    """Турнирные настройки лобби для create_practice_lobby/config_practice_lobby"""
+    from dota2.enums import DOTA_GameMode, EServerRegion
+    
+    server_mapping = {
+        'Stockholm': 8,  # Stockholm = регион 8 в Dota 2
+        'Europe West': EServerRegion.Europe,
+        'Russia': EServerRegion.Europe,
+        'US East': EServerRegion.USEast,
+        'US West': EServerRegion.USWest,
+    }
+    
+    mode_mapping = {
+        'Captains Mode': DOTA_GameMode.DOTA_GAMEMODE_CM,
+        'All Pick': DOTA_GameMode.DOTA_GAMEMODE_AP,
+        'Captains Draft': DOTA_GameMode.DOTA_GAMEMODE_CD,
+        'Mid Only': DOTA_GameMode.DOTA_GAMEMODE_MO,
+        '1v1 Solo Mid': DOTA_GameMode.DOTA_GAMEMODE_1V1MID,
+        'Random Draft': DOTA_GameMode.DOTA_GAMEMODE_RD,
+        'Single Draft': DOTA_GameMode.DOTA_GAMEMODE_SD,
+    }
+    
+    # Маппинг серий игр
+    series_mapping = {
+        'bo1': 0,  # Best of 1 (одна игра)
+        'bo2': 1,  # Best of 2 (две игры)
+        'bo3': 2,  # Best of 3 (до 2 побед)
+        'bo5': 3,  # Best of 5 (до 3 побед)
+    }
+    
+    server_region = server_mapping.get(server, EServerRegion.Europe)
+    game_mode = mode_mapping.get(mode, DOTA_GameMode.DOTA_GAMEMODE_CM)
+    series_value = series_mapping.get(series_type.lower(), 0)
+    
+    # Настройки лобби с League ID турнира
+    return {
+        'game_name': lobby_name,
+        'pass_key': lobby_password,
+        'server_region': server_region,
+        'game_mode': game_mode,
+        'series_type': series_value,  # Серия игр (bo1, bo2, bo3, bo5)
+        'allow_spectating': False,
+        'allow_cheats': False,
+        'dota_tv_delay': 2,
+        'fill_with_bots': False,
+        'cm_pick': 1,  # Captains Mode: подброс монетки для выбора стороны (право первого выбора)
+        'radiant_series_wins': 0,
+        'dire_series_wins': 0,
+        'leagueid': 18390,  # ID турнира для отображения в настройках лобби
+    }
+
+
+# Фазы жизненного цикла лобби и допустимые переходы (closing - из любой фазы)
+LOBBY_PHASE_TRANSITIONS = {
+    None: ('cleanup',),
+    'cleanup': ('creating',),
+    'creating': ('configuring',),
+    'configuring': ('broadcast',),
+    'broadcast': ('joining',),
+    'joining': ('open',),
+    'open': ('launching',),
+    'launching': ('in_game', 'open'),  # open - запуск не удался, ждём дальше
+    'in_game': (),
+    'closing': ('closed',),
+    'closed': (),
+}
+
+
+class _LobbyPhases:
+    """Явная машина состояний лобби в воркере.
+    
+    Каждый переход получает отметку времени, пишется в лог и уходит боту
+    событием lobby_phase (с длительностью предыдущей фазы) - так видно,
+    на какой фазе тратится время создания.
     """
-    # НЕ используем monkey.patch_all() - это вызывает RecursionError
-    # gevent работает и без этого в отдельном процессе
+    def __init__(self, username: str, lobby_name: str, event_conn, local_logger):
+        self.username = username
+        self.lobby_name = lobby_name
+        self.event_conn = event_conn
+        self.logger = local_logger
+        self.phase: Optional[str] = None
+        self.entered_at = time.time()
+        self.durations: Dict[str, float] = {}  # фаза -> сек
     
-    logging.basicConfig(level=logging.INFO)
-    local_logger = logging.getLogger(f"steam_worker_{username}")
+    def enter(self, phase: str):
+        if phase == self.phase:
+            return
+        if phase != 'closing' and phase not in LOBBY_PHASE_TRANSITIONS.get(self.phase, ()):
+            self.logger.warning(f"[{self.username}] ⚠️ Неожиданный переход лобби {self.phase} → {phase}")
+        now = time.time()
+        previous = self.phase
+        if previous is not None:
+            self.durations[previous] = self.durations.get(previous, 0) + now - self.entered_at
+        self.phase = phase
+        self.entered_at = now
+        self.logger.info(f"[{self.username}] 🔀 Фаза лобби: {previous or '—'} → {phase}"
+                         + (f" ({self.durations[previous] * 1000:.0f} мс)" if previous else ""))
+        self.event_conn.send({
+            'event': 'lobby_phase',
+            'lobby_name': self.lobby_name,
+            'phase': phase,
+            'previous': previous,
+            'previous_ms': self.durations[previous] * 1000 if previous else None,
+            'at': now,
+        })
+
+
+def _run_lobby(steam, dota, username: str, lobby: dict, event_conn, stop_event, local_logger):
+    """
+    Жизненный цикл одного лобби на уже залогиненной сессии - машина состояний
+    _LobbyPhases: cleanup → creating → configuring → broadcast → joining → open → launching →
+    in_game, из любой фазы → closing → closed. Переходы ждут событий координатора
+    (изменение лобби), а не фиксированных пауз; таймауты - только страховка.
+    event_conn - канал событий воркер → бот (результат создания, фазы, закрытие лобби).
+    stop_event - gevent.event.Event, выставляется командой destroy/shutdown.
+    Steam НЕ отключаем: сессия остаётся тёплой для следующего лобби.
+    """
+    import gevent
+    import gevent.event
     
-    try:
-        local_logger.info(f"[{username}] Процесс запущен")
-        
-        # Создаем Steam клиент
-        steam = SteamClient()
-        dota = Dota2Client(steam)
-        
-        lobby_created = gevent.event.Event()
-        lobby_data_container = {'data': None}
-        dota_ready = gevent.event.Event()
-        
-        def on_dota_ready():
-            local_logger.info(f"[{username}] Dota 2 готов")
-            dota_ready.set()  # Устанавливаем флаг готовности
-        
-        def on_lobby_created(lobby):
-            local_logger.info(f"[{username}] Лобби создано!")
-            lobby_data_container['data'] = lobby
-            lobby_created.set()
-        
-        # Счётчик игроков для отслеживания изменений
-        player_counts = {'last_count': 0, 'last_radiant': 0, 'last_dire': 0}
-        
-        def on_lobby_changed(lobby_obj):
-            """Отслеживаем ВСЕ изменения в лобби (игроки, чат и т.д.)"""
-            try:
-                # Проверяем количество игроков
-                if dota.lobby and hasattr(dota.lobby, 'all_members'):
-                    radiant = sum(1 for m in dota.lobby.all_members if m.team == 0)
-                    dire = sum(1 for m in dota.lobby.all_members if m.team == 1)
-                    total = radiant + dire
-                    
-                    # Логируем ТОЛЬКО при изменениях
-                    if (total != player_counts['last_count'] or 
-                        radiant != player_counts['last_radiant'] or 
-                        dire != player_counts['last_dire']):
-                        
-                        local_logger.info(f"[{username}] 👥 Игроков изменилось: {total}/10 (Radiant: {radiant}, Dire: {dire})")
-                        
-                        player_counts['last_count'] = total
-                        player_counts['last_radiant'] = radiant
-                        player_counts['last_dire'] = dire
-                
-            except Exception as e:
-                pass  # Не спамим
-        
-        # Подписываемся на события
-        dota.on('ready', on_dota_ready)
-        dota.on(dota.EVENT_LOBBY_NEW, on_lobby_created)
-        dota.on(dota.EVENT_LOBBY_CHANGED, on_lobby_changed)  # ВАЖНО: отслеживаем ВСЕ изменения
-        
-        # 1. Вход в Steam
-        local_logger.info(f"[{username}] Подключение к Steam...")
-        result = steam.login(username=username, password=password)
-        
-        if result != EResult.OK:
-            local_logger.error(f"[{username}] Ошибка входа: {result}")
-            result_queue.put({'success': False, 'error': f'Login failed: {result}'})
+    lobby_name = lobby['lobby_name']
+    lobby_password = lobby['password']
+    server = lobby['server']
+    mode = lobby['mode']
+    series_type = lobby['series_type']
+    
+    lobby_created = gevent.event.Event()
+    lobby_update = gevent.event.Event()  # Любое сообщение координатора о нашем лобби
+    lobby_version = [0]  # Счётчик изменений лобби (ждём "следующее изменение")
+    phases = _LobbyPhases(username, lobby_name, event_conn, local_logger)
+    
+    def on_lobby_created(lobby_obj):
+        local_logger.info(f"[{username}] Лобби создано!")
+        lobby_created.set()
+        lobby_version[0] += 1
+        lobby_update.set()
+    
+    def wait_lobby(predicate, timeout: float) -> bool:
+        """Ждём изменения лобби, после которого predicate(dota.lobby) истинно.
+        False - таймаут, отмена или лобби пропало."""
+        deadline = time.time() + timeout
+        while True:
+            lobby_obj = dota.lobby
+            if lobby_obj is not None and predicate(lobby_obj):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0 or stop_event.is_set() or lobby_gone.is_set():
+                return False
+            lobby_update.clear()
+            gevent.wait([lobby_update, stop_event], count=1, timeout=remaining)
+    
+    def own_team(lobby_obj):
+        for member in getattr(lobby_obj, 'all_members', None) or []:
+            if getattr(member, 'id', None) == own_id:
+                return member.team
+        return None
+    
+    # Автостарт в зависимости от режима
+    # Mid Only и 1v1 Solo Mid - оба режима для 1v1 (2 игрока)
+    is_1v1 = (mode in ['1v1 Solo Mid', 'Mid Only'])
+    required_radiant = 1 if is_1v1 else 5
+    required_dire = 1 if is_1v1 else 5
+    
+    # Инкрементальный счётчик игроков по командам: member_id -> team
+    team_by_member = {}
+    team_counts = {0: 0, 1: 0}  # 0 = Radiant, 1 = Dire
+    player_counts = {'last_radiant': 0, 'last_dire': 0}
+    
+    # Снимки лобби для бота (игроки по командам, зрители, состояние):
+    # не чаще одного раза в snapshot_interval, последнее состояние всегда доходит
+    snapshot_interval = lobby.get('snapshot_interval') or 0.5
+    snapshot_state = {'enabled': False, 'last_sent': None, 'sent_at': 0.0, 'timer': None}
+    own_id = steam.steam_id.as_64 if steam.steam_id else None
+    
+    def publish_snapshot():
+        snapshot_state['timer'] = None
+        lobby_obj = dota.lobby
+        if lobby_obj is None:
             return
-        
-        local_logger.info(f"[{username}] Успешный вход в Steam")
-        
-        # 2. Запуск Dota 2
-        local_logger.info(f"[{username}] Запуск Dota 2...")
-        dota.launch()
-        
-        # Ждем подключения к координатору (макс 60 сек) - используем событие вместо фиксированного времени
-        if not dota_ready.wait(timeout=60):
-            local_logger.error(f"[{username}] Таймаут подключения Dota 2")
-            result_queue.put({'success': False, 'error': 'Dota 2 connection timeout'})
+        members = list(getattr(lobby_obj, 'all_members', None) or [])
+        snapshot = {
+            'radiant': team_counts[0],
+            'dire': team_counts[1],
+            'spectators': sum(1 for m in members if m.team not in (0, 1) and getattr(m, 'id', None) != own_id),
+            'state': int(getattr(lobby_obj, 'state', 0) or 0),
+        }
+        if snapshot == snapshot_state['last_sent']:
             return
-        
+        snapshot_state['last_sent'] = snapshot
+        snapshot_state['sent_at'] = time.time()
+        event_conn.send({
+            'event': 'lobby_snapshot',
+            'lobby_name': lobby_name,
+            'capacity': required_radiant + required_dire,
+            **snapshot,
+        })
+    
+    def schedule_snapshot():
+        if not snapshot_state['enabled'] or snapshot_state['timer'] is not None:
+            return  # Уже запланирован - уйдёт самое свежее состояние
+        delay = snapshot_interval - (time.time() - snapshot_state['sent_at'])
+        if delay <= 0:
+            publish_snapshot()
+        else:
+            snapshot_state['timer'] = gevent.spawn_later(delay, publish_snapshot)
+    
+    start_ready = gevent.event.Event()  # Составы собраны - можно запускать
+    lobby_gone = gevent.event.Event()   # Лобби удалено координатором
+    activity = gevent.event.Event()     # Любое изменение лобби (для idle-таймера)
+    
+    def on_lobby_changed(lobby_obj):
+        """Отслеживаем ВСЕ изменения в лобби и сразу решаем про автостарт"""
+        try:
+            activity.set()
+            lobby_version[0] += 1
+            lobby_update.set()
+            if not hasattr(lobby_obj, 'all_members'):
+                return
+            
+            # Обновляем счётчики только по изменившимся игрокам
+            members = {getattr(m, 'id', idx): m.team for idx, m in enumerate(lobby_obj.all_members)}
+            for member_id, team in team_by_member.items():
+                if members.get(member_id) != team and team in team_counts:
+                    team_counts[team] -= 1
+            for member_id, team in members.items():
+                if team_by_member.get(member_id) != team and team in team_counts:
+                    team_counts[team] += 1
+            team_by_member.clear()
+            team_by_member.update(members)
+            
+            radiant = team_counts[0]
+            dire = team_counts[1]
+            
+            # Логируем ТОЛЬКО при изменениях
+            if radiant != player_counts['last_radiant'] or dire != player_counts['last_dire']:
+                local_logger.info(f"[{username}] 👥 Игроков изменилось: {radiant + dire}/10 (Radiant: {radiant}, Dire: {dire})")
+                player_counts['last_radiant'] = radiant
+                player_counts['last_dire'] = dire
+            
+            schedule_snapshot()
+            
+            if start_ready.is_set() or radiant != required_radiant or dire != required_dire:
+                return
+            
+            # Для 1v1: проверяем, что команды назначены
+            if is_1v1 and not _lobby_teams_assigned(lobby_obj, username, local_logger):
+                local_logger.info(f"[{username}] ⚠️ Команды не назначены для обеих сторон — не запускаем.")
+                return
+            
+            start_ready.set()
+        except Exception as e:
+            pass  # Не спамим
+    
+    def on_lobby_removed(lobby_obj):
+        lobby_gone.set()
+        lobby_update.set()
+    
+    # Подписываемся на события этого лобби
+    dota.on(dota.EVENT_LOBBY_NEW, on_lobby_created)
+    dota.on(dota.EVENT_LOBBY_CHANGED, on_lobby_changed)  # ВАЖНО: отслеживаем ВСЕ изменения
+    dota.on(dota.EVENT_LOBBY_REMOVED, on_lobby_removed)
+    
+    try:
         # КРИТИЧНО: Агрессивная очистка ВСЕХ старых турнирных лобби
+        phases.enter('cleanup')
         local_logger.info(f"[{username}] 🧹 Очистка старых турнирных лобби...")
         try:
             dota.leave_practice_lobby()
@@ -168,54 +475,9 @@ def steam_worker_process(username: str, password: str, lobby_name: str,
         local_logger.info(f"[{username}] ✅ Очистка завершена, готовы создать новое лобби")
         
         # 3. Создание лобби
+        phases.enter('creating')
         local_logger.info(f"[{username}] Создание лобби: {lobby_name}")
-        
-        server_mapping = {
-            'Stockholm': 8,  # Stockholm = регион 8 в Dota 2
-            'Europe West': EServerRegion.Europe,
-            'Russia': EServerRegion.Europe,
-            'US East': EServerRegion.USEast,
-            'US West': EServerRegion.USWest,
-        }
-        
-        mode_mapping = {
-            'Captains Mode': DOTA_GameMode.DOTA_GAMEMODE_CM,
-            'All Pick': DOTA_GameMode.DOTA_GAMEMODE_AP,
-            'Captains Draft': DOTA_GameMode.DOTA_GAMEMODE_CD,
-            'Mid Only': DOTA_GameMode.DOTA_GAMEMODE_MO,
-            '1v1 Solo Mid': DOTA_GameMode.DOTA_GAMEMODE_1V1MID,
-            'Random Draft': DOTA_GameMode.DOTA_GAMEMODE_RD,
-            'Single Draft': DOTA_GameMode.DOTA_GAMEMODE_SD,
-        }
-        
-        # Маппинг серий игр
-        series_mapping = {
-            'bo1': 0,  # Best of 1 (одна игра)
-            'bo2': 1,  # Best of 2 (две игры)
-            'bo3': 2,  # Best of 3 (до 2 побед)
-            'bo5': 3,  # Best of 5 (до 3 побед)
-        }
-        
-        server_region = server_mapping.get(server, EServerRegion.Europe)
-        game_mode = mode_mapping.get(mode, DOTA_GameMode.DOTA_GAMEMODE_CM)
-        series_value = series_mapping.get(series_type.lower(), 0)
-        
-        # Настройки лобби с League ID турнира
-        options = {
-            'game_name': lobby_name,
-            'pass_key': lobby_password,
-            'server_region': server_region,
-            'game_mode': game_mode,
-            'series_type': series_value,  # Серия игр (bo1, bo2, bo3, bo5)
-            'allow_spectating': False,
-            'allow_cheats': False,
-            'dota_tv_delay': 2,
-            'fill_with_bots': False,
-            'cm_pick': 1,  # Captains Mode: подброс монетки для выбора стороны (право первого выбора)
-            'radiant_series_wins': 0,
-            'dire_series_wins': 0,
-            'leagueid': 18390,  # ID турнира для отображения в настройках лобби
-        }
+        options = _build_lobby_options(lobby_name, lobby_password, server, mode, series_type)
         
         # Создаем practice лобби с турнирными настройками (автоматически закрывается при отключении)
         local_logger.info(f"[{username}] Создание лобби с League ID: 18390...")
@@ -227,379 +489,2590 @@ def steam_worker_process(username: str, password: str, lobby_name: str,
         # Ждем создания лобби (макс 60 сек)
         local_logger.info(f"[{username}] Ожидание создания лобби...")
         
-        if lobby_created.wait(timeout=60):
-            local_logger.info(f"[{username}] Лобби создано! Применяем настройки...")
-            
-            # ВАЖНО: Применяем настройки к созданному лобби
-            try:
-                dota.config_practice_lobby(options=options)
+        # Отмена (stop_event) прерывает ожидание сразу, как и в остальных фазах
+        gevent.wait([lobby_created, stop_event], count=1, timeout=60)
+        if stop_event.is_set():
+            local_logger.info(f"[{username}] 🛑 Создание лобби отменено")
+            event_conn.send({'success': False, 'error': 'Cancelled', 'lobby_name': lobby_name})
+            return
+        if not lobby_created.is_set():
+            local_logger.error(f"[{username}] Таймаут создания лобби")
+            event_conn.send({'success': False, 'error': 'Lobby creation timeout', 'lobby_name': lobby_name})
+            return
+        
+        # События удаления старых лобби при очистке к новому лобби не относятся
+        lobby_gone.clear()
+        
+        local_logger.info(f"[{username}] Лобби создано! Применяем настройки...")
+        
+        # ВАЖНО: Применяем настройки к созданному лобби
+        phases.enter('configuring')
+        try:
+            version = lobby_version[0]
+            dota.config_practice_lobby(options=options)
+            # Координатор подтверждает настройки обновлением лобби
+            if wait_lobby(lambda lobby_obj: lobby_version[0] > version, timeout=2):
                 local_logger.info(f"[{username}] Настройки применены")
-                gevent.sleep(0.5)  # Минимальная задержка для применения настроек
-            except Exception as e:
-                local_logger.warning(f"[{username}] Ошибка применения настроек: {e}")
+            else:
+                local_logger.info(f"[{username}] Настройки отправлены (подтверждение не пришло за 2 сек)")
+        except Exception as e:
+            local_logger.warning(f"[{username}] Ошибка применения настроек: {e}")
+        
+        # ВАЖНО: Заходим в слот наблюдателя (team=4) чтобы загрузиться в игру
+        phases.enter('broadcast')
+        try:
+            # Сначала занимаем канал трансляции
+            version = lobby_version[0]
+            dota.join_practice_lobby_broadcast_channel(channel=1)
+            wait_lobby(lambda lobby_obj: lobby_version[0] > version, timeout=2)
+            local_logger.info(f"[{username}] Занят слот в канале трансляции")
             
-            # ВАЖНО: Заходим в слот наблюдателя (team=4) чтобы загрузиться в игру
-            try:
-                # Сначала занимаем канал трансляции
-                dota.join_practice_lobby_broadcast_channel(channel=1)
-                local_logger.info(f"[{username}] Занят слот в канале трансляции")
-                gevent.sleep(1)  # Задержка перед присоединением к команде
-                
-                # Затем присоединяемся к слоту наблюдателя чтобы загрузиться в игру
-                dota.join_practice_lobby_team(team=4)
+            # Затем присоединяемся к слоту наблюдателя чтобы загрузиться в игру
+            phases.enter('joining')
+            dota.join_practice_lobby_team(team=4)
+            
+            # Лобби видно в поиске, когда координатор подтвердил нас в слоте
+            if wait_lobby(lambda lobby_obj: own_team(lobby_obj) == 4, timeout=5):
                 local_logger.info(f"[{username}] ✅ Присоединились к слоту наблюдателя (team=4)")
+            else:
+                local_logger.warning(f"[{username}] ⚠️ Координатор не подтвердил слот наблюдателя за 5 сек")
+            
+            # Проверяем состояние лобби для диагностики
+            if hasattr(dota, 'lobby') and dota.lobby:
+                lobby_state = dota.lobby.state if hasattr(dota.lobby, 'state') else None
+                local_logger.info(f"[{username}] 📡 Состояние лобби после присоединения: state = {lobby_state}")
                 
-                # ВАЖНО: Даём время на синхронизацию лобби с сервером
-                # Лобби должно стать видимым в поиске после присоединения к слоту
-                gevent.sleep(3)  # Увеличена задержка для синхронизации
-                
-                # Проверяем состояние лобби для диагностики
-                if hasattr(dota, 'lobby') and dota.lobby:
-                    lobby_state = dota.lobby.state if hasattr(dota.lobby, 'state') else None
-                    local_logger.info(f"[{username}] 📡 Состояние лобби после присоединения: state = {lobby_state}")
-                    
-                    # Для турнирных лобби с League ID лобби должно быть видимо в поиске
-                    # даже если state = 2 (LOADING), но обычно должно быть state = 0 (READY)
-                    if lobby_state == 0:
-                        local_logger.info(f"[{username}] ✅ Лобби готово (state = 0) - должно быть видно в поиске!")
-                    elif lobby_state == 2:
-                        local_logger.info(f"[{username}] ⚠️ Лобби в состоянии LOADING (state = 2) - может быть не видно в поиске")
-                    else:
-                        local_logger.info(f"[{username}] 📡 Лобби в состоянии: {lobby_state}")
-            except Exception as e:
-                local_logger.warning(f"[{username}] Ошибка входа: {e}")
-            
-            local_logger.info(f"[{username}] ✅ Лобби полностью настроено!")
-            
-            result_queue.put({
-                'success': True,
-                'lobby_name': lobby_name,
-                'password': lobby_password,
-                'account': username,
-                'server': server,
-                'mode': mode,
-                'series_type': series_type
-            })
-        else:
-            local_logger.error(f"[{username}] Таймаут создания лобби")
-            result_queue.put({'success': False, 'error': 'Lobby creation timeout'})
-            # ВАЖНО: Выходим из функции при ошибке, иначе код продолжит выполняться!
+                # Для турнирных лобби с League ID лобби должно быть видимо в поиске
+                # даже если state = 2 (LOADING), но обычно должно быть state = 0 (READY)
+                if lobby_state == 0:
+                    local_logger.info(f"[{username}] ✅ Лобби готово (state = 0) - должно быть видно в поиске!")
+                elif lobby_state == 2:
+                    local_logger.info(f"[{username}] ⚠️ Лобби в состоянии LOADING (state = 2) - может быть не видно в поиске")
+                else:
+                    local_logger.info(f"[{username}] 📡 Лобби в состоянии: {lobby_state}")
+        except Exception as e:
+            local_logger.warning(f"[{username}] Ошибка входа: {e}")
+            phases.enter('joining')
+        
+        # Создание отменили, пока лобби настраивалось - не отдаём его боту
+        if stop_event.is_set():
+            local_logger.info(f"[{username}] 🛑 Создание лобби отменено")
+            event_conn.send({'success': False, 'error': 'Cancelled', 'lobby_name': lobby_name})
             return
         
-        # Держим процесс живым 5 минут, автостарт в зависимости от режима
-        # Mid Only и 1v1 Solo Mid - оба режима для 1v1 (2 игрока)
-        is_1v1 = (mode in ['1v1 Solo Mid', 'Mid Only'])
-        required_radiant = 1 if is_1v1 else 5
-        required_dire = 1 if is_1v1 else 5
-        total_required = required_radiant + required_dire
+        local_logger.info(f"[{username}] ✅ Лобби полностью настроено!")
+        phases.enter('open')
+        
+        event_conn.send({
+            'success': True,
+            'lobby_name': lobby_name,
+            'password': lobby_password,
+            'account': username,
+            'server': server,
+            'mode': mode,
+            'series_type': series_type
+        })
+        
+        # Первый снимок сразу, дальше - по изменениям
+        snapshot_state['enabled'] = True
+        publish_snapshot()
+        
+        # Лобби живёт max_lifetime секунд (35 минут по умолчанию),
+        # либо, в режиме idle_timeout, пока в нём что-то происходит
+        idle_timeout = lobby.get('idle_timeout') or 0
+        max_lifetime = lobby.get('max_lifetime') or 2100
         
         if is_1v1:
             local_logger.info(f"[{username}] 🔄 Лобби активно, автостарт при 2 игроках (1 vs 1)...")
         else:
             local_logger.info(f"[{username}] 🔄 Лобби активно, автостарт при 10 игроках (5 vs 5)...")
+        if idle_timeout:
+            local_logger.info(f"[{username}] ⏲️ Лобби закроется после {idle_timeout} сек без активности")
         
         game_started = False
-        players_warned = False  # Флаг предупреждения об игроках
-        
-        local_logger.info(f"[{username}] 🔄 НАЧИНАЕМ ЦИКЛ ПРОВЕРКИ ИГРОКОВ...")
-        
-        # Проверяем каждые 3 секунды (700 раз = 35 минут)
-        for i in range(700):
-            gevent.sleep(3)
+        deadline = time.time() + (idle_timeout or max_lifetime)
+        
+        # Ждём событий лобби: никаких периодических проверок, пока ничего не происходит
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                local_logger.info(f"[{username}] ⏲️ Время жизни лобби истекло, закрываем")
+                event_conn.send({'success': False, 'lobby_closed': True, 'lobby_name': lobby_name, 'reason': 'timeout'})
+                break
             
-            # Проверяем команду закрытия
-            if shutdown_event.is_set():
+            gevent.wait([start_ready, lobby_gone, stop_event, activity], count=1, timeout=remaining)
+            
+            if stop_event.is_set():
                 local_logger.info(f"[{username}] 🛑 Получена команда закрытия лобби!")
                 break
             
-            # Проверяем состояние лобби
-            try:
-                # Проверяем что лобби еще существует
-                lobby_exists = dota.lobby is not None
-                
-                if not lobby_exists:
-                    if not game_started:
-                        local_logger.warning(f"[{username}] ⚠️ dota.lobby = None! Лобби закрылось.")
-                        result_queue.put({'success': False, 'lobby_closed': True})
-                        local_logger.info(f"[{username}] ⏳ Ожидание обработки сообщения о закрытии (15 секунд)...")
-                        gevent.sleep(15)
-                        break
-                    else:
-                        # Игра была запущена, лобби закрылось - игра завершена
-                        break
-                
-                # Используем all_members вместо members
-                if not hasattr(dota.lobby, 'all_members'):
-                    continue
-                
-                members_count = len(dota.lobby.all_members)
-                
-                if members_count == 0:
-                    continue
-                
-                # Есть игроки! Проверяем их команды
-                lobby = dota.lobby
-                
-                # Подсчитываем игроков в командах
-                radiant_players = sum(1 for m in lobby.all_members if m.team == 0)  # 0 = Radiant
-                dire_players = sum(1 for m in lobby.all_members if m.team == 1)     # 1 = Dire
+            if lobby_gone.is_set() or dota.lobby is None:
+                local_logger.warning(f"[{username}] ⚠️ dota.lobby = None! Лобби закрылось.")
+                event_conn.send({'success': False, 'lobby_closed': True, 'lobby_name': lobby_name})
+                return
+            
+            if start_ready.is_set():
+                if is_1v1:
+                    local_logger.info(f"[{username}] ✅✅✅ 2 ИГРОКА ГОТОВЫ (1 vs 1)! ЗАПУСКАЕМ ИГРУ...")
+                else:
+                    local_logger.info(f"[{username}] ✅✅✅ 10 ИГРОКОВ ГОТОВЫ (5 vs 5)! ЗАПУСКАЕМ ИГРУ...")
+                local_logger.info(f"[{username}] 📡 dota.lobby.state = {dota.lobby.state if hasattr(dota.lobby, 'state') else 'N/A'}")
                 
-                # Проверяем готовность в зависимости от режима
-                if radiant_players == required_radiant and dire_players == required_dire:
-                    if is_1v1:
-                        local_logger.info(f"[{username}] ✅✅✅ 2 ИГРОКА ГОТОВЫ (1 vs 1)! ЗАПУСКАЕМ ИГРУ...")
-                    else:
-                        local_logger.info(f"[{username}] ✅✅✅ 10 ИГРОКОВ ГОТОВЫ (5 vs 5)! ЗАПУСКАЕМ ИГРУ...")
-                    
-                    # Проверяем, что бот в канале трансляции
-                    local_logger.info(f"[{username}] 📡 Проверяем статус в канале трансляции...")
-                    local_logger.info(f"[{username}] 📡 dota.lobby.state = {dota.lobby.state if hasattr(dota.lobby, 'state') else 'N/A'}")
-                    
-                    # Для 1v1: проверяем, что команды назначены
-                    if is_1v1:
-                        # Доп.проверка: у обеих сторон должна быть назначена команда (team_id != 0)
-                        def teams_assigned(lobby_obj):
-                            """Пытаемся определить назначение команд максимально широко.
-                            Возвращает True, если у Radiant и Dire есть ненулевые team_id/объекты команды.
-                            """
-                            try:
-                                # 1) Прямые поля ID на лобби
-                                candidates = [
-                                    (
-                                        getattr(lobby_obj, 'team_id_radiant', None) or getattr(lobby_obj, 'radiant_team_id', None),
-                                        getattr(lobby_obj, 'team_id_dire', None) or getattr(lobby_obj, 'dire_team_id', None),
-                                    )
-                                ]
-                                # 2) Объекты команд (radiant_team/dire_team) с полями team_id/id
-                                r_obj = getattr(lobby_obj, 'radiant_team', None)
-                                d_obj = getattr(lobby_obj, 'dire_team', None)
-                                if r_obj or d_obj:
-                                    r_tid = getattr(r_obj, 'team_id', None) or getattr(r_obj, 'id', None)
-                                    d_tid = getattr(d_obj, 'team_id', None) or getattr(d_obj, 'id', None)
-                                    candidates.append((r_tid, d_tid))
-                                # 3) team_details (официальное место хранения команд в лобби)
-                                # team_details - это массив, где индекс 0 = Radiant, индекс 1 = Dire
-                                try:
-                                    details = getattr(lobby_obj, 'team_details', None)
-                                    if details:
-                                        details_list = list(details)
-                                        # Проверяем оба элемента массива по индексу
-                                        if len(details_list) >= 2:
-                                            # Radiant (индекс 0)
-                                            td_radiant = details_list[0]
-                                            radiant_id = getattr(td_radiant, 'team_id', None) or getattr(td_radiant, 'id', None)
-                                            radiant_tag = getattr(td_radiant, 'team_tag', None) or getattr(td_radiant, 'tag', None)
-                                            radiant_ok = (radiant_id is not None and radiant_id != 0) or (radiant_tag is not None and radiant_tag != '')
-                                            
-                                            # Dire (индекс 1)
-                                            td_dire = details_list[1]
-                                            dire_id = getattr(td_dire, 'team_id', None) or getattr(td_dire, 'id', None)
-                                            dire_tag = getattr(td_dire, 'team_tag', None) or getattr(td_dire, 'tag', None)
-                                            dire_ok = (dire_id is not None and dire_id != 0) or (dire_tag is not None and dire_tag != '')
-                                            
-                                            if radiant_ok and dire_ok:
-                                                return True
-                                        # Альтернативная проверка: если team_details содержит элементы с team=0 и team=1
-                                        radiant_ok, dire_ok = False, False
-                                        for td in details_list:
-                                            t_side = getattr(td, 'team', None)
-                                            t_id = getattr(td, 'team_id', None) or getattr(td, 'id', None)
-                                            t_tag = getattr(td, 'team_tag', None) or getattr(td, 'tag', None)
-                                            if t_side == 0 and ((t_id is not None and t_id != 0) or (t_tag is not None and t_tag != '')):
-                                                radiant_ok = True
-                                            if t_side == 1 and ((t_id is not None and t_id != 0) or (t_tag is not None and t_tag != '')):
-                                                dire_ok = True
-                                        if radiant_ok and dire_ok:
-                                            return True
-                                except Exception:
-                                    pass
-
-                                # 4) По членам лобби (team/tag/id)
-                                has_r, has_d = False, False
-                                for mem in getattr(lobby_obj, 'all_members', []) or []:
-                                    t = getattr(mem, 'team', None)
-                                    # встречаются разные варианты имён атрибутов
-                                    tid = (
-                                        getattr(mem, 'team_id', 0)
-                                        or getattr(mem, 'teamid', 0)
-                                        or getattr(mem, 'teamId', 0)
-                                    )
-                                    tag = getattr(mem, 'team_tag', None) or getattr(mem, 'teamTag', None)
-                                    if t == 0 and (tid or tag):
-                                        has_r = True
-                                    if t == 1 and (tid or tag):
-                                        has_d = True
-                                if has_r and has_d:
-                                    return True
-                                # Проверяем кандидатов
-                                for r_tid, d_tid in candidates:
-                                    if (isinstance(r_tid, int) and r_tid > 0) and (isinstance(d_tid, int) and d_tid > 0):
-                                        return True
-                                # Если не смогли определить — выводим диагностический лог
-                                try:
-                                    local_logger.info(
-                                        f"[{username}] 🔍 Нет явных team_id. Атрибуты lobby с 'team': "
-                                    )
-                                    for name in dir(lobby_obj):
-                                        if 'team' in name.lower():
-                                            val = getattr(lobby_obj, name)
-                                            if isinstance(val, (int, str)):
-                                                local_logger.info(f"    lobby.{name} = {val}")
-                                            else:
-                                                local_logger.info(f"    lobby.{name} = {type(val).__name__}")
-                                    # Вывести team_details содержимое
-                                    details = getattr(lobby_obj, 'team_details', None)
-                                    if details:
-                                        for idx, td in enumerate(list(details)):
-                                            try:
-                                                local_logger.info(
-                                                    f"    team_details[{idx}]: team={getattr(td,'team',None)} id={getattr(td,'team_id',None) or getattr(td,'id',None)} tag={getattr(td,'team_tag',None) or getattr(td,'tag',None)} name={getattr(td,'team_name',None) or getattr(td,'name',None)}"
-                                                )
-                                            except Exception:
-                                                pass
-                                except Exception:
-                                    pass
-                                return False
-                            except Exception:
-                                return False
-
-                        if not (hasattr(dota, 'lobby') and dota.lobby and hasattr(dota.lobby, 'all_members')):
-                            continue
-                        r_now = sum(1 for m in dota.lobby.all_members if m.team == 0)
-                        d_now = sum(1 for m in dota.lobby.all_members if m.team == 1)
-                        if r_now != required_radiant or d_now != required_dire:
-                            continue
-                        if not teams_assigned(dota.lobby):
-                            local_logger.info(f"[{username}] ⚠️ Команды не назначены для обеих сторон — не запускаем.")
-                            continue
-                    
-                    gevent.sleep(2)
-                    
-                    # Для всех режимов запускаем игру сразу после назначения команд
+                try:
+                    # Для всех режимов запускаем игру сразу после сбора составов
+                    phases.enter('launching')
                     local_logger.info(f"[{username}] 🚀 ЗАПУСКАЕМ ИГРУ...")
                     dota.launch_practice_lobby()
-                    gevent.sleep(5)  # Даём время на запуск
+                    # Запуск подтверждается сменой состояния лобби (UI → подготовка сервера)
+                    if not wait_lobby(lambda lobby_obj: int(getattr(lobby_obj, 'state', 0) or 0) != 0, timeout=10):
+                        local_logger.warning(f"[{username}] ⚠️ Состояние лобби не сменилось за 10 сек после запуска")
                     
                     local_logger.info(f"[{username}] 🎮🎮🎮 ИГРА ЗАПУЩЕНА! Бот загружается как наблюдатель!")
-                    
+                    phases.enter('in_game')
                     game_started = True
                     break
-                        
-            except Exception as check_error:
-                local_logger.error(f"[{username}] ❌ ОШИБКА при проверке игроков: {check_error}", exc_info=True)
+                except Exception as launch_error:
+                    local_logger.error(f"[{username}] ❌ ОШИБКА запуска игры: {launch_error}", exc_info=True)
+                    phases.enter('open')
+                    start_ready.clear()
+            
+            if activity.is_set():
+                activity.clear()
+                if idle_timeout:
+                    deadline = time.time() + idle_timeout
+        
+        if game_started:
+            # Игра запущена - держим лобби до команды закрытия или конца игры
+            local_logger.info(f"[{username}] 🎮 Игра запущена! Бот остается в Steam для поддержки лобби...")
+            local_logger.info(f"[{username}] ⏳ Ожидание завершения игры или команды закрытия...")
+            
+            # Раз в минуту страхуемся на случай пропущенного EVENT_LOBBY_REMOVED
+            while True:
+                gevent.wait([lobby_gone, stop_event], count=1, timeout=60)
+                if stop_event.is_set():
+                    break
+                if lobby_gone.is_set() or dota.lobby is None:
+                    local_logger.info(f"[{username}] 🏁 Лобби закрылось (игра завершена)!")
+                    event_conn.send({'success': False, 'lobby_closed': True, 'lobby_name': lobby_name})
+                    break
+    finally:
+        snapshot_state['enabled'] = False
+        if snapshot_state['timer'] is not None:
+            snapshot_state['timer'].kill()
+        dota.remove_listener(dota.EVENT_LOBBY_NEW, on_lobby_created)
+        dota.remove_listener(dota.EVENT_LOBBY_CHANGED, on_lobby_changed)
+        
+        # ВАЖНО: Явно удаляем лобби (сессия Steam остаётся подключенной)
+        phases.enter('closing')
+        if dota.lobby is not None:
+            local_logger.info(f"[{username}] Удаление лобби...")
+            try:
+                dota.destroy_lobby()
+                # Ждём, пока координатор удалит лобби (EVENT_LOBBY_REMOVED), вместо паузы
+                lobby_gone.wait(timeout=3)
+                dota.leave_practice_lobby()
+                local_logger.info(f"[{username}] ✅ Лобби удалено")
+            except Exception as destroy_error:
+                local_logger.warning(f"[{username}] Ошибка при удалении лобби: {destroy_error}")
+        dota.remove_listener(dota.EVENT_LOBBY_REMOVED, on_lobby_removed)
+        phases.enter('closed')
+
+
+class _WorkerLink:
+    """Связь процесса-хоста воркеров с ботом, переживающая перезапуск бота.
+    
+    Пока бот подключён - команды и события идут по его pipe'ам. Если бот упал
+    или отсоединился (EOF), хост не завершается: лобби продолжают жить, события
+    копятся в backlog, а новый экземпляр бота может подключиться к control_address
+    (unix-сокет) и подхватить все аккаунты хоста. Без control_address EOF = shutdown, как раньше.
+    """
+    BACKLOG_LIMIT = 100
+    
+    def __init__(self, name: str, command_conn, event_conn, control_address: Optional[str], local_logger):
+        self.name = name
+        self.command_conn = command_conn
+        self.event_conn = event_conn
+        self.logger = local_logger
+        self.accounts = {}  # Аккаунты хоста (username -> greenlet, очередь команд), заполняет хост
+        self.lobbies: Dict[str, dict] = {}  # username -> текущее созданное лобби (для переподключения)
+        self.ready: set = set()  # Аккаунты, прошедшие вход в Steam и GC
+        self.on_detach: Optional[Callable[[], None]] = None  # Будит сессии: пошёл отсчёт orphan_ttl
+        self.detached_at: Optional[float] = None
+        self._backlog: List[dict] = []
+        self._server = None
+        self._wakeup_recv, self._wakeup_send = os.pipe()  # wakeup(): прервать ожидание poll()
+        self._address = control_address
+        if control_address:
+            if os.path.exists(control_address):
+                os.unlink(control_address)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(control_address)
+            os.chmod(control_address, 0o600)
+            self._server.listen(1)
+    
+    @property
+    def attached(self) -> bool:
+        return self.command_conn is not None
+    
+    def detached_for(self) -> float:
+        return time.time() - self.detached_at if self.detached_at else 0
+    
+    def send(self, message: dict):
+        # Запоминаем лобби и готовность сессий, чтобы сообщить о них при переподключении.
+        # Лобби, удалённое по команде (закрытие, отмена), lobby_closed не шлёт - его
+        # конец виден по фазе closed
+        account = message.get('account')
+        event = message.get('event')
+        if message.get('success') and message.get('lobby_name'):
+            self.lobbies[account] = {key: message.get(key) for key in ('lobby_name', 'password', 'server', 'mode', 'series_type')}
+        elif (message.get('lobby_closed') or event == 'account_stopped'
+              or (event == 'lobby_phase' and message.get('phase') == 'closed')):
+            lobby = self.lobbies.get(account)
+            if lobby and message.get('lobby_name') in (None, lobby['lobby_name']):
+                del self.lobbies[account]
+        if event == 'session_ready':
+            self.ready.add(account)
+        elif event == 'account_stopped':
+            self.ready.discard(account)
+        
+        if self.event_conn is not None:
+            try:
+                self.event_conn.send(message)
+                return
+            except (OSError, EOFError):
+                self._detach()
+        if self._server is None:
+            return
+        if message.get('event') == 'lobby_snapshot':
+            # Из снимков лобби важен только последний
+            self._backlog = [m for m in self._backlog
+                             if m.get('event') != 'lobby_snapshot' or m.get('account') != account]
+        self._backlog.append(message)
+        del self._backlog[:-self.BACKLOG_LIMIT]
+    
+    def wakeup(self):
+        """Прерывает poll() (из другого greenlet'а): хосту нужно пересмотреть состояние"""
+        os.write(self._wakeup_send, b'+')
+    
+    def poll(self, timeout: Optional[float]) -> Optional[dict]:
+        """Ждём команду, не блокируя gevent hub (timeout=None - без ограничения).
+        None - команды не было (таймаут, wakeup() или переподключение бота)."""
+        import gevent.select
+        
+        waitables = [conn for conn in (self.command_conn, self._server) if conn is not None]
+        readable, _, _ = gevent.select.select(waitables + [self._wakeup_recv], [], [], timeout)
+        if self._wakeup_recv in readable:
+            os.read(self._wakeup_recv, 4096)
+            return None
+        if self._server is not None and self._server in readable:
+            self._adopt()
+            return None
+        if self.command_conn is None or self.command_conn not in readable:
+            return None
+        try:
+            return self.command_conn.recv()
+        except (EOFError, OSError):
+            if self._server is None:
+                # Бот закрыл канал управления - завершаемся
+                return {'cmd': 'shutdown'}
+            self._detach()
+            return None
+    
+    def _detach(self):
+        if self.command_conn is None and self.event_conn is None:
+            return
+        for conn in {self.command_conn, self.event_conn}:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.command_conn = self.event_conn = None
+        self.detached_at = time.time()
+        lobbies = ', '.join(lobby['lobby_name'] for lobby in self.lobbies.values()) or 'нет'
+        self.logger.warning(f"[{self.name}] 🔌 Бот отключился, ждём переподключения (лобби: {lobbies})")
+        if self.on_detach is not None:
+            self.on_detach()
+    
+    def _adopt(self):
+        sock, _ = self._server.accept()
+        conn = multiprocessing.connection.Connection(sock.detach())
+        backlog, self._backlog = self._backlog, []
+        try:
+            conn.send({
+                'event': 'adopted',
+                'pid': os.getpid(),
+                'accounts': {username: self.lobbies.get(username) for username in self.accounts},
+                'ready': [username for username in self.accounts if username in self.ready],
+            })
+            for message in backlog:
+                conn.send(message)
+        except (OSError, EOFError):
+            # Подключившийся уже ушёл (например, не дождался ответа)
+            conn.close()
+            self._backlog = backlog + self._backlog
+            return
+        if self.attached:
+            # Новый экземпляр бота сменяет старый (старый завис или ещё не вышел)
+            self._detach()
+        self.command_conn = self.event_conn = conn
+        self.detached_at = None
+        self.logger.info(f"[{self.name}] 🔗 Хост подхвачен новым экземпляром бота (аккаунтов: {len(self.accounts)})")
+    
+    def close(self):
+        for conn in {self.command_conn, self.event_conn}:
+            if conn is not None:
+                conn.close()
+        self.command_conn = self.event_conn = None
+        for fd in (self._wakeup_recv, self._wakeup_send):
+            os.close(fd)
+        if self._server is not None:
+            self._server.close()
+            try:
+                os.unlink(self._address)
+            except OSError:
+                pass
+
+
+class _AccountEvents:
+    """Канал событий одного аккаунта внутри хоста: каждое событие помечается аккаунтом"""
+    def __init__(self, link: _WorkerLink, username: str):
+        self.link = link
+        self.username = username
+    
+    def send(self, message: dict):
+        self.link.send({**message, 'account': self.username})
+
+
+def _rss_kb() -> Optional[int]:
+    """Текущий RSS процесса в КБ (Linux /proc), иначе пиковый через getrusage"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
+# Ответы Steam на вход, означающие "слишком много входов" (повторяем позже, а не падаем)
+LOGIN_THROTTLE_RESULTS = {'RateLimitExceeded', 'TryAnotherCM', 'ServiceUnavailable', 'Busy',
+                          'AccountLoginDeniedThrottle'}
+
+
+def _connect_cm(steam, cm_servers: Optional[List[list]], local_logger) -> dict:
+    """
+    Подключение SteamClient к CM-серверу до входа.
+    cm_servers - список [ip, port] из кэша бота, самые быстрые первыми: пробуем их
+    по очереди (каждый с замером), без справочника серверов Steam. Если кэша нет
+    или ни один сервер не ответил - бутстрап библиотеки, и боту уходит новый список.
+    Возвращает событие cm_connected: server, connect_ms, source, failed, servers.
+    """
+    failed = []
+    if cm_servers:
+        try:
+            steam.cm_servers.clear()
+            steam.cm_servers.merge_list([tuple(addr) for addr in cm_servers])
+        except Exception as e:
+            local_logger.warning(f"Кэш CM-серверов не применён: {e}")
+            cm_servers = None
+        
+        for addr in cm_servers or ():
+            connect_started = time.perf_counter()
+            if steam.connect(retry=1):
+                ip, port = steam.current_server_addr
+                return {
+                    'event': 'cm_connected',
+                    'server': f"{ip}:{port}",
+                    'connect_ms': (time.perf_counter() - connect_started) * 1000,
+                    'source': 'cache',
+                    'failed': failed,
+                }
+            failed.append(f"{addr[0]}:{addr[1]}")
+            steam.cm_servers.mark_bad(tuple(addr))
+        
+        local_logger.warning(f"Ни один CM-сервер из кэша не ответил ({len(failed)}), запрашиваем список у Steam")
+        steam.cm_servers.clear()
+    
+    connect_started = time.perf_counter()
+    if not steam.connect():
+        return {'event': 'cm_connected', 'server': None, 'source': 'bootstrap', 'failed': failed}
+    ip, port = steam.current_server_addr
+    return {
+        'event': 'cm_connected',
+        'server': f"{ip}:{port}",
+        'connect_ms': (time.perf_counter() - connect_started) * 1000,
+        'source': 'bootstrap',
+        'failed': failed,
+        'servers': [f"{ip}:{port}" for ip, port in list(getattr(steam.cm_servers, 'list', {}))[:200]],
+    }
+
+
+def _account_session(username: str, password: str, commands, event_conn, link: _WorkerLink,
+                     persistent: bool, idle_ttl: int, orphan_ttl: int, imports_ms: Optional[float], local_logger,
+                     cm_servers: Optional[List[list]] = None, credentials: Optional[dict] = None):
+    """
+    Жизненный цикл одного аккаунта внутри процесса-хоста (отдельный greenlet):
+    вход в Steam → запуск Dota 2 → готов (цикл команд) → удаление лобби → выход из Steam.
+    commands - gevent.queue.Queue команд этого аккаунта:
+      - {'cmd': 'create', 'lobby_name', 'password', 'server', 'mode', 'series_type',
+         'idle_timeout', 'max_lifetime'}
+      - {'cmd': 'destroy'} - удалить текущее лобби, сессию оставить
+      - {'cmd': 'shutdown'} - удалить лобби и выйти из Steam
+      - {'cmd': 'login'} - повторить вход после login_throttled (разрешение бота)
+      - {'cmd': 'wake'} - внутренняя: пересчитать сроки (лобби закончилось, бот отсоединился)
+    event_conn - события аккаунта (session_ready, результат создания, lobby_closed).
+    persistent=False - сессия завершается после первого лобби (старое поведение).
+    idle_ttl - через сколько секунд без лобби тёплая сессия завершается (0 = никогда).
+    Без бота (link отсоединён) сессия доживает текущее лобби и ещё orphan_ttl секунд.
+    imports_ms - время импортов хоста, если хост запущен ради этой сессии (None - хост уже работал).
+    cm_servers - CM-серверы из кэша бота, быстрые первыми (см. _connect_cm).
+    credentials - {'login_key', 'sentry'} из CredentialCache бота: вход по ключу без
+    пароля; отклонённый ключ сбрасывается (событие credentials) и вход идёт по паролю.
+    Новые ключ и sentry от Steam уходят боту тем же событием.
+    """
+    import gevent.event
+    import gevent.queue
+    from steam.client import SteamClient
+    from steam.enums import EResult
+    from dota2.client import Dota2Client
+    
+    steam = None
+    lobby_stop = gevent.event.Event()
+    lobby_greenlet = None
+    deferred: List[dict] = []  # Команды, пришедшие во время ожидания повторного входа
+    
+    try:
+        local_logger.info(f"[{username}] Сессия запускается")
+        
+        # Создаем Steam клиент
+        steam = SteamClient()
+        dota = Dota2Client(steam)
+        
+        dota_ready = gevent.event.Event()
+        
+        def on_dota_ready():
+            local_logger.info(f"[{username}] Dota 2 готов")
+            dota_ready.set()  # Устанавливаем флаг готовности
+        
+        dota.on('ready', on_dota_ready)
+        
+        # Кэш входа: sentry (Steam Guard этой машины) и login key хранит бот, не файлы воркера
+        credentials = credentials or {}
+        login_key = credentials.get('login_key')
+        sentry = base64.b64decode(credentials['sentry']) if credentials.get('sentry') else None
+        
+        def store_sentry(_username, sentry_bytes):
+            event_conn.send({'event': 'credentials', 'sentry': base64.b64encode(sentry_bytes).decode('ascii')})
+            return True
+        
+        steam.get_sentry = lambda _username: sentry
+        steam.store_sentry = store_sentry
+        steam.on('new_login_key', lambda: event_conn.send({'event': 'credentials', 'login_key': steam.login_key}))
+        
+        # Метрики старта воркера: бот считает задержку от допуска сессии до входа
+        # (spawned=False - сессия на уже работающем хосте, запуска процесса не было)
+        event_conn.send({
+            'event': 'worker_started',
+            'login_started_at': time.time(),
+            'spawned': imports_ms is not None,
+            'imports_ms': imports_ms or 0,
+            'rss_kb': _rss_kb(),
+            'start_method': multiprocessing.get_start_method(allow_none=True),
+        })
+        
+        # 1. Вход в Steam. Троттлинг Steam (RateLimitExceeded, TryAnotherCM...) - не ошибка:
+        # сообщаем боту и ждём от его контроля допуска команду login на повтор.
+        # Время входа считаем вместе с подключением к CM
+        local_logger.info(f"[{username}] Подключение к Steam...")
+        login_started = time.perf_counter()
+        event_conn.send(_connect_cm(steam, cm_servers, local_logger))
+        while True:
+            result = steam.login(username=username, password=password, login_key=login_key)
+            login_ms = (time.perf_counter() - login_started) * 1000
+            throttled = getattr(result, 'name', None) in LOGIN_THROTTLE_RESULTS
+            if login_key and result != EResult.OK and not throttled:
+                # Ключ отозван или истёк - забываем его и входим по паролю
+                local_logger.warning(f"[{username}] Steam отклонил login key ({result}), вход по паролю")
+                event_conn.send({'event': 'credentials', 'login_key': None})
+                login_key = None
+                continue
+            if result == EResult.OK or not throttled:
+                break
+            
+            local_logger.warning(f"[{username}] ⏳ Steam ограничивает входы ({result.name}), ждём повтора")
+            event_conn.send({'event': 'login_throttled', 'eresult': result.name})
+            # Без бота команда login может не прийти никогда: ждём не дольше orphan_ttl
+            # (wake от отсоединения бота - пересчитать срок)
+            while True:
+                timeout = None
+                if not link.attached:
+                    timeout = max(0.0, link.detached_at + orphan_ttl - time.time())
+                try:
+                    command = commands.get(timeout=timeout)
+                except gevent.queue.Empty:
+                    command = None
+                if command is None or command.get('cmd') == 'wake':
+                    if not link.attached and link.detached_for() >= orphan_ttl:
+                        local_logger.info(f"[{username}] 🔌 Бот не подключился за {orphan_ttl} сек, завершаемся")
+                        return
+                    continue
+                if command.get('cmd') in ('login', 'shutdown'):
+                    break
+                deferred.append(command)  # create и т.п. - выполним после входа
+            if command.get('cmd') == 'shutdown':
+                return
+            local_logger.info(f"[{username}] Повторный вход в Steam...")
+            login_started = time.perf_counter()
+        
+        if result != EResult.OK:
+            local_logger.error(f"[{username}] Ошибка входа: {result}")
+            event_conn.send({'success': False, 'error': f'Login failed: {result}'})
+            return
+        
+        local_logger.info(f"[{username}] Успешный вход в Steam")
+        
+        # 2. Запуск Dota 2
+        local_logger.info(f"[{username}] Запуск Dota 2...")
+        launch_started = time.perf_counter()
+        dota.launch()
+        
+        # Ждем подключения к координатору (макс 60 сек) - используем событие вместо фиксированного времени
+        if not dota_ready.wait(timeout=60):
+            local_logger.error(f"[{username}] Таймаут подключения Dota 2")
+            event_conn.send({'success': False, 'error': 'Dota 2 connection timeout'})
+            return
+        
+        event_conn.send({
+            'event': 'session_ready',
+            'login_ms': login_ms,
+            'login_method': 'login_key' if login_key else 'password',
+            'gc_ready_ms': (time.perf_counter() - launch_started) * 1000,
+        })
+        local_logger.info(f"[{username}] 🔥 Сессия готова, ждём команды")
+        
+        idle_since = time.time()
+        
+        # 3. Цикл команд: лобби живут в отдельных greenlet'ах. Периодического опроса нет:
+        # очередь будят команды бота и wake (конец лобби, отсоединение бота от хоста),
+        # а таймаут ожидания - ближайший срок простоя (idle_ttl) или сиротства (orphan_ttl)
+        while True:
+            timeout = None
+            if lobby_greenlet is None:
+                deadlines = []
+                if persistent and idle_ttl:
+                    deadlines.append(idle_since + idle_ttl)
+                if not link.attached:
+                    deadlines.append(link.detached_at + orphan_ttl)
+                if deadlines:
+                    timeout = max(0.0, min(deadlines) - time.time())
+            try:
+                command = deferred.pop(0) if deferred else commands.get(timeout=timeout)
+            except gevent.queue.Empty:
+                command = None
+            
+            if command is None or command.get('cmd') == 'wake':
+                if lobby_greenlet is not None and lobby_greenlet.dead:
+                    lobby_greenlet = None
+                    idle_since = time.time()
+                    if not persistent:
+                        break
+                if lobby_greenlet is None and persistent and idle_ttl and time.time() - idle_since >= idle_ttl:
+                    local_logger.info(f"[{username}] 💤 Сессия простаивает {idle_ttl} сек, завершаемся")
+                    break
+                if lobby_greenlet is None and not link.attached and link.detached_for() >= orphan_ttl:
+                    local_logger.info(f"[{username}] 🔌 Бот не подключился за {orphan_ttl} сек, завершаемся")
+                    break
+                continue
+            
+            cmd = command.get('cmd')
+            if cmd == 'create':
+                # Предыдущее лобби должно быть удалено до создания нового
+                if lobby_greenlet is not None and not lobby_greenlet.dead:
+                    lobby_stop.set()
+                    lobby_greenlet.join()
+                lobby_stop = gevent.event.Event()
+                lobby_greenlet = gevent.spawn(
+                    _run_lobby, steam, dota, username, command, event_conn, lobby_stop, local_logger
+                )
+                lobby_greenlet.link(lambda _: commands.put({'cmd': 'wake'}))
+            elif cmd == 'destroy':
+                local_logger.info(f"[{username}] 🛑 Получена команда удаления лобби!")
+                lobby_stop.set()
+            elif cmd == 'shutdown':
+                break
+    
+    except Exception as e:
+        local_logger.error(f"[{username}] Ошибка: {e}", exc_info=True)
+        event_conn.send({'success': False, 'error': str(e)})
+    
+    finally:
+        # КРИТИЧНО: Удаляем лобби перед выходом!
+        if lobby_greenlet is not None and not lobby_greenlet.dead:
+            local_logger.info(f"[{username}] 🗑️ Удаляем лобби перед выходом...")
+            lobby_stop.set()
+            lobby_greenlet.join(timeout=20)
+        
+        # Отключаемся от Steam
+        if steam is not None:
+            try:
+                steam.disconnect()
+                local_logger.info(f"[{username}] 👋 Отключились от Steam")
+            except Exception as disconnect_error:
+                local_logger.warning(f"[{username}] Ошибка при отключении: {disconnect_error}")
+
+
+def steam_worker_process(name: str, command_conn, event_conn, shutdown_event,
+                         persistent: bool = True, idle_ttl: int = 0,
+                         control_address: Optional[str] = None, orphan_ttl: int = 600,
+                         linger: bool = False, cpu: Optional[int] = None):
+    """
+    Процесс-хост долгоживущих сессий: один gevent hub, на нём greenlet'ы аккаунтов
+    (_account_session, у каждого свой SteamClient + Dota2Client).
+    Сколько аккаунтов делят хост, решает бот (ACCOUNTS_PER_HOST): 1 - процесс на аккаунт,
+    больше - меньше RSS на лобби ценой общей судьбы аккаунтов при падении процесса.
+    Команды по command_conn помечены аккаунтом:
+      - {'cmd': 'start', 'account', 'password', 'cm_servers', 'credentials'} - поднять сессию аккаунта
+      - {'cmd': 'create' | 'destroy' | 'shutdown', 'account', ...} - команда сессии
+      - {'cmd': 'shutdown'} без аккаунта - завершить все сессии и процесс
+    События сессий отправляются в event_conn с полем account; о завершении
+    сессии хост сообщает событием account_stopped. Хост выходит, когда на нём
+    не осталось сессий.
+    shutdown_event - аварийный сигнал завершения всего хоста.
+    control_address - unix-сокет, через который перезапущенный бот может подхватить хост.
+    linger=True - постоянный шард (WORKER_HOSTS): пустым не завершается, ждёт новых
+    аккаунтов (без бота - не дольше orphan_ttl). cpu - ядро, к которому привязан процесс.
+    Автозапуск:
+      - 1v1 Solo Mid: при 2 игроках (1 vs 1)
+      - Остальные режимы: при 10 игроках (5 vs 5)
+    """
+    # НЕ используем monkey.patch_all() - это вызывает RecursionError
+    # gevent работает и без этого в отдельном процессе.
+    # В режиме forkserver эти модули уже загружены в шаблонном процессе
+    # (WORKER_PRELOAD_MODULES), и import здесь ничего не стоит
+    imports_started = time.perf_counter()
+    import gevent
+    import gevent.queue
+    for module_name in ('steam.client', 'steam.enums', 'dota2.client'):
+        __import__(module_name)  # Сессии аккаунтов импортируют их у себя, здесь - замер и прогрев
+    imports_ms = (time.perf_counter() - imports_started) * 1000
+    
+    logging.basicConfig(level=logging.INFO)
+    local_logger = logging.getLogger(f"steam_worker_{name}")
+    
+    link = None
+    accounts: Dict[str, tuple] = {}  # username -> (greenlet сессии, очередь её команд)
+    started_any = False
+    
+    if control_address:
+        # Своя сессия процессов: Ctrl+C/SIGHUP терминала бота не должны убивать лобби
+        try:
+            os.setsid()
+        except OSError:
+            pass
+    
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        # Шарды разнесены по ядрам: gevent hub однопоточный, больше одного ядра ему не нужно
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except OSError as e:
+            local_logger.warning(f"[{name}] Не удалось привязать процесс к ядру {cpu}: {e}")
+    
+    try:
+        local_logger.info(f"[{name}] Процесс запущен" + (f" (ядро {cpu})" if cpu is not None else ""))
+        link = _WorkerLink(name, command_conn, event_conn, control_address, local_logger)
+        link.accounts = accounts
+        
+        def wake_sessions():
+            for _, commands in accounts.values():
+                commands.put({'cmd': 'wake'})
+        
+        link.on_detach = wake_sessions
+        
+        def session_ended(username: str, greenlet):
+            # Сессия аккаунта завершилась: сообщаем боту и будим цикл (может, хосту пора выходить)
+            if accounts.get(username, (None,))[0] is greenlet:
+                del accounts[username]
+                link.send({'event': 'account_stopped', 'account': username})
+            link.wakeup()
+        
+        # Без периодического опроса: poll будят команды бота, переподключение и конец
+        # сессий (session_ended). Таймаут нужен только пустому шарду без бота - до orphan_ttl.
+        # shutdown_event бот выставляет вместе с командой shutdown (или рвёт pipe - EOF
+        # тоже будит poll), поэтому проверять его между пробуждениями достаточно
+        while not shutdown_event.is_set():
+            timeout = None
+            if not accounts and linger and not link.attached:
+                timeout = max(0.0, link.detached_at + orphan_ttl - time.time())
+            command = link.poll(timeout)
+            
+            if command is None:
+                if not accounts and not linger and started_any:
+                    local_logger.info(f"[{name}] Сессий не осталось, завершаемся")
+                    break
+                if not accounts and linger and not link.attached and link.detached_for() >= orphan_ttl:
+                    local_logger.info(f"[{name}] 🔌 Бот не подключился за {orphan_ttl} сек, шард завершается")
+                    break
+                continue
+            
+            cmd = command.get('cmd')
+            username = command.get('account')
+            if cmd == 'start':
+                if username in accounts:
+                    continue
+                commands = gevent.queue.Queue()
+                greenlet = gevent.spawn(
+                    _account_session, username, command['password'], commands,
+                    _AccountEvents(link, username), link, persistent, idle_ttl, orphan_ttl,
+                    None if started_any else imports_ms, local_logger, command.get('cm_servers'),
+                    command.get('credentials'),
+                )
+                accounts[username] = (greenlet, commands)
+                greenlet.link(lambda dead, username=username: session_ended(username, dead))
+                started_any = True
+            elif username is None:
+                if cmd == 'shutdown':
+                    break
+            elif username in accounts:
+                accounts[username][1].put(command)
+        
+    except KeyboardInterrupt:
+        local_logger.info(f"[{name}] 🛑 Получен сигнал прерывания (Ctrl+C)!")
+            
+    except Exception as e:
+        local_logger.error(f"[{name}] Ошибка: {e}", exc_info=True)
+    
+    finally:
+        # КРИТИЧНО: каждая сессия удаляет своё лобби перед выходом!
+        for _, commands in accounts.values():
+            commands.put({'cmd': 'shutdown'})
+        gevent.joinall([greenlet for greenlet, _ in accounts.values()], timeout=25)
+        
+        if link is not None:
+            link.close()
+
+
+class SteamAccount:
+    """Информация об аккаунте"""
+    __slots__ = ('username', 'password', 'current_lobby', '_busy', '_registry')
+    
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+        self.current_lobby = None
+        self._busy = False
+        self._registry: Optional['AccountRegistry'] = None
+    
+    @property
+    def is_busy(self) -> bool:
+        return self._busy
+    
+    @is_busy.setter
+    def is_busy(self, value: bool):
+        value = bool(value)
+        if value != self._busy:
+            self._busy = value
+            if self._registry is not None:
+                self._registry._mark(self)
+        
+    def to_dict(self):
+        return {
+            'username': self.username,
+            'password': self.password
+        }
+
+
+class AccountRegistry:
+    """Реестр аккаунтов: индекс по логину и поддерживаемые множества свободных/занятых.
+    
+    Поиск, захват и освобождение аккаунта - O(1); порядок обхода - порядок добавления.
+    """
+    def __init__(self):
+        self._by_username: Dict[str, SteamAccount] = {}
+        self._free: Dict[str, SteamAccount] = {}  # dict как упорядоченное множество
+        self._busy: set = set()
+        self._waiters: List[asyncio.Future] = []  # Ждут освобождения любого аккаунта
+    
+    def __len__(self) -> int:
+        return len(self._by_username)
+    
+    def __iter__(self):
+        return iter(list(self._by_username.values()))
+    
+    def __contains__(self, username: str) -> bool:
+        return username in self._by_username
+    
+    def get(self, username: str) -> Optional[SteamAccount]:
+        return self._by_username.get(username)
+    
+    def add(self, account: SteamAccount):
+        if account.username in self._by_username:
+            raise ValueError(f"Аккаунт {account.username} уже добавлен")
+        account._registry = self
+        self._by_username[account.username] = account
+        self._mark(account)
+    
+    def remove(self, username: str) -> Optional[SteamAccount]:
+        account = self._by_username.pop(username, None)
+        if account is not None:
+            self._free.pop(username, None)
+            self._busy.discard(username)
+            account._registry = None
+        return account
+    
+    def rename(self, old_username: str, new_username: str, password: str):
+        """Смена логина/пароля с переиндексацией (позиция в списке сохраняется)"""
+        if new_username != old_username and new_username in self._by_username:
+            raise ValueError(f"Аккаунт {new_username} уже добавлен")
+        account = self._by_username[old_username]
+        self._free.pop(old_username, None)
+        self._busy.discard(old_username)
+        account.username = new_username
+        account.password = password
+        self._by_username = {
+            (new_username if username == old_username else username): acc
+            for username, acc in self._by_username.items()
+        }
+        self._mark(account)
+    
+    def is_free(self, username: str) -> bool:
+        return username in self._free
+    
+    def free(self) -> List[SteamAccount]:
+        return list(self._free.values())
+    
+    @property
+    def free_count(self) -> int:
+        return len(self._free)
+    
+    @property
+    def busy_count(self) -> int:
+        return len(self._busy)
+    
+    def acquire(self, username: Optional[str] = None) -> Optional[SteamAccount]:
+        """Занимает указанный аккаунт (если свободен) или первый свободный"""
+        if username is None:
+            account = next(iter(self._free.values()), None)
+        else:
+            account = self._free.get(username)
+        if account is not None:
+            account.is_busy = True
+        return account
+    
+    def release(self, username: str) -> Optional[SteamAccount]:
+        """Освобождает аккаунт и отвязывает от него лобби"""
+        account = self._by_username.get(username)
+        if account is not None:
+            account.is_busy = False
+            account.current_lobby = None
+        return account
+    
+    def release_all(self):
+        for username in list(self._busy):
+            self.release(username)
+    
+    async def wait_free(self, timeout: float) -> bool:
+        """Ждёт, пока освободится хотя бы один аккаунт (без опроса). False - таймаут."""
+        if self._free:
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+    
+    def _mark(self, account: SteamAccount):
+        if account.is_busy:
+            self._free.pop(account.username, None)
+            self._busy.add(account.username)
+        else:
+            self._busy.discard(account.username)
+            self._free[account.username] = account
+            waiters, self._waiters = self._waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(True)
+
+
+class ScheduleAllocator:
+    """Распределение аккаунтов по матчам расписания с учётом времени.
+    
+    Матч занимает аккаунт на окно [старт - lead, старт + длительность серии]:
+    серии разной длины держат аккаунт разное время, а матчи с непересекающимися
+    окнами (раунды в 18:00 и 21:00) делят одни и те же аккаунты. Аккаунты
+    раздаются жадно по времени начала окна (интервальная раскраска), так что
+    перегрузка - это только момент, где одновременно нужно больше окон, чем аккаунтов.
+    """
+    # Оценка длительности серии в минутах: до 35 минут сбора + игры по ~55 минут
+    DEFAULT_SERIES_MINUTES = {'bo1': 90, 'bo2': 150, 'bo3': 210, 'bo5': 330}
+    
+    def __init__(self, series_minutes: Optional[Dict[str, int]] = None, lead_seconds: int = 0):
+        self.series_minutes = {**self.DEFAULT_SERIES_MINUTES, **(series_minutes or {})}
+        self.lead_seconds = max(0, lead_seconds)
+    
+    @staticmethod
+    def parse_minutes(value: str) -> Dict[str, int]:
+        """'bo1=90,bo3=240' -> {'bo1': 90, 'bo3': 240}"""
+        result = {}
+        for item in value.split(','):
+            if '=' in item:
+                series, minutes = item.split('=', 1)
+                result[series.strip().lower()] = int(minutes)
+        return result
+    
+    def window(self, match: dict) -> Optional[tuple]:
+        """(начало, конец) окна матча или None, если дата не разбирается"""
+        try:
+            start = datetime.strptime(f"{match.get('date')} {match.get('time')}", '%d.%m.%Y %H:%M')
+        except (TypeError, ValueError):
+            return None
+        minutes = self.series_minutes.get(str(match.get('series_type') or 'bo1').lower(), self.series_minutes['bo1'])
+        return start - timedelta(seconds=self.lead_seconds), start + timedelta(minutes=minutes)
+    
+    def plan(self, matches: List[dict], usernames: List[str], now: datetime) -> tuple:
+        """Раскладывает включённые будущие/идущие матчи по аккаунтам.
+        Возвращает ({id матча: username}, [матчи, которым аккаунта не хватило]).
+        """
+        windows = []
+        for match in matches:
+            if not match.get('enabled', False) or match.get('status', 'scheduled') not in ('scheduled', 'active'):
+                continue
+            window = self.window(match)
+            if window is None or window[1] <= now:
+                continue
+            windows.append((window[0], window[1], match))
+        windows.sort(key=lambda item: (item[0], item[1]))
+        
+        assignment: Dict[str, str] = {}
+        overflow: List[dict] = []
+        free = list(usernames)
+        in_use: List[tuple] = []  # (конец окна, username)
+        for start, end, match in windows:
+            # Аккаунты, чьи окна закончились к началу этого, снова свободны
+            for item in [item for item in in_use if item[0] <= start]:
+                in_use.remove(item)
+                free.append(item[1])
+            if not free:
+                overflow.append(match)
+                continue
+            username = free.pop(0)
+            in_use.append((end, username))
+            assignment[str(match.get('id'))] = username
+        return assignment, overflow
+
+
+class LobbyRetryPolicy:
+    """Повторы создания лобби после ошибки воркера.
+    
+    Ошибки делятся на классы: отмена (не повторяем), ошибка аккаунта (Steam
+    отклонил вход - сразу берём другой аккаунт) и временные (таймаут GC или
+    создания, падение процесса - повтор на том же аккаунте, затем другой).
+    Пауза между попытками - экспонента с полным джиттером, чтобы одновременные
+    повторы не били в Steam залпом; все попытки укладываются в общий бюджет.
+    """
+    CANCELLED = 'cancelled'
+    ACCOUNT = 'account'
+    TRANSIENT = 'transient'
+    
+    def __init__(self, max_attempts: int = 3, budget: float = 300, base_delay: float = 2,
+                 max_delay: float = 20, same_account_retries: int = 1, min_attempt: float = 30):
+        self.max_attempts = max(1, max_attempts)
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.same_account_retries = same_account_retries
+        self.min_attempt = min_attempt  # Меньше - попытка не успеет даже войти в Steam
+    
+    @classmethod
+    def classify(cls, error: Optional[str]) -> str:
+        if error == 'Cancelled':
+            return cls.CANCELLED
+        if error and error.startswith('Login failed'):
+            return cls.ACCOUNT
+        return cls.TRANSIENT
+    
+    def delay(self, failures: int) -> float:
+        """Пауза после failures-й неудачной попытки"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (failures - 1)))
+    
+    def describe(self) -> str:
+        return (f"до {self.max_attempts} попыток за {self.budget:.0f} сек, "
+                f"повторов на том же аккаунте {self.same_account_retries}")
+
+
+class LobbyMetrics:
+    """Длительности этапов создания лобби: скользящее окно последних замеров
+    по каждому этапу и перцентили p50/p95/p99 по нему.
+    
+    Этапы воркера: login (вход в Steam, последняя попытка), gc_ready (launch → ready координатора),
+    фазы лобби (cleanup, creating = create_practice_lobby → EVENT_LOBBY_NEW,
+    configuring, broadcast, joining). Этапы бота: session_start (запуск сессии →
+    готовность, включая очередь входа), login_queue (ожидание допуска), create_command (команда create → ответ), create_total (весь вызов).
+    """
+    STAGES = ('login_queue', 'session_start', 'cm_connect', 'login', 'gc_ready', 'cleanup', 'creating',
+              'configuring', 'broadcast', 'joining', 'create_command', 'create_total')
+    BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 180)  # Границы гистограммы, сек
+    
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._samples: Dict[str, List[float]] = {}
+        self.started_at = time.time()
+    
+    def record(self, stage: str, seconds: Optional[float]):
+        if seconds is None or seconds < 0:
+            return
+        samples = self._samples.setdefault(stage, [])
+        samples.append(seconds)
+        del samples[:-self.window]
+    
+    @staticmethod
+    def _percentile(ordered: List[float], percent: float) -> float:
+        # Nearest-rank: значение, не меньше которого percent% замеров
+        rank = max(1, -(-len(ordered) * percent // 100))
+        return ordered[int(rank) - 1]
+    
+    def summary(self) -> Dict[str, dict]:
+        result = {}
+        stages = [stage for stage in self.STAGES if stage in self._samples]
+        stages += sorted(stage for stage in self._samples if stage not in self.STAGES)
+        for stage in stages:
+            ordered = sorted(self._samples[stage])
+            if not ordered:
+                continue
+            result[stage] = {
+                'count': len(ordered),
+                'p50': self._percentile(ordered, 50),
+                'p95': self._percentile(ordered, 95),
+                'p99': self._percentile(ordered, 99),
+                'max': ordered[-1],
+            }
+        return result
+    
+    def histogram(self, stage: str) -> List[tuple]:
+        """[(верхняя граница сек или None = больше последней, число замеров)]"""
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for value in self._samples.get(stage, []):
+            index = next((i for i, bound in enumerate(self.BUCKETS) if value <= bound), len(self.BUCKETS))
+            counts[index] += 1
+        return list(zip(list(self.BUCKETS) + [None], counts))
+    
+    def export(self) -> dict:
+        return {
+            'since': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'exported_at': datetime.now().isoformat(timespec='seconds'),
+            'window': self.window,
+            'summary': self.summary(),
+            'histograms': {
+                stage: [{'le': bound, 'count': count} for bound, count in self.histogram(stage)]
+                for stage in self._samples
+            },
+            'samples': {stage: list(samples) for stage, samples in self._samples.items()},
+        }
+
+
+class LobbyInfo:
+    """Информация о лобби"""
+    def __init__(self, lobby_name: str, password: str, account: str):
+        self.lobby_name = lobby_name  # "wb cup 1", "wb cup 2"
+        self.password = password
+        self.account = account
+        self.created_at = datetime.now()
+        self.creation_seconds = None  # Сколько заняло создание (вход + GC + лобби)
+        self.attempts = 1  # Попыток создания (с повторами и сменой аккаунта)
+        self.players_count = 0
+        self.status = "active"
+        # Живое состояние из снимков воркера
+        self.radiant = 0
+        self.dire = 0
+        self.spectators = 0
+        self.capacity = 10  # 2 для 1v1
+        self.lobby_state = None
+        self.updated_at = None
+        # Фаза жизненного цикла из воркера (open, launching, in_game...) и длительности фаз, сек
+        self.phase: Optional[str] = None
+        self.phase_durations: Dict[str, float] = {}
+    
+    def apply_phase(self, phase: str, durations: Dict[str, float]):
+        self.phase = phase
+        self.phase_durations = dict(durations)
+    
+    def apply_snapshot(self, snapshot: dict):
+        self.radiant = snapshot.get('radiant', 0)
+        self.dire = snapshot.get('dire', 0)
+        self.spectators = snapshot.get('spectators', 0)
+        self.capacity = snapshot.get('capacity', self.capacity)
+        self.lobby_state = snapshot.get('state')
+        self.players_count = self.radiant + self.dire
+        self.updated_at = datetime.now()
+    
+    def fill_emoji(self) -> str:
+        if self.players_count >= self.capacity:
+            return "🟢"
+        return "🟡" if self.players_count else "⚪"
+    
+    def players_line(self) -> str:
+        line = f"👥 Игроков: {self.players_count}/{self.capacity} (Radiant {self.radiant} / Dire {self.dire})"
+        if self.spectators:
+            line += f" 👀 {self.spectators}"
+        if self.phase in ('launching', 'in_game'):
+            line += " 🎮" if self.phase == 'in_game' else " 🚀"
+        return line
+
+
+class SilentStatusMessage:
+    """Заглушка status_msg: используется там, где прогресс показывается отдельно
+    (параллельное создание, создание по расписанию)"""
+    async def edit_text(self, *args, **kwargs):
+        pass
+
+
+class StatusMessageUpdater:
+    """Обновление статусных сообщений Telegram без флуда.
+    
+    Для каждого сообщения хранится желаемый текст; в Telegram уходит только
+    последний вариант и только если он отличается от отправленного.
+    В один чат - не чаще min_interval, RetryAfter (429) откладывает весь чат.
+    Создание лобби никогда не ждёт Telegram: set() только запоминает текст.
+    """
+    def __init__(self, min_interval: float = 3.0):
+        self.min_interval = min_interval
+        self._desired: Dict[tuple, tuple] = {}   # (chat_id, message_id) -> (message, text, kwargs)
+        self._sent: Dict[tuple, tuple] = {}      # (chat_id, message_id) -> отправленная сигнатура
+        self._chat_next_at: Dict[int, float] = {}  # chat_id -> когда можно следующее изменение
+        self._chat_tasks: Dict[int, asyncio.Task] = {}
+    
+    @staticmethod
+    def _key(message) -> Optional[tuple]:
+        chat_id = getattr(message, 'chat_id', None)
+        message_id = getattr(message, 'message_id', None)
+        if chat_id is None or message_id is None:
+            return None  # SilentStatusMessage и т.п.
+        return (chat_id, message_id)
+    
+    def set(self, message, text: str, **kwargs):
+        """Запомнить желаемый текст; отправится при ближайшем сбросе чата"""
+        key = self._key(message)
+        if key is None:
+            return
+        self._desired[key] = (message, text, kwargs)
+        chat_id = key[0]
+        task = self._chat_tasks.get(chat_id)
+        if task is None or task.done():
+            self._chat_tasks[chat_id] = asyncio.create_task(self._flush_chat(chat_id))
+    
+    async def set_now(self, message, text: str, **kwargs):
+        """Финальный текст: отменяет отложенные обновления и отправляется сразу
+        (с учётом лимита чата и RetryAfter)"""
+        key = self._key(message)
+        if key is None:
+            await message.edit_text(text, **kwargs)
+            return
+        self._desired.pop(key, None)
+        await self._wait_chat(key[0])
+        await self._send(key, message, text, kwargs, final=True)
+    
+    async def _wait_chat(self, chat_id: int):
+        delay = self._chat_next_at.get(chat_id, 0) - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    async def _flush_chat(self, chat_id: int):
+        while True:
+            await self._wait_chat(chat_id)
+            keys = [key for key in self._desired if key[0] == chat_id]
+            if not keys:
+                break
+            for key in keys:
+                entry = self._desired.pop(key, None)
+                if entry:
+                    await self._send(key, *entry)
+        self._chat_tasks.pop(chat_id, None)
+    
+    async def _send(self, key: tuple, message, text: str, kwargs: dict, final: bool = False):
+        loop = asyncio.get_running_loop()
+        markup = kwargs.get('reply_markup')
+        signature = (text, markup.to_json() if markup is not None else None)
+        if self._sent.get(key) == signature:
+            return
+        
+        try:
+            await message.edit_text(text, **kwargs)
+            self._remember(key, signature)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"⏳ Telegram просит подождать {retry_after} сек (чат {key[0]})")
+            self._chat_next_at[key[0]] = loop.time() + float(retry_after)
+            if final:
+                await self._wait_chat(key[0])
+                await self._send(key, message, text, kwargs, final=True)
+            else:
+                # Повторим, если за это время не появился более свежий текст
+                self._desired.setdefault(key, (message, text, kwargs))
+            return
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                self._remember(key, signature)
+            else:
+                logger.debug(f"Не удалось обновить статус {key}: {e}")
+        except Exception as e:
+            logger.debug(f"Не удалось обновить статус {key}: {e}")
+        
+        self._chat_next_at[key[0]] = max(self._chat_next_at.get(key[0], 0), loop.time() + self.min_interval)
+    
+    def _remember(self, key: tuple, signature: tuple):
+        self._sent.pop(key, None)
+        self._sent[key] = signature
+        if len(self._sent) > 500:
+            self._sent.pop(next(iter(self._sent)))
+
+
+class JsonStore:
+    """Хранилище состояния в JSON-файлах без блокировки event loop.
+    
+    Серия изменений за delay секунд склеивается в одну запись; запись идёт в
+    отдельном потоке (по одному файлу за раз, порядок сохраняется) и атомарна:
+    временный файл + fsync + os.replace, так что падение посреди записи не
+    портит файл.
+    """
+    def __init__(self, delay: float = 0.5):
+        self.delay = delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-store')
+        self._pending: Dict[str, Callable[[], object]] = {}  # путь -> функция, собирающая данные
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+    
+    def load(self, path: str):
+        """Данные файла или None, если его ещё нет"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def save(self, path: str, build: Callable[[], object]):
+        """Запланировать запись path; build() вызывается в момент записи"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Event loop ещё не запущен (загрузка при старте) - пишем сразу
+            self._executor.submit(self._write, path, self._dump(build())).result()
+            return
+        
+        self._pending[path] = build
+        if path not in self._timers:
+            self._timers[path] = loop.call_later(self.delay, self._flush, path)
+    
+    def _flush(self, path: str):
+        self._timers.pop(path, None)
+        build = self._pending.pop(path, None)
+        if build is None:
+            return
+        try:
+            # Снимок данных берём в потоке event loop, на диск пишем в фоне
+            text = self._dump(build())
+        except Exception as e:
+            logger.error(f"Ошибка подготовки {path}: {e}")
+            return
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._write, path, text)
+        future.add_done_callback(lambda f: f.exception() and logger.error(f"Ошибка записи {path}: {f.exception()}"))
+    
+    def flush_all(self):
+        """Синхронно записать всё отложенное (при остановке бота)"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        pending, self._pending = self._pending, {}
+        for path, build in pending.items():
+            try:
+                self._executor.submit(self._write, path, self._dump(build())).result(timeout=10)
+            except Exception as e:
+                logger.error(f"Ошибка записи {path}: {e}")
+        # Дожидаемся фоновых записей
+        self._executor.submit(lambda: None).result(timeout=10)
+    
+    # История лобби и выборки есть только в SQLite
+    def record_lobby_created(self, lobby: 'LobbyInfo'):
+        pass
+    
+    def record_lobby_closed(self, lobby_name: str, reason: str = 'closed'):
+        pass
+    
+    def count_upcoming_matches(self, now: datetime, within: timedelta) -> Optional[int]:
+        return None
+    
+    def count_lobbies_since(self, since: float) -> Optional[int]:
+        return None
+    
+    @staticmethod
+    def _dump(data) -> str:
+        return json.dumps(data, ensure_ascii=False, indent=2)
+    
+    def _write(self, path: str, text: str):
+        self._write_atomic(path, text)
+    
+    @staticmethod
+    def _write_atomic(path: str, text: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # Фиксируем переименование в каталоге (на Windows недоступно - не критично)
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+        logger.debug(f"💾 Сохранено: {path}")
+
+
+class SqliteStore(JsonStore):
+    """Хранилище состояния в SQLite (WAL): аккаунты, настройки, матчи, история лобби.
+    
+    Интерфейс тот же, что у JsonStore (load/save по имени бывшего JSON-файла),
+    поэтому load_*/save_* бота не зависят от бэкенда. При первом запуске данные
+    подхватываются из существующих JSON-файлов. Матчи хранятся построчно с
+    индексами по статусу и времени старта и пишутся только изменившиеся.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS accounts (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS matches (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            status TEXT,
+            enabled INTEGER NOT NULL DEFAULT 0,
+            start_at TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_matches_status_start ON matches(status, start_at);
+        CREATE INDEX IF NOT EXISTS idx_matches_start ON matches(start_at);
+        CREATE TABLE IF NOT EXISTS lobby_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lobby_name TEXT NOT NULL,
+            account TEXT,
+            password TEXT,
+            created_at REAL NOT NULL,
+            closed_at REAL,
+            close_reason TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_lobby_history_created ON lobby_history(created_at);
+        CREATE INDEX IF NOT EXISTS idx_lobby_history_open ON lobby_history(lobby_name, closed_at);
+    """
+    
+    # Отметка в kv: аккаунты уже хранятся в базе (перенос из JSON выполнен)
+    ACCOUNTS_MARKER = 'accounts_migrated'
+    
+    def __init__(self, db_path: str, delay: float = 0.5):
+        super().__init__(delay)
+        self.db_path = db_path
+        # Одно соединение; все записи идут через единственный поток executor'а
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        # Отдельное соединение для выборок из event loop (WAL: чтение не ждёт записи)
+        self._reader = sqlite3.connect(db_path, check_same_thread=False)
+        self._written_matches: Dict[str, tuple] = {}  # id -> (позиция, data) последней записи
+        logger.info(f"🗄️ Хранилище SQLite: {db_path}")
+    
+    def load(self, path: str):
+        if path == 'steam_accounts.json':
+            rows = self._db.execute("SELECT username, password FROM accounts ORDER BY position").fetchall()
+            if rows or self._get_kv(self.ACCOUNTS_MARKER) is not None:
+                # Пустая таблица после переноса - все аккаунты удалены, JSON не перечитываем
+                return [{'username': username, 'password': password} for username, password in rows]
+        elif path == 'schedule_config.json':
+            config = self._get_kv(path)
+            if config is not None:
+                config['matches'] = []
+                for match_id, position, data in self._db.execute(
+                    "SELECT id, position, data FROM matches ORDER BY position"
+                ):
+                    config['matches'].append(json.loads(data))
+                    self._written_matches[match_id] = (position, data)
+                return config
+        else:
+            value = self._get_kv(path)
+            if value is not None:
+                return value
+        
+        # В базе пусто - переносим из JSON-файла (если он есть)
+        data = super().load(path)
+        if data is not None:
+            logger.info(f"🗄️ Перенос {path} в SQLite")
+            self._executor.submit(self._write, path, self._dump(data)).result()
+        return data
+    
+    def _get_kv(self, key: str):
+        row = self._db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _write(self, path: str, text: str):
+        data = json.loads(text)
+        with self._db:
+            self._db.execute("BEGIN")
+            if path == 'steam_accounts.json':
+                self._db.execute("DELETE FROM accounts")
+                self._db.executemany(
+                    "INSERT INTO accounts (username, password, position) VALUES (?, ?, ?)",
+                    [(acc['username'], acc['password'], idx) for idx, acc in enumerate(data)]
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (self.ACCOUNTS_MARKER, json.dumps(True))
+                )
+            elif path == 'schedule_config.json':
+                matches = data.pop('matches', [])
+                self._db.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (path, json.dumps(data, ensure_ascii=False))
+                )
+                self._write_matches(matches)
+            else:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (path, json.dumps(data, ensure_ascii=False))
+                )
+        logger.debug(f"🗄️ Сохранено в SQLite: {path}")
+    
+    def _write_matches(self, matches: List[dict]):
+        """Пишет только добавленные/изменённые матчи и удаляет исчезнувшие"""
+        seen = set()
+        for position, match in enumerate(matches):
+            match_id = str(match.get('id'))
+            seen.add(match_id)
+            data = json.dumps(match, ensure_ascii=False, sort_keys=True)
+            if self._written_matches.get(match_id) == (position, data):
+                continue
+            self._db.execute(
+                "INSERT OR REPLACE INTO matches (id, position, status, enabled, start_at, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (match_id, position, match.get('status'), int(bool(match.get('enabled'))),
+                 self._start_at(match), data)
+            )
+            self._written_matches[match_id] = (position, data)
+        
+        removed = [match_id for match_id in self._written_matches if match_id not in seen]
+        for match_id in removed:
+            self._db.execute("DELETE FROM matches WHERE id = ?", (match_id,))
+            del self._written_matches[match_id]
+    
+    @staticmethod
+    def _start_at(match: dict) -> Optional[str]:
+        """"26.10.2025" + "18:00" -> "2025-10-26T18:00" (сортируется как строка)"""
+        try:
+            day, month, year = map(int, match.get('date').split('.'))
+            hour, minute = map(int, match.get('time').split(':'))
+            return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}"
+        except Exception:
+            return None
+    
+    def record_lobby_created(self, lobby: 'LobbyInfo'):
+        self._executor.submit(
+            self._execute,
+            "INSERT INTO lobby_history (lobby_name, account, password, created_at) VALUES (?, ?, ?, ?)",
+            (lobby.lobby_name, lobby.account, lobby.password, lobby.created_at.timestamp())
+        )
+    
+    def record_lobby_closed(self, lobby_name: str, reason: str = 'closed'):
+        self._executor.submit(
+            self._execute,
+            "UPDATE lobby_history SET closed_at = ?, close_reason = ? "
+            "WHERE lobby_name = ? AND closed_at IS NULL",
+            (time.time(), reason, lobby_name)
+        )
+    
+    def _execute(self, sql: str, params: tuple):
+        try:
+            with self._db:
+                self._db.execute(sql, params)
+        except Exception as e:
+            logger.error(f"Ошибка записи в SQLite: {e}")
+    
+    def count_upcoming_matches(self, now: datetime, within: timedelta) -> Optional[int]:
+        row = self._reader.execute(
+            "SELECT COUNT(*) FROM matches WHERE status = 'scheduled' AND enabled = 1 "
+            "AND start_at >= ? AND start_at < ?",
+            (now.strftime('%Y-%m-%dT%H:%M'), (now + within).strftime('%Y-%m-%dT%H:%M'))
+        ).fetchone()
+        return row[0]
+    
+    def count_lobbies_since(self, since: float) -> Optional[int]:
+        row = self._reader.execute("SELECT COUNT(*) FROM lobby_history WHERE created_at >= ?", (since,)).fetchone()
+        return row[0]
+
+
+class NotificationDispatcher:
+    """Очередь уведомлений в Telegram (группа/топик и админы).
+    
+    Уведомления, пришедшие в течение window секунд в один чат/топик,
+    склеиваются в одно сообщение (дайджест) - например, когда по расписанию
+    одновременно стартует целый раунд. Разные чаты отправляются параллельно,
+    в один чат - не чаще лимита Telegram, с учётом RetryAfter.
+    """
+    MAX_MESSAGE_LENGTH = 4096
+    SEPARATOR = "\n\n➖➖➖➖➖➖\n\n"
+    
+    def __init__(self, window: float = 3.0):
+        self.window = window
+        self.bot = None  # выставляется в post_init
+        self._buffers: Dict[tuple, List[str]] = {}      # (chat_id, thread_id) -> тексты
+        self._tasks: Dict[tuple, asyncio.Task] = {}
+        self._waiting: set = set()  # Ключи, задачи которых ещё ждут окно дайджеста (тексты в буфере)
+        self._chat_next_at: Dict[str, float] = {}      # chat_id -> когда можно следующее сообщение
+    
+    @staticmethod
+    def _chat_interval(chat_id) -> float:
+        # Лимиты Telegram: ~1 сообщение/сек в личку, ~20 сообщений/мин в группу
+        return 3.0 if str(chat_id).startswith('-') else 1.0
+    
+    def notify(self, chat_id, text: str, thread_id: Optional[int] = None):
+        """Поставить уведомление в очередь (не ждёт отправки)"""
+        if not chat_id:
+            return
+        key = (str(chat_id), thread_id)
+        self._buffers.setdefault(key, []).append(text)
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            self._tasks[key] = asyncio.create_task(self._flush_later(key))
+    
+    def notify_admins(self, admin_ids, text: str):
+        for admin_id in admin_ids:
+            self.notify(admin_id, text)
+    
+    async def flush_all(self, timeout: float = 10):
+        """Немедленно отправить всё накопленное (при остановке бота).
+        Задачи, ждущие окно дайджеста, отменяем - их тексты ещё в буфере; уже
+        отправляющие сняли тексты с буфера, их дожидаемся (не дольше timeout)."""
+        sending = []
+        for key, task in list(self._tasks.items()):
+            if key in self._waiting:
+                task.cancel()
+            else:
+                sending.append(task)
+        if sending:
+            _, stuck = await asyncio.wait(sending, timeout=timeout)
+            if stuck:
+                logger.warning(f"⚠️ Не дождались отправки уведомлений в {len(stuck)} чат(ов)")
+        keys = [key for key, texts in self._buffers.items() if texts]
+        await asyncio.gather(*(self._flush(key) for key in keys), return_exceptions=True)
+    
+    async def _flush_later(self, key: tuple):
+        try:
+            self._waiting.add(key)
+            try:
+                await asyncio.sleep(self.window)
+            finally:
+                self._waiting.discard(key)
+            while self._buffers.get(key):
+                await self._flush(key)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                self._tasks.pop(key, None)
+    
+    async def _flush(self, key: tuple):
+        texts = self._buffers.pop(key, [])
+        for chunk in self._pack(texts):
+            await self._send(key, chunk)
+    
+    def _pack(self, texts: List[str]) -> List[str]:
+        """Склеивает тексты в сообщения не длиннее лимита Telegram"""
+        chunks = []
+        current = ""
+        for text in texts:
+            while len(text) > self.MAX_MESSAGE_LENGTH:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(text[:self.MAX_MESSAGE_LENGTH])
+                text = text[self.MAX_MESSAGE_LENGTH:]
+            candidate = current + self.SEPARATOR + text if current else text
+            if len(candidate) > self.MAX_MESSAGE_LENGTH:
+                chunks.append(current)
+                candidate = text
+            current = candidate
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    async def _send(self, key: tuple, text: str, attempts: int = 3):
+        chat_id, thread_id = key
+        loop = asyncio.get_running_loop()
+        send_kwargs = {
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': 'HTML'
+        }
+        if thread_id:
+            send_kwargs['message_thread_id'] = thread_id
+        
+        for _ in range(attempts):
+            delay = self._chat_next_at.get(chat_id, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.bot.send_message(**send_kwargs)
+                self._chat_next_at[chat_id] = loop.time() + self._chat_interval(chat_id)
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"⏳ Telegram просит подождать {retry_after} сек (чат {chat_id})")
+                self._chat_next_at[chat_id] = loop.time() + float(retry_after)
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление в {chat_id}: {e}")
+                return
+        logger.error(f"Уведомление в {chat_id} не отправлено: превышен лимит попыток")
+
+
+def _process_start_ticks(pid: int) -> Optional[int]:
+    """Время старта процесса (такты с загрузки системы) из /proc - защита от
+    повторного использования pid. None - процесса нет или /proc недоступен."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+        # Поле 22; имя процесса (поле 2) может содержать пробелы - считаем после ')'
+        return int(stat[stat.rindex(b')') + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _process_cpu_rss(pid: int) -> Optional[tuple]:
+    """(процессорное время в сек, RSS в КБ) процесса из /proc. None - процесса нет."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+        fields = stat[stat.rindex(b')') + 2:].split()
+        # utime и stime - поля 14 и 15, rss (в страницах) - поле 24
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        rss_kb = int(fields[21]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        return cpu_seconds, rss_kb
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class AdoptedProcess:
+    """Handle воркера, подхваченного после перезапуска бота.
+    
+    Это уже не дочерний процесс, поэтому вместо multiprocessing.Process - pid
+    и (на Linux) pidfd в роли sentinel: он становится читаемым при выходе процесса.
+    """
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.exitcode = None
+        self.sentinel = None
+        try:
+            self.sentinel = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pass  # Нет pidfd - живость проверяем сигналом 0, выход видим по EOF канала
+    
+    def is_alive(self) -> bool:
+        if self.exitcode is not None:
+            return False
+        if self.sentinel is not None:
+            readable, _, _ = select.select([self.sentinel], [], [], 0)
+            alive = not readable
+        else:
+            try:
+                os.kill(self.pid, 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+        if not alive:
+            self.exitcode = -1  # Код выхода чужого процесса недоступен
+        return alive
+    
+    def join(self, timeout: Optional[float] = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.1)
+    
+    def _signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+    
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+    
+    def kill(self):
+        self._signal(signal.SIGKILL)
+    
+    def close(self):
+        if self.sentinel is not None:
+            os.close(self.sentinel)
+            self.sentinel = None
+
+
+async def _wait_process_exit(process, timeout: float) -> bool:
+    """Ждёт завершения дочернего процесса без блокировки event loop.
+    На Linux ждём sentinel процесса через add_reader, иначе - опрашиваем.
+    """
+    if not process.is_alive():
+        return True
+    
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    try:
+        loop.add_reader(process.sentinel, lambda: exited.done() or exited.set_result(True))
+    except (NotImplementedError, ValueError, TypeError, OSError):
+        deadline = loop.time() + timeout
+        while process.is_alive() and loop.time() < deadline:
+            await asyncio.sleep(0.2)
+        return not process.is_alive()
+    
+    try:
+        await asyncio.wait_for(exited, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(process.sentinel)
+    
+    process.join(timeout=0)  # Забираем код выхода (без зомби)
+    return not process.is_alive()
+
+
+class WorkerEventChannel:
+    """Единый канал событий воркер → бот.
+    
+    Один поток ждёт сразу на всех pipe'ах хостов воркеров и sentinel'ах их процессов
+    (multiprocessing.connection.wait) и передаёт сообщения в asyncio.Queue
+    event loop'а бота. Никакого опроса очередей по таймеру.
+    """
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self._loop = None
+        self._lock = threading.Lock()
+        self._conns = {}      # Connection -> SteamHost
+        self._sentinels = {}  # sentinel процесса -> SteamHost
+        self._wakeup_recv, self._wakeup_send = multiprocessing.Pipe(duplex=False)
+        self._thread = None
+    
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.queue = asyncio.Queue()
+        self._thread = threading.Thread(target=self._run, name='worker-events', daemon=True)
+        self._thread.start()
+    
+    def register(self, host: 'SteamHost'):
+        with self._lock:
+            self._conns[host.event_conn] = host
+            if host.process.sentinel is not None:
+                self._sentinels[host.process.sentinel] = host
+        self._wakeup_send.send_bytes(b'+')
+    
+    def _emit(self, host: 'SteamHost', message: dict):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.queue.put_nowait, (host, message))
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                waitables = [self._wakeup_recv, *self._conns, *self._sentinels]
+            try:
+                ready = multiprocessing.connection.wait(waitables)
+            except Exception as e:
+                logger.error(f"❌ Ошибка канала событий воркеров: {e}", exc_info=True)
+                time.sleep(1)
+                continue
+            
+            # Сначала дочитываем сообщения, потом обрабатываем выход процессов:
+            # последнее сообщение воркера должно прийти раньше worker_exited
+            for obj in ready:
+                if obj is self._wakeup_recv:
+                    while self._wakeup_recv.poll():
+                        self._wakeup_recv.recv_bytes()
+                elif obj in self._conns:
+                    self._drain(obj)
+            
+            for obj in ready:
+                with self._lock:
+                    host = self._sentinels.pop(obj, None)
+                if host is not None:
+                    self._emit(host, {'event': 'worker_exited'})
+    
+    def _drain(self, conn):
+        host = self._conns.get(conn)
+        try:
+            while conn.poll():
+                self._emit(host, conn.recv())
+        except (EOFError, OSError):
+            with self._lock:
+                self._conns.pop(conn, None)
+            conn.close()
+            # У подхваченного воркера без pidfd выход виден только по EOF канала
+            if host is not None and host.process.sentinel is None:
+                self._emit(host, {'event': 'worker_exited'})
+
+
+class LoginAdmission:
+    """Контроль допуска входов в Steam для всплесков (раунд расписания, массовое создание).
+    
+    Token bucket: не больше rate входов в секунду, запас burst. Ответ Steam о
+    троттлинге вдвое снижает rate (не чаще раза в cooldown сек), каждый успешный
+    вход понемногу возвращает его к максимуму (AIMD). Очередь упорядочена по
+    дедлайну: первым входит аккаунт матча, который стартует раньше всех.
+    """
+    def __init__(self, rate_per_min: float, burst: int = 5, min_rate_per_min: float = 2, cooldown: float = 10):
+        self.max_rate = rate_per_min / 60
+        self.min_rate = min(min_rate_per_min, rate_per_min) / 60
+        self.rate = self.max_rate
+        self.burst = max(1, burst)
+        self.cooldown = cooldown
+        self.tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._decreased_at = 0.0
+        self._queue: List[list] = []  # heap [дедлайн, порядковый номер, grant или None (отменён)]
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.granted = 0
+        self.throttled = 0
+    
+    def request(self, grant: Callable[[], None], deadline: float) -> Optional[list]:
+        """Ставит вход в очередь; grant() вызывается, когда вход разрешён. Возвращает запись
+        для cancel() или None, если вход разрешён сразу (grant() уже вызван)."""
+        self._seq += 1
+        entry = [deadline, self._seq, grant]
+        heapq.heappush(self._queue, entry)
+        self._pump()
+        return entry if entry[2] is not None else None
+    
+    @staticmethod
+    def cancel(entry: list):
+        entry[2] = None
+    
+    @property
+    def queued(self) -> int:
+        return sum(1 for entry in self._queue if entry[2] is not None)
+    
+    def on_throttled(self):
+        self.throttled += 1
+        now = time.monotonic()
+        if now - self._decreased_at >= self.cooldown:
+            self._decreased_at = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            logger.warning(f"🚦 Steam троттлит входы: лимит снижен до {self.rate * 60:.1f}/мин")
+    
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+    
+    def _pump(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        while self._queue and (self._queue[0][2] is None or self.tokens >= 1):
+            entry = heapq.heappop(self._queue)
+            grant, entry[2] = entry[2], None  # Выданная запись больше не в очереди
+            if grant is None:
+                continue
+            self.tokens -= 1
+            self.granted += 1
+            try:
+                grant()
+            except Exception as e:
+                logger.error(f"Ошибка запуска входа: {e}")
+        
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._queue:
+            delay = (1 - self.tokens) / self.rate
+            try:
+                self._timer = asyncio.get_running_loop().call_later(max(0.01, delay), self._pump)
+            except RuntimeError:
+                pass  # Вне event loop очередь продвинет следующий request()
+    
+    def describe(self) -> str:
+        return (f"{self.rate * 60:.1f}/мин (макс {self.max_rate * 60:.0f}), в очереди {self.queued}, "
+                f"допущено {self.granted}, троттлинг {self.throttled}")
+
+
+class CMServerCache:
+    """Общий для воркеров кэш CM-серверов Steam с замерами подключения.
+    
+    Список серверов воркер получает бутстрапом библиотеки и отдаёт боту; бот
+    хранит его ttl секунд (на диске через store) и с командой start передаёт
+    воркерам самые быстрые исправные серверы - вход обходится без справочника
+    Steam и без подключения к случайному CM. Задержка сервера - скользящее
+    среднее времени подключения; не ответивший сервер уходит в конец списка
+    на FAIL_COOLDOWN секунд.
+    """
+    FAIL_COOLDOWN = 600
+    
+    def __init__(self, ttl: float = 86400, size: int = 20):
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.fetched_at = 0.0  # Когда список получен от Steam (time.time())
+        self.servers: Dict[str, dict] = {}  # 'ip:port' -> {'latency_ms', 'connects', 'failed_at'}
+        self.connect_ms: Dict[str, List[float]] = {'cache': [], 'bootstrap': []}  # Последние подключения
+    
+    def load(self, data: Optional[dict]):
+        if not data:
+            return
+        self.fetched_at = data.get('fetched_at', 0.0)
+        self.servers = data.get('servers', {})
+    
+    def to_dict(self) -> dict:
+        return {'fetched_at': self.fetched_at, 'servers': self.servers}
+    
+    def is_fresh(self) -> bool:
+        return bool(self.servers) and time.time() - self.fetched_at < self.ttl
+    
+    def preferred(self) -> List[list]:
+        """[[ip, port], ...] для воркера: измеренные по задержке, затем неизмеренные,
+        недавно не ответившие - последними. Пустой список - кэш устарел, нужен бутстрап."""
+        if not self.is_fresh():
+            return []
+        now = time.time()
+        
+        def rank(item):
+            _, entry = item
+            failing = now - entry.get('failed_at', 0) < self.FAIL_COOLDOWN
+            latency = entry.get('latency_ms')
+            return (failing, latency is None, latency or 0)
+        
+        ranked = sorted(self.servers.items(), key=rank)[:self.size]
+        result = []
+        for endpoint, _ in ranked:
+            ip, _, port = endpoint.rpartition(':')
+            result.append([ip, int(port)])
+        return result
+    
+    def merge(self, endpoints: List[str]):
+        """Свежий список от Steam: замеры известных серверов сохраняем, исчезнувшие убираем"""
+        self.servers = {endpoint: self.servers.get(endpoint, {}) for endpoint in endpoints}
+        self.fetched_at = time.time()
+    
+    def record(self, endpoint: Optional[str], connect_ms: Optional[float], source: str, failed: List[str]):
+        now = time.time()
+        for bad in failed:
+            self.servers.setdefault(bad, {})['failed_at'] = now
+        if endpoint is None or connect_ms is None:
+            return
+        entry = self.servers.setdefault(endpoint, {})
+        previous = entry.get('latency_ms')
+        entry['latency_ms'] = connect_ms if previous is None else previous * 0.7 + connect_ms * 0.3
+        entry['connects'] = entry.get('connects', 0) + 1
+        entry.pop('failed_at', None)
+        samples = self.connect_ms.setdefault(source, [])
+        samples.append(connect_ms)
+        del samples[:-50]
+    
+    def describe(self) -> str:
+        if not self.servers:
+            return "список ещё не получен"
+        measured = sum(1 for entry in self.servers.values() if entry.get('latency_ms') is not None)
+        line = (f"{len(self.servers)} серверов ({measured} измерено), "
+                f"список {(time.time() - self.fetched_at) / 60:.0f} мин назад")
+        for source, title in (('cache', 'из кэша'), ('bootstrap', 'без кэша')):
+            samples = self.connect_ms.get(source)
+            if samples:
+                line += f"; подключение {title}: {sum(samples) / len(samples):.0f} мс ({len(samples)})"
+        return line
+
+
+class CredentialCache:
+    """Кэш входа Steam по аккаунтам: login key и sentry, зашифрованные Fernet.
+    
+    Повторный вход по login key не тратит парольную аутентификацию, которую Steam
+    троттлит, а sentry подтверждает Steam Guard этой машины. Воркеры присылают
+    новые ключ и sentry событием credentials, бот хранит их одним токеном через
+    store и отдаёт воркеру в команде start. Без ключа шифрования данные не читаются.
+    """
+    def __init__(self, key: bytes):
+        self._fernet = Fernet(key)
+        self._entries: Dict[str, dict] = {}  # username -> {'login_key', 'sentry' (base64), 'updated_at'}
+        self.login_ms: Dict[str, List[float]] = {'login_key': [], 'password': []}  # Последние входы
+    
+    @staticmethod
+    def key_from_file(path: str) -> bytes:
+        """Ключ шифрования из файла; при первом запуске создаётся (доступ только владельцу)"""
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read().strip()
+        key = Fernet.generate_key()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        logger.info(f"🔑 Создан ключ шифрования кэша входа Steam: {path}")
+        return key
+    
+    def load(self, token: Optional[str]):
+        if not token:
+            return
+        try:
+            self._entries = json.loads(self._fernet.decrypt(token.encode('ascii')))
+        except InvalidToken:
+            logger.error("❌ Кэш входа Steam зашифрован другим ключом - начинаем с пустого")
+            self._entries = {}
+    
+    def to_token(self) -> str:
+        return self._fernet.encrypt(json.dumps(self._entries).encode('utf-8')).decode('ascii')
+    
+    def get(self, username: str) -> Optional[dict]:
+        entry = self._entries.get(username)
+        if not entry:
+            return None
+        return {'login_key': entry.get('login_key'), 'sentry': entry.get('sentry')}
+    
+    def update(self, username: str, **fields):
+        """Поля со значением None удаляются (отклонённый ключ)"""
+        entry = self._entries.setdefault(username, {})
+        for name, value in fields.items():
+            if value is None:
+                entry.pop(name, None)
+            else:
+                entry[name] = value
+        entry['updated_at'] = time.time()
+        if not entry.keys() - {'updated_at'}:
+            del self._entries[username]
+    
+    def forget(self, username: str):
+        self._entries.pop(username, None)
+    
+    def record_login(self, method: str, login_ms: float):
+        samples = self.login_ms.setdefault(method, [])
+        samples.append(login_ms)
+        del samples[:-50]
+    
+    def describe(self) -> str:
+        with_key = sum(1 for entry in self._entries.values() if entry.get('login_key'))
+        line = f"ключ есть у {with_key} из {len(self._entries)} аккаунтов"
+        for method, title in (('login_key', 'по ключу'), ('password', 'по паролю')):
+            samples = self.login_ms.get(method)
+            if samples:
+                line += f"; вход {title}: {sum(samples) / len(samples):.0f} мс ({len(samples)})"
+        return line
+
+
+class SteamHost:
+    """Процесс-хост воркеров: один gevent hub и несколько сессий аккаунтов на нём"""
+    def __init__(self, name: str, process, command_conn, event_conn, shutdown_event,
+                 control_address: Optional[str] = None, index: Optional[int] = None):
+        self.name = name
+        self.index = index  # Номер шарда (WORKER_HOSTS) или None у динамического хоста
+        self.process = process
+        self.command_conn = command_conn  # Канал команд start/create/destroy/shutdown
+        self.event_conn = event_conn      # Канал событий воркер → бот (читает WorkerEventChannel)
+        self.shutdown_event = shutdown_event  # None у подхваченного хоста
+        self.control_address = control_address  # unix-сокет для переподключения после рестарта
+        self.start_ticks: Optional[int] = None  # Время старта процесса (для журнала)
+        self.sessions: Dict[str, 'SteamSession'] = {}  # username -> сессия на этом хосте
+        self._cpu_sample: Optional[tuple] = None  # (время, процессорное время) прошлого замера
+    
+    @property
+    def linger(self) -> bool:
+        """Шард живёт и без сессий"""
+        return self.index is not None
+    
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+    
+    def load(self) -> dict:
+        """Нагрузка хоста: сессии, лобби, загрузка CPU с прошлого замера (%), RSS (МБ)"""
+        load = {
+            'sessions': len(self.sessions),
+            'lobbies': sum(1 for session in self.sessions.values() if session.lobbies_created and not session.closed),
+            'cpu': None,
+            'rss_mb': None,
+        }
+        usage = _process_cpu_rss(self.process.pid)
+        if usage is None:
+            return load
+        now = time.monotonic()
+        cpu_seconds, rss_kb = usage
+        if self._cpu_sample is not None and now > self._cpu_sample[0]:
+            load['cpu'] = (cpu_seconds - self._cpu_sample[1]) / (now - self._cpu_sample[0]) * 100
+        self._cpu_sample = (now, cpu_seconds)
+        load['rss_mb'] = rss_kb / 1024
+        return load
+    
+    def send(self, message: dict):
+        self.command_conn.send(message)
+
+
+class SteamSession:
+    """Тёплая сессия аккаунта: greenlet с залогиненным SteamClient + Dota2Client на хосте"""
+    def __init__(self, username: str, host: SteamHost):
+        self.username = username
+        self.host = host
+        self.started_at = time.time()
+        self.ready_at = None  # Когда сессия сообщила о готовности GC
+        self.pending: Optional[asyncio.Future] = None  # Ожидание результата создания лобби
+        self.pending_lobby = None
+        self.last_snapshot: Optional[dict] = None  # Последний снимок лобби (игроки, состояние)
+        self.lobbies_created = 0  # Сколько команд create получила сессия
+        # Фазы текущего лобби сессии (из событий lobby_phase)
+        self.phase_lobby: Optional[str] = None
+        self.phase: Optional[str] = None
+        self.phase_durations: Dict[str, float] = {}
+        self.deadline: Optional[float] = None  # Когда сессия нужна (приоритет в очереди входа)
+        self.admission = None  # Запись в очереди LoginAdmission, пока вход не разрешён
+        self.admitted = False  # Команда start отправлена хосту
+        self.admitted_at: Optional[float] = None
+        self.closed = False  # Хост сообщил о завершении сессии (или сам завершился)
+        self._closed_waiter: Optional[asyncio.Future] = None
+    
+    @property
+    def process(self):
+        return self.host.process
+    
+    @property
+    def shutdown_event(self):
+        return self.host.shutdown_event
+    
+    def is_alive(self) -> bool:
+        return not self.closed and self.host.is_alive()
+    
+    def send(self, cmd: str, **payload):
+        self.host.send({'cmd': cmd, 'account': self.username, **payload})
+        if cmd == 'create':
+            self.lobbies_created += 1
+    
+    def mark_closed(self):
+        self.closed = True
+        if self._closed_waiter is not None and not self._closed_waiter.done():
+            self._closed_waiter.set_result(True)
+    
+    async def wait_closed(self, timeout: float) -> bool:
+        if self.closed:
+            return True
+        if self._closed_waiter is None:
+            self._closed_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._closed_waiter), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.closed
+
+
+class SteamSessionPool:
+    """Пул долгоживущих Steam/GC сессий, размещённых по процессам-хостам.
+    
+    Повторное лобби на том же аккаунте не платит за вход в Steam и запуск Dota 2 -
+    только за round-trip до координатора. accounts_per_host задаёт плотность:
+    1 - процесс на аккаунт (полная изоляция), больше - несколько аккаунтов
+    на одном gevent hub'е и заметно меньше памяти на лобби.
+    shards > 0 - фиксированное число постоянных хостов (по одному на ядро),
+    новая сессия идёт на наименее загруженный; accounts_per_host тогда не используется.
+    """
+    def __init__(self, events: 'WorkerEventChannel', persistent: bool = True, idle_ttl: int = 0,
+                 control_dir: Optional[str] = None, orphan_ttl: int = 600, accounts_per_host: int = 1,
+                 shards: int = 0):
+        self.events = events
+        self.persistent = persistent
+        self.idle_ttl = idle_ttl
+        self.control_dir = control_dir  # Каталог unix-сокетов воркеров (None - без переподключения)
+        self.orphan_ttl = orphan_ttl
+        self.accounts_per_host = max(1, accounts_per_host)
+        self.shards = max(0, shards)
+        self.on_change: Optional[Callable[[], None]] = None  # Состав сессий изменился (журнал)
+        self.sessions: Dict[str, SteamSession] = {}  # username -> SteamSession
+        self.hosts: List[SteamHost] = []
+        self._host_seq = 0
+        self.admission: Optional[LoginAdmission] = None  # None - входы без ограничений
+        self.on_admitted: Optional[Callable[[SteamSession], None]] = None  # Метрики ожидания допуска
+        self.cm_cache: Optional[CMServerCache] = None  # CM-серверы для входа (None - бутстрап в каждом воркере)
+        self.credential_cache: Optional[CredentialCache] = None  # Вход по login key (None - всегда по паролю)
+        if control_dir:
+            os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    
+    def get(self, username: str) -> Optional[SteamSession]:
+        session = self.sessions.get(username)
+        if session and session.is_alive():
+            return session
+        return None
+    
+    def is_warm(self, username: str) -> bool:
+        session = self.get(username)
+        return bool(session and session.ready_at)
+    
+    def get_or_start(self, account: 'SteamAccount', deadline: Optional[float] = None) -> SteamSession:
+        """Возвращает живую сессию аккаунта или поднимает новую на хосте со свободным местом.
+        deadline - когда сессия нужна (time.time()); по нему упорядочена очередь входов.
+        """
+        deadline = deadline if deadline is not None else time.time()
+        session = self.sessions.get(account.username)
+        # Одноразовую сессию можно взять, пока она ещё не создавала лобби (прогрев)
+        if session and session.is_alive() and (self.persistent or not session.lobbies_created):
+            if session.admission is not None and deadline < session.deadline:
+                # Сессия стала нужна раньше - переставляем в очереди входов
+                LoginAdmission.cancel(session.admission)
+                session.deadline = deadline
+                session.admission = self.admission.request(
+                    lambda: self._admit(session, 'start', account.password), deadline)
+            return session
+        if session:
+            # Одноразовая сессия доживает своё лобби сама
+            self._dispose(session)
+        
+        host = self._place(account.username)
+        session = SteamSession(account.username, host)
+        session.deadline = deadline
+        host.sessions[account.username] = session
+        self.sessions[account.username] = session
+        if self.admission is None:
+            self._admit(session, 'start', account.password)
+        else:
+            session.admission = self.admission.request(
+                lambda: self._admit(session, 'start', account.password), deadline)
+        logger.info(f"🔥 Запущена сессия Steam для {account.username} "
+                    f"(pid {host.process.pid}, аккаунтов на хосте: {len(host.sessions)}"
+                    + (f", вход в очереди: {self.admission.queued}" if session.admission else "") + ")")
+        self._changed()
+        return session
+    
+    def _admit(self, session: SteamSession, cmd: str, password: Optional[str] = None):
+        """Вход разрешён: start - поднять сессию на хосте, login - повторить вход после троттлинга"""
+        session.admission = None
+        if session.closed or self.sessions.get(session.username) is not session:
+            return
+        try:
+            if cmd == 'start':
+                session.admitted = True
+                session.admitted_at = time.time()
+                session.host.send({
+                    'cmd': 'start',
+                    'account': session.username,
+                    'password': password,
+                    'cm_servers': self.cm_cache.preferred() if self.cm_cache is not None else None,
+                    'credentials': (self.credential_cache.get(session.username)
+                                    if self.credential_cache is not None else None),
+                })
+                if self.on_admitted is not None:
+                    self.on_admitted(session)
+            else:
+                session.send('login')
+        except (OSError, EOFError) as e:
+            logger.warning(f"Не удалось отправить {cmd} для {session.username}: {e}")
+    
+    def login_throttled(self, session: SteamSession):
+        """Steam отказал во входе из-за частоты: снижаем темп и ставим повтор в очередь"""
+        if self.admission is None:
+            # Без контроля допуска повторяем сразу после короткой паузы
+            asyncio.get_running_loop().call_later(5, self._admit, session, 'login')
+            return
+        self.admission.on_throttled()
+        session.admission = self.admission.request(lambda: self._admit(session, 'login'), session.deadline or time.time())
+    
+    def login_succeeded(self):
+        if self.admission is not None:
+            self.admission.on_success()
+    
+    def _place(self, username: str) -> SteamHost:
+        """Самый заполненный живой хост со свободным местом, иначе новый.
+        Опустевший хост завершается сам, поэтому на него не садимся.
+        """
+        if self.shards:
+            return self._place_shard(username)
+        candidates = [
+            host for host in self.hosts
+            if host.sessions and len(host.sessions) < self.accounts_per_host
+            and username not in host.sessions and host.is_alive()
+        ]
+        if candidates:
+            return max(candidates, key=lambda host: len(host.sessions))
+        return self._start_host(username)
+    
+    def _place_shard(self, username: str) -> SteamHost:
+        """Наименее загруженный шард (по числу сессий); пустой слот - запускаем шард.
+        При равной нагрузке - шард с меньшим номером, так сессии расходятся по ядрам.
+        """
+        live = {host.index: host for host in self.hosts if host.index is not None and host.is_alive()}
         
-        # ВАЖНО: Явно удаляем лобби ПЕРЕД отключением (но только если игра не запущена)
-        if not game_started:
-            local_logger.info(f"[{username}] Удаление лобби...")
-            try:
-                dota.destroy_lobby()
-                gevent.sleep(3)  # Даём время серверам Valve обработать destroy
-                local_logger.info(f"[{username}] ✅ Лобби удалено")
-            except Exception as destroy_error:
-                local_logger.warning(f"[{username}] Ошибка при удалении лобби: {destroy_error}")
-            
-            # Отключаемся от Steam
-            try:
-                dota.leave_practice_lobby()
-                gevent.sleep(1)
-                steam.disconnect()
-                local_logger.info(f"[{username}] Отключились от Steam")
-            except Exception as disconnect_error:
-                local_logger.warning(f"[{username}] Ошибка при отключении: {disconnect_error}")
+        def slot_load(index: int) -> float:
+            host = live.get(index)
+            if host is None:
+                return 0
+            # Старая одноразовая сессия аккаунта ещё доживает на этом шарде
+            return float('inf') if username in host.sessions else len(host.sessions)
+        
+        index = min(range(self.shards), key=lambda index: (slot_load(index), index))
+        return live.get(index) or self._start_host(username, index)
+    
+    def _start_host(self, username: str, index: Optional[int] = None) -> SteamHost:
+        self._host_seq += 1
+        # Процесс на аккаунт называем по аккаунту (как раньше), шард - по номеру,
+        # общий динамический хост - по порядковому номеру запуска
+        if index is not None:
+            name = f"shard-{index}"
+        elif self.accounts_per_host == 1:
+            name = username
         else:
-            # Игра запущена - остаемся подключенными до получения команды shutdown или закрытия лобби
-            local_logger.info(f"[{username}] 🎮 Игра запущена! Бот остается в Steam для поддержки лобби...")
-            local_logger.info(f"[{username}] ⏳ Ожидание завершения игры или команды закрытия...")
-            
-            # Держим процесс живым пока идет игра или не получен сигнал shutdown
-            while not shutdown_event.is_set():
-                gevent.sleep(5)  # Проверяем каждые 5 секунд
-                
-                # Проверяем, существует ли ещё лобби (игра может закончиться)
+            name = f"host-{os.getpid()}-{self._host_seq}"
+        cpu = index % (os.cpu_count() or 1) if index is not None else None
+        command_recv, command_send = multiprocessing.Pipe(duplex=False)
+        event_recv, event_send = multiprocessing.Pipe(duplex=False)
+        shutdown_event = multiprocessing.Event()
+        control_address = self.control_address(name)
+        
+        process = Process(
+            target=steam_worker_process,
+            args=(
+                name,
+                command_recv,
+                event_send,
+                shutdown_event,
+                self.persistent,
+                self.idle_ttl,
+                control_address,
+                self.orphan_ttl,
+                index is not None,
+                cpu,
+            )
+        )
+        process.start()
+        # Эти концы нужны только воркеру (иначе не увидим EOF при его выходе)
+        command_recv.close()
+        event_send.close()
+        
+        host = SteamHost(name, process, command_send, event_recv, shutdown_event, control_address, index)
+        self.hosts.append(host)
+        self.events.register(host)
+        if index is not None:
+            logger.info(f"🧩 Запущен шард {index} (pid {process.pid}, ядро {cpu})")
+        return host
+    
+    def control_address(self, name: str) -> Optional[str]:
+        if not self.control_dir:
+            return None
+        safe_name = ''.join(ch if ch.isalnum() or ch in '-_.' else '_' for ch in name)
+        return os.path.join(self.control_dir, f"{safe_name}.sock")
+    
+    @staticmethod
+    def _handshake(address: str, timeout: float) -> tuple:
+        """Подключение к unix-сокету хоста и его приветствие (блокирующее - для executor)"""
+        conn = multiprocessing.connection.Client(address, family='AF_UNIX')
+        if not conn.poll(timeout):
+            conn.close()
+            raise TimeoutError(f"воркер {address} не ответил за {timeout:.0f} сек")
+        hello = conn.recv()
+        if hello.get('event') != 'adopted' or not isinstance(hello.get('accounts'), dict):
+            conn.close()
+            raise ValueError(f"неожиданный ответ воркера: {hello}")
+        return conn, hello
+    
+    async def adopt(self, address: str, pid: int, timeout: float = 5) -> tuple:
+        """Подключается к хосту воркеров, пережившему перезапуск бота.
+        Рукопожатие идёт в executor, так что хосты можно опрашивать параллельно.
+        Возвращает (хост, приветствие хоста).
+        """
+        conn, hello = await asyncio.get_running_loop().run_in_executor(None, self._handshake, address, timeout)
+        
+        process = AdoptedProcess(hello.get('pid') or pid)
+        name = os.path.splitext(os.path.basename(address))[0]
+        index = int(name[len('shard-'):]) if name.startswith('shard-') and name[len('shard-'):].isdigit() else None
+        host = SteamHost(name, process, conn, conn, None, address, index)
+        ready = hello.get('ready')  # None - хост старой версии, сессии без признака готовности
+        for username, lobby in hello['accounts'].items():
+            session = SteamSession(username, host)
+            if ready is None or username in ready:
+                session.ready_at = time.time()
+            # Сессия ещё входит в Steam - ready_at выставит её session_ready
+            session.admitted = True
+            if lobby:
+                session.lobbies_created = 1
+            host.sessions[username] = session
+            self.sessions[username] = session
+        self.hosts.append(host)
+        self.events.register(host)
+        logger.info(f"🔗 Подхвачен хост {name} (pid {process.pid}, аккаунты: {', '.join(host.sessions) or 'нет'})")
+        self._changed()
+        return host, hello
+    
+    def detach_all(self):
+        """Отпускает все воркеры без остановки (перед перезапуском бота).
+        Воркеры видят EOF и ждут переподключения, лобби продолжают работать.
+        """
+        for host in self.hosts:
+            for conn in {host.command_conn, host.event_conn}:
                 try:
-                    if dota.lobby is None:
-                        local_logger.info(f"[{username}] 🏁 Лобби закрылось (игра завершена)!")
-                        result_queue.put({'success': False, 'lobby_closed': True})
-                        gevent.sleep(15)  # Даем время главному процессу
-                        break
-                        
-                except Exception as check_error:
-                    local_logger.warning(f"[{username}] ⚠️ Ошибка проверки лобби: {check_error}")
-                    local_logger.info(f"[{username}] 🏁 Ошибка проверки - вероятно лобби закрылось!")
-                    result_queue.put({'success': False, 'lobby_closed': True})
-                    gevent.sleep(15)
-                    break
-            
-            # Получена команда закрытия или игра завершена
-            local_logger.info(f"[{username}] 🛑 Завершение работы...")
-            try:
-                dota.destroy_lobby()
-                gevent.sleep(3)
-                local_logger.info(f"[{username}] ✅ Лобби удалено после игры")
-            except Exception as destroy_error:
-                local_logger.warning(f"[{username}] Ошибка при удалении лобби после игры: {destroy_error}")
-            
+                    conn.close()
+                except Exception:
+                    pass
+        self.hosts.clear()
+        self.sessions.clear()
+    
+    def _changed(self):
+        if self.on_change is not None:
             try:
-                dota.leave_practice_lobby()
-                gevent.sleep(1)
-                steam.disconnect()
-                local_logger.info(f"[{username}] Отключились от Steam после игры")
-            except Exception as disconnect_error:
-                local_logger.warning(f"[{username}] Ошибка при отключении после игры: {disconnect_error}")
-        
-    except KeyboardInterrupt:
-        local_logger.info(f"[{username}] 🛑 Получен сигнал прерывания (Ctrl+C)!")
-        # КРИТИЧНО: Удаляем лобби перед выходом!
+                self.on_change()
+            except Exception as e:
+                logger.error(f"Ошибка обновления журнала сессий: {e}")
+    
+    def destroy_lobby(self, username: str) -> bool:
+        """Удаляет текущее лобби сессии, не выходя из Steam"""
+        session = self.get(username)
+        if not session:
+            return False
         try:
-            local_logger.info(f"[{username}] 🗑️ Удаляем лобби перед выходом...")
-            dota.leave_practice_lobby()
-            gevent.sleep(1)
-            dota.destroy_lobby()
-            gevent.sleep(2)
-            local_logger.info(f"[{username}] ✅ Лобби удалено!")
-        except Exception as cleanup_error:
-            local_logger.error(f"[{username}] ❌ Ошибка при удалении лобби: {cleanup_error}")
-        
+            session.send('destroy')
+            return True
+        except (OSError, EOFError) as e:
+            logger.warning(f"Не удалось отправить destroy для {username}: {e}")
+            return False
+    
+    def signal_stop(self, username: str) -> Optional[SteamSession]:
+        """Просит сессию завершиться, не дожидаясь её выхода"""
+        session = self.sessions.pop(username, None)
+        if not session:
+            return None
+        self._changed()
+        if not session.admitted:
+            # Вход ещё в очереди - хост о сессии не знает, закрываем её здесь
+            if session.admission is not None:
+                LoginAdmission.cancel(session.admission)
+                session.admission = None
+            self.forget(session)
+            if not session.host.sessions and not session.host.linger:
+                try:
+                    session.host.send({'cmd': 'shutdown'})
+                except (OSError, EOFError):
+                    pass
+            return session
         try:
-            steam.disconnect()
-            local_logger.info(f"[{username}] 👋 Отключились от Steam")
-        except:
+            session.send('shutdown')
+        except (OSError, EOFError):
             pass
+        return session
+    
+    def stop_all(self, timeout: float = 20):
+        """Завершает все хосты: сначала сигналим всем, потом ждём"""
+        for username in list(self.sessions):
+            self.signal_stop(username)
+        hosts = list(self.hosts)
+        for host in hosts:
+            if host.shutdown_event is not None:
+                host.shutdown_event.set()
+            try:
+                host.send({'cmd': 'shutdown'})
+            except (OSError, EOFError):
+                pass
+        for host in hosts:
+            self._join(host, timeout)
+    
+    def _join(self, host: SteamHost, timeout: float):
+        process = host.process
+        try:
+            if process.is_alive():
+                logger.info(f"Ожидание завершения процесса {host.name} (макс {timeout:.0f} сек)...")
+                process.join(timeout=timeout)
             
-    except Exception as e:
-        local_logger.error(f"[{username}] Ошибка: {e}", exc_info=True)
-        result_queue.put({'success': False, 'error': str(e)})
-
-
-class SteamAccount:
-    """Информация об аккаунте"""
-    def __init__(self, username: str, password: str):
-        self.username = username
-        self.password = password
-        self.is_busy = False
-        
-    def to_dict(self):
-        return {
-            'username': self.username,
-            'password': self.password
-        }
-
-
-class LobbyInfo:
-    """Информация о лобби"""
-    def __init__(self, lobby_name: str, password: str, account: str):
-        self.lobby_name = lobby_name  # "wb cup 1", "wb cup 2"
-        self.password = password
-        self.account = account
-        self.created_at = datetime.now()
-        self.players_count = 0
-        self.status = "active"
+            if process.is_alive():
+                logger.warning(f"Процесс {host.name} не завершился, принудительное завершение...")
+                process.terminate()
+                process.join(timeout=2)
+            
+            if process.is_alive():
+                logger.warning(f"Убиваем процесс {host.name}...")
+                process.kill()
+                process.join(timeout=2)
+        except Exception as e:
+            logger.error(f"Ошибка остановки процесса {host.name}: {e}")
+        finally:
+            self.forget_host(host)
+    
+    async def stop_many_async(self, usernames: List[str], timeout: float = 20):
+        """Асинхронно завершает несколько сессий, не блокируя event loop.
+        Сигнал shutdown получают все сразу, завершение ожидается параллельно.
+        Процесс, на котором была только эта сессия, при зависании эскалируется
+        terminate → kill; общий хост с другими аккаунтами не трогаем.
+        """
+        sessions = [self.signal_stop(username) for username in usernames]
+        await asyncio.gather(*(self._join_async(session, timeout) for session in sessions if session))
+    
+    async def _join_async(self, session: SteamSession, timeout: float):
+        host = session.host
+        process = host.process
+        try:
+            shared = any(other is not session for other in host.sessions.values())
+            if shared or host.linger:
+                if await session.wait_closed(timeout):
+                    logger.info(f"✅ Сессия {session.username} остановлена (хост {host.name} продолжает работу)")
+                    return
+                if shared:
+                    logger.warning(f"Сессия {session.username} не завершилась за {timeout:.0f} сек "
+                                   f"(хост {host.name} общий, процесс не трогаем)")
+                    return
+                # Шард завис на единственной сессии - перезапустим его при следующем размещении
+                logger.warning(f"Шард {host.name} завис на сессии {session.username}, принудительное завершение...")
+                timeout = 0
+            if not await _wait_process_exit(process, timeout):
+                logger.warning(f"Процесс {host.name} не завершился за {timeout:.0f} сек, принудительное завершение...")
+                process.terminate()
+                if not await _wait_process_exit(process, 2):
+                    logger.warning(f"Убиваем процесс {host.name}...")
+                    process.kill()
+                    await _wait_process_exit(process, 2)
+            logger.info(f"✅ Процесс {host.name} остановлен")
+        except Exception as e:
+            logger.error(f"Ошибка остановки сессии {session.username}: {e}")
+        finally:
+            self._dispose(session)
+    
+    def host_loads(self) -> List[tuple]:
+        """[(хост, нагрузка)] живых хостов: шарды по номеру, затем остальные"""
+        hosts = sorted(self.hosts, key=lambda host: (host.index is None, host.index or 0, host.name))
+        return [(host, host.load()) for host in hosts if host.is_alive()]
+    
+    def forget(self, session: SteamSession):
+        """Сессия завершилась сама (хост сообщил account_stopped или процесс вышел)"""
+        session.mark_closed()
+        if session.host.sessions.get(session.username) is session:
+            del session.host.sessions[session.username]
+        self._dispose(session)
+    
+    def forget_host(self, host: SteamHost):
+        """Процесс хоста завершился: все его сессии закрыты"""
+        for session in list(host.sessions.values()):
+            self.forget(session)
+        if host in self.hosts:
+            self.hosts.remove(host)
+        try:
+            host.command_conn.close()
+        except Exception:
+            pass
+    
+    def _dispose(self, session: SteamSession):
+        if self.sessions.get(session.username) is session:
+            del self.sessions[session.username]
+            self._changed()
 
 
 class RealDota2BotV2:
     """Улучшенный бот"""
     
     def __init__(self):
+        self._startup_marks: List[tuple] = []
+        self._mark_startup('imports')
+        
         self.telegram_token = os.getenv('TELEGRAM_BOT_TOKEN')
         self.admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
         self.notification_chat_id = os.getenv('NOTIFICATION_CHAT_ID')
@@ -608,11 +3081,52 @@ class RealDota2BotV2:
         self.telegram_app = None
         
         # Хранилище
-        self.steam_accounts: List[SteamAccount] = []
+        self.steam_accounts = AccountRegistry()
         self.active_lobbies: Dict[str, LobbyInfo] = {}  # "wb cup 1" -> LobbyInfo
         self.active_processes: Dict[str, Process] = {}  # username -> Process
         self.shutdown_events: Dict[str, multiprocessing.Event] = {}  # username -> Event
-        self.result_queues: Dict[str, Queue] = {}  # username -> Queue для мониторинга закрытия лобби
+        self._closing_lobbies: set = set()  # Лобби, удаление которых идёт в фоне
+        
+        # События от воркеров (результаты, закрытие лобби, выход процесса) приходят сюда
+        self.worker_events = WorkerEventChannel()
+        
+        # Переживание перезапуска: воркеры слушают unix-сокет в WORKER_CONTROL_DIR,
+        # живые сессии записываются в журнал, и новый экземпляр бота их подхватывает
+        # вместо pkill. При остановке бота (SUPERVISOR_DETACH_ON_EXIT) лобби не удаляются.
+        self.supervisor_adopt = os.getenv('SUPERVISOR_ADOPT', '1') != '0' and hasattr(socket, 'AF_UNIX')
+        self.detach_on_exit = self.supervisor_adopt and os.getenv('SUPERVISOR_DETACH_ON_EXIT', '1') != '0'
+        
+        # Пул тёплых Steam/GC сессий (STEAM_SESSION_POOL=0 - сессия на одно лобби, как раньше).
+        # ACCOUNTS_PER_HOST - сколько аккаунтов делят один процесс (gevent hub):
+        # 1 - процесс на аккаунт, больше - плотнее по памяти, но падение хоста задевает всех его соседей.
+        # WORKER_HOSTS - фиксированное число хостов-шардов (auto = по ядру на шард),
+        # сессии раскладываются по наименее загруженным; 0 - хосты по требованию
+        self.session_pool = SteamSessionPool(
+            self.worker_events,
+            persistent=os.getenv('STEAM_SESSION_POOL', '1') != '0',
+            idle_ttl=int(os.getenv('STEAM_SESSION_IDLE_TTL', '3600')),
+            control_dir=os.path.abspath(os.getenv('WORKER_CONTROL_DIR', 'run/workers')) if self.supervisor_adopt else None,
+            orphan_ttl=int(os.getenv('WORKER_ORPHAN_TTL', '600')),
+            accounts_per_host=int(os.getenv('ACCOUNTS_PER_HOST', '1')),
+            shards=self._worker_hosts_setting(),
+        )
+        self.session_pool.on_change = self._save_journal
+        
+        # Контроль допуска входов в Steam: STEAM_LOGIN_RATE входов в минуту (0 - без ограничений),
+        # запас STEAM_LOGIN_BURST; при троттлинге Steam темп адаптивно снижается до STEAM_LOGIN_MIN_RATE
+        login_rate = float(os.getenv('STEAM_LOGIN_RATE', '20'))
+        if login_rate > 0:
+            self.session_pool.admission = LoginAdmission(
+                login_rate,
+                burst=int(os.getenv('STEAM_LOGIN_BURST', '5')),
+                min_rate_per_min=float(os.getenv('STEAM_LOGIN_MIN_RATE', '2')),
+            )
+        self.session_pool.on_admitted = self._record_login_queue
+        self.worker_start_stats: List[tuple] = []  # (запуск→вход мс, RSS МБ) последних воркеров
+        
+        # Длительности этапов создания лобби (/metrics); выгрузка - в METRICS_EXPORT_PATH
+        self.lobby_metrics = LobbyMetrics(int(os.getenv('METRICS_WINDOW', '1000')))
+        self.metrics_export_path = os.getenv('METRICS_EXPORT_PATH', 'lobby_metrics.json')
         
         # Настройки
         self.lobby_base_name = "wb cup"  # Базовое название
@@ -622,104 +3136,296 @@ class RealDota2BotV2:
         # Счетчик лобби (ВАЖНО: НЕ сохраняем между перезапусками!)
         self.lobby_counter = 1
         
+        # Параллельное создание лобби: сколько воркеров запускаем одновременно
+        # и пауза между стартами (0 = все сразу)
+        self.lobby_create_concurrency = max(1, int(os.getenv('LOBBY_CREATE_CONCURRENCY', '8')))
+        self.lobby_create_stagger = float(os.getenv('LOBBY_CREATE_STAGGER', '0'))
+        
+        # Время жизни лобби без старта игры: жёсткий лимит (35 минут) или,
+        # если задан LOBBY_IDLE_TIMEOUT, таймер простоя, сбрасываемый любым изменением лобби
+        self.lobby_max_lifetime = int(os.getenv('LOBBY_MAX_LIFETIME', '2100'))
+        self.lobby_idle_timeout = int(os.getenv('LOBBY_IDLE_TIMEOUT', '0'))
+        
+        # Не больше стольких снимков игроков в секунду от одного лобби
+        self.lobby_snapshot_rate = max(0.1, float(os.getenv('LOBBY_SNAPSHOT_RATE', '2')))
+        
+        # Статусные сообщения: не чаще одного изменения в STATUS_UPDATE_INTERVAL сек на чат
+        self.status_updater = StatusMessageUpdater(float(os.getenv('STATUS_UPDATE_INTERVAL', '3')))
+        
+        # Уведомления в группу/админам, пришедшие в течение окна, склеиваются в дайджест
+        self.notifier = NotificationDispatcher(float(os.getenv('NOTIFICATION_BATCH_WINDOW', '3')))
+        
+        # Состояние пишется отложенно (STORE_WRITE_DELAY сек) и вне event loop:
+        # в JSON-файлы (по умолчанию) или в SQLite (STORAGE_BACKEND=sqlite)
+        store_delay = float(os.getenv('STORE_WRITE_DELAY', '0.5'))
+        if os.getenv('STORAGE_BACKEND', 'json').lower() == 'sqlite':
+            self.store = SqliteStore(os.getenv('SQLITE_PATH', 'lobby_bot.db'), store_delay)
+        else:
+            self.store = JsonStore(store_delay)
+        
+        # Кэш CM-серверов Steam (cm_servers.json): воркеры входят через самые быстрые
+        # исправные CM; список обновляется раз в CM_CACHE_TTL сек (0 - кэш выключен)
+        cm_cache_ttl = float(os.getenv('CM_CACHE_TTL', '86400'))
+        self.cm_cache = None
+        if cm_cache_ttl > 0:
+            self.cm_cache = CMServerCache(cm_cache_ttl, size=int(os.getenv('CM_CACHE_SIZE', '20')))
+            try:
+                self.cm_cache.load(self.store.load('cm_servers.json'))
+            except Exception as e:
+                logger.warning(f"Кэш CM-серверов не загружен: {e}")
+            self.session_pool.cm_cache = self.cm_cache
+        
+        # Кэш входа Steam (login key + sentry, шифрование Fernet из пакета cryptography):
+        # повторный вход аккаунта без пароля. Ключ - STEAM_CREDENTIAL_KEY или файл
+        # STEAM_CREDENTIAL_KEY_FILE (создаётся сам); STEAM_CREDENTIAL_CACHE=0 - выключить
+        self.credential_cache = None
+        if os.getenv('STEAM_CREDENTIAL_CACHE', '1') != '0':
+            if Fernet is None:
+                logger.warning("⚠️ Пакет cryptography не установлен - кэш входа Steam выключен, вход по паролю")
+            else:
+                try:
+                    key = os.getenv('STEAM_CREDENTIAL_KEY') or CredentialCache.key_from_file(
+                        os.getenv('STEAM_CREDENTIAL_KEY_FILE', 'steam_credentials.key'))
+                    self.credential_cache = CredentialCache(key)
+                    self.credential_cache.load(self.store.load('steam_credentials.json'))
+                except Exception as e:
+                    logger.error(f"❌ Кэш входа Steam не загружен, вход по паролю: {e}")
+                    self.credential_cache = None
+            self.session_pool.credential_cache = self.credential_cache
+        
         # Расписание
         self.schedule_config = {}
         self.scheduler = None
+        self._match_jobs: Dict[str, tuple] = {}  # match_<id> -> (сигнатура, дата запуска, матч)
+        
+        # Прогрев: за SCHEDULE_PREWARM_LEAD сек до матча резервируем аккаунт и поднимаем
+        # сессию Steam/GC, чтобы к старту оставалось только отправить create (0 = выключено)
+        self.schedule_prewarm_lead = int(os.getenv('SCHEDULE_PREWARM_LEAD', '120'))
+        self._prewarmed: Dict[str, str] = {}  # id матча -> username зарезервированного аккаунта
+        
+        # Аккаунты резервируются под окна матчей (длительность - по серии, SCHEDULE_SERIES_MINUTES
+        # вида "bo1=90,bo3=210"); в момент старта свободного аккаунта ждём до SCHEDULE_ACCOUNT_WAIT сек
+        self.schedule_allocator = ScheduleAllocator(
+            ScheduleAllocator.parse_minutes(os.getenv('SCHEDULE_SERIES_MINUTES', '')),
+            lead_seconds=max(0, self.schedule_prewarm_lead),
+        )
+        self.schedule_account_wait = int(os.getenv('SCHEDULE_ACCOUNT_WAIT', '600'))
+        self._account_plan: Dict[str, str] = {}  # id матча -> username по плану
+        
+        # Неудачное создание лобби повторяется: временные ошибки - на том же аккаунте,
+        # ошибки входа - на другом свободном (название и пароль лобби те же)
+        self.lobby_retry = LobbyRetryPolicy(
+            max_attempts=int(os.getenv('LOBBY_RETRY_ATTEMPTS', '3')),
+            budget=float(os.getenv('LOBBY_RETRY_BUDGET', '300')),
+            base_delay=float(os.getenv('LOBBY_RETRY_BACKOFF', '2')),
+        )
+        self._create_errors: Dict[str, str] = {}  # название лобби -> ошибка последней попытки
+        self._cancelled_creations: set = set()  # Аккаунты, создание на которых отменил админ
         
         # Загрузка
         self.load_accounts()
         self.load_settings()
         self.load_schedule()
+        self._mark_startup('state')
         
         # ВАЖНО: Очищаем все аккаунты при старте (новая сессия = новые лобби)
-        for account in self.steam_accounts:
-            account.is_busy = False
-            account.current_lobby = None
-            account.bot_instance = None
+        self.steam_accounts.release_all()
         
         logger.info("🔄 Все аккаунты освобождены для новой сессии")
         
-        # ВАЖНО: Убиваем все старые процессы Python/Steam
-        self.kill_old_processes()
-        
-    def kill_old_processes(self):
-        """Убиваем ВСЕ старые процессы Steam/Dota АГРЕССИВНО"""
+        # Воркеры прошлого запуска: живые подхватываем в post_init (их лобби и игры
+        # продолжаются), остальные из журнала завершаем в фоне (_reap_stale_workers)
+        self._stale_workers: List[dict] = []
+        self._reap_task = None
+    
+    @staticmethod
+    def _worker_hosts_setting() -> int:
+        value = os.getenv('WORKER_HOSTS', '0').strip().lower()
+        if value == 'auto':
+            return os.cpu_count() or 1
+        return int(value or 0)
+    
+    def _save_journal(self):
+        """Журнал живых воркеров: по нему перезапущенный бот подхватывает сессии"""
+        self.store.save('supervisor_journal.json', self._journal_snapshot)
+    
+    def _journal_snapshot(self) -> dict:
+        journal = {}
+        for username, session in self.session_pool.sessions.items():
+            host = session.host
+            if host.start_ticks is None:
+                host.start_ticks = _process_start_ticks(host.process.pid)
+            account = self.steam_accounts.get(username)
+            lobby = self.active_lobbies.get(account.current_lobby) if account and account.current_lobby else None
+            journal[username] = {
+                'pid': host.process.pid,
+                'start_ticks': host.start_ticks,
+                'address': host.control_address,
+                'started_at': session.started_at,
+                'lobby_name': lobby.lobby_name if lobby else None,
+                'password': lobby.password if lobby else None,
+                'created_at': lobby.created_at.timestamp() if lobby else None,
+            }
+        return journal
+    
+    async def adopt_surviving_workers(self):
+        """Переподключается к воркерам из журнала (ко всем хостам параллельно) и восстанавливает их лобби"""
         try:
-            import subprocess
-            import time
-            
-            logger.info("🔪 Очистка ВСЕХ старых процессов Steam/Dota...")
-            
-            # Убиваем все процессы Steam и Dota с флагом -9 (принудительно)
-            commands = [
-                ['pkill', '-9', '-f', 'steam'],
-                ['pkill', '-9', '-f', 'dota'],
-                ['pkill', '-9', '-f', 'SteamClient'],
-                ['pkill', '-9', '-f', 'steam_worker'],
-            ]
-            
-            for cmd in commands:
-                try:
-                    subprocess.run(cmd, stderr=subprocess.DEVNULL, timeout=2)
-                except:
-                    pass
-            
-            # Даём время на завершение
-            time.sleep(2)
-            
-            logger.info("✅ Все старые процессы убиты!")
+            journal = self.store.load('supervisor_journal.json') or {}
         except Exception as e:
-            logger.warning(f"Ошибка очистки процессов: {e}")
+            logger.warning(f"Журнал воркеров не прочитан: {e}")
+            journal = {}
+        
+        # Аккаунты одного хоста делят его unix-сокет - подключаемся к каждому хосту один раз
+        by_address: Dict[str, Dict[str, dict]] = {}
+        for username, entry in journal.items():
+            if not (self.supervisor_adopt and entry.get('address')):
+                self._stale_workers.append(entry)
+                continue
+            by_address.setdefault(entry['address'], {})[username] = entry
         
+        results = await asyncio.gather(
+            *(self.session_pool.adopt(address, next(iter(entries.values())).get('pid'))
+              for address, entries in by_address.items()),
+            return_exceptions=True,
+        )
+        
+        adopted = 0
+        for (address, entries), result in zip(by_address.items(), results):
+            if isinstance(result, (FileNotFoundError, ConnectionRefusedError)):
+                self._stale_workers.extend(entries.values())  # Сокета нет - воркер завершился или завис
+                continue
+            if isinstance(result, Exception):
+                logger.warning(f"⚠️ Не удалось подхватить хост {address}: {result}")
+                self._stale_workers.extend(entries.values())
+                continue
+            host, hello = result
+            
+            for username, lobby in hello['accounts'].items():
+                if username not in self.steam_accounts:
+                    # Аккаунт удалили, пока бот был остановлен
+                    self.session_pool.signal_stop(username)
+                    continue
+                adopted += 1
+                if not lobby:
+                    continue
+                entry = entries.get(username, {})
+                lobby_info = LobbyInfo(
+                    lobby_name=lobby['lobby_name'],
+                    password=lobby.get('password') or entry.get('password'),
+                    account=username,
+                )
+                if entry.get('lobby_name') == lobby['lobby_name'] and entry.get('created_at'):
+                    lobby_info.created_at = datetime.fromtimestamp(entry['created_at'])
+                account = self.steam_accounts.get(username)
+                account.is_busy = True
+                account.current_lobby = lobby_info.lobby_name
+                self.active_lobbies[lobby_info.lobby_name] = lobby_info
+                self.active_processes[username] = host.process
+                logger.info(f"🔗 Лобби {lobby_info.lobby_name} ({username}) подхвачено")
+        
+        # Новые лобби не должны повторять названия подхваченных
+        prefix = f"{self.lobby_base_name} "
+        for lobby_name in self.active_lobbies:
+            suffix = lobby_name[len(prefix):]
+            if lobby_name.startswith(prefix) and suffix.isdigit():
+                self.lobby_counter = max(self.lobby_counter, int(suffix) + 1)
+        
+        logger.info(f"🔗 Подхвачено сессий: {adopted}, лобби: {len(self.active_lobbies)}")
+        self._save_journal()
+    
+    async def _reap_stale_workers(self, entries: List[dict]):
+        """Завершает воркеры прошлого запуска, которые не удалось подхватить.
+        Только по pid из журнала и только если время старта процесса совпадает
+        (pid мог достаться другому процессу); ждём выход через pidfd, не блокируя loop.
+        """
+        async def reap(entry: dict):
+            pid = entry.get('pid')
+            if not pid or not entry.get('start_ticks') or _process_start_ticks(pid) != entry['start_ticks']:
+                return
+            process = AdoptedProcess(pid)
+            try:
+                logger.info(f"🔪 Завершаем старый воркер pid {pid}")
+                process.terminate()
+                if not await _wait_process_exit(process, 10):
+                    process.kill()
+                    await _wait_process_exit(process, 2)
+            finally:
+                process.close()
+        
+        # У аккаунтов одного хоста общий pid - завершаем процесс один раз
+        entries = list({entry.get('pid'): entry for entry in entries}.values())
+        await asyncio.gather(*(reap(entry) for entry in entries), return_exceptions=True)
+        logger.info(f"✅ Старые воркеры обработаны: {len(entries)}")
+    
+    def _mark_startup(self, stage: str):
+        self._startup_marks.append((stage, time.perf_counter()))
+    
+    def _log_startup_timing(self):
+        """Разбивка времени старта: от загрузки модуля до запуска polling"""
+        previous = _STARTUP_T0
+        parts = []
+        for stage, moment in self._startup_marks:
+            parts.append(f"{stage} {(moment - previous) * 1000:.0f}")
+            previous = moment
+        total = (previous - _STARTUP_T0) * 1000
+        logger.info(f"⏱️ Старт за {total:.0f} мс: " + ", ".join(parts) + " (мс)")
+    
     def load_accounts(self):
         try:
-            if os.path.exists('steam_accounts.json'):
-                with open('steam_accounts.json', 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for acc_data in data:
-                        account = SteamAccount(acc_data['username'], acc_data['password'])
-                        self.steam_accounts.append(account)
+            data = self.store.load('steam_accounts.json')
+            if data is not None:
+                for acc_data in data:
+                    if acc_data['username'] in self.steam_accounts:
+                        continue
+                    self.steam_accounts.add(SteamAccount(acc_data['username'], acc_data['password']))
                 logger.info(f"Загружено {len(self.steam_accounts)} аккаунтов")
         except Exception as e:
             logger.error(f"Ошибка загрузки аккаунтов: {e}")
             
     def save_accounts(self):
         try:
-            data = [{'username': acc.username, 'password': acc.password} for acc in self.steam_accounts]
-            with open('steam_accounts.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.store.save('steam_accounts.json', lambda: [acc.to_dict() for acc in self.steam_accounts])
         except Exception as e:
             logger.error(f"Ошибка сохранения: {e}")
     
+    def _save_credentials(self):
+        try:
+            self.store.save('steam_credentials.json', self.credential_cache.to_token)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша входа: {e}")
+    
+    def _forget_credentials(self, username: str):
+        if self.credential_cache is not None:
+            self.credential_cache.forget(username)
+            self._save_credentials()
+    
     def load_settings(self):
         try:
-            if os.path.exists('lobby_settings.json'):
-                with open('lobby_settings.json', 'r', encoding='utf-8') as f:
-                    settings = json.load(f)
-                    self.lobby_base_name = settings.get('lobby_base_name', self.lobby_base_name)
-                    self.server_region = settings.get('server_region', self.server_region)
-                    self.game_mode = settings.get('game_mode', self.game_mode)
+            settings = self.store.load('lobby_settings.json')
+            if settings is not None:
+                self.lobby_base_name = settings.get('lobby_base_name', self.lobby_base_name)
+                self.server_region = settings.get('server_region', self.server_region)
+                self.game_mode = settings.get('game_mode', self.game_mode)
         except Exception as e:
             logger.error(f"Ошибка загрузки настроек: {e}")
     
     def save_settings(self):
         try:
-            settings = {
+            self.store.save('lobby_settings.json', lambda: {
                 'lobby_base_name': self.lobby_base_name,
                 'server_region': self.server_region,
                 'game_mode': self.game_mode
-            }
-            with open('lobby_settings.json', 'w', encoding='utf-8') as f:
-                json.dump(settings, f, ensure_ascii=False, indent=2)
+            })
         except Exception as e:
             logger.error(f"Ошибка сохранения настроек: {e}")
     
     def load_schedule(self):
         """Загрузка расписания"""
         try:
-            if os.path.exists('schedule_config.json'):
-                with open('schedule_config.json', 'r', encoding='utf-8') as f:
-                    self.schedule_config = json.load(f)
+            schedule_config = self.store.load('schedule_config.json')
+            if schedule_config is not None:
+                self.schedule_config = schedule_config
                 logger.info(f"📅 Загружено расписаний: {len(self.schedule_config.get('schedules', []))}")
             else:
                 # Создаём пустое расписание
@@ -736,13 +3442,12 @@ class RealDota2BotV2:
     def save_schedule(self):
         """Сохранение расписания"""
         try:
-            with open('schedule_config.json', 'w', encoding='utf-8') as f:
-                json.dump(self.schedule_config, f, ensure_ascii=False, indent=2)
-            logger.info("💾 Расписание сохранено")
+            # Запись на диск отложенная и фоновая; задачи планировщика - сразу
+            self.store.save('schedule_config.json', lambda: self.schedule_config)
             
-            # Перезапускаем планировщик если бот уже запущен
+            # Синхронизируем задачи матчей с планировщиком (только изменившиеся)
             if hasattr(self, 'telegram_app') and self.telegram_app is not None:
-                self.setup_scheduler()
+                self.reconcile_schedule_jobs()
         except Exception as e:
             logger.error(f"Ошибка сохранения расписания: {e}")
     
@@ -754,7 +3459,7 @@ class RealDota2BotV2:
         return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
     
     def get_available_accounts(self) -> List[SteamAccount]:
-        return [acc for acc in self.steam_accounts if not acc.is_busy]
+        return self.steam_accounts.free()
     
     def is_admin(self, user_id: int) -> bool:
         return user_id in self.admin_ids
@@ -782,7 +3487,7 @@ class RealDota2BotV2:
 
 <b>📊 Статистика:</b>
 🤖 Ботов: {len(self.steam_accounts)}
-💚 Свободных: {len(self.get_available_accounts())}
+💚 Свободных: {self.steam_accounts.free_count}
 🎯 Активных лобби: {len(self.active_lobbies)}
 
 <b>⚙️ Настройки:</b>
@@ -793,6 +3498,33 @@ class RealDota2BotV2:
     
     # ==================== КОМАНДЫ ====================
     
+    async def cmd_metrics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/metrics - перцентили этапов создания лобби; /metrics export - выгрузка в файл"""
+        if not self.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Нет доступа")
+            return
+        
+        if context.args and context.args[0].lower() == 'export':
+            data = json.dumps(self.lobby_metrics.export(), ensure_ascii=False, indent=2)
+            path = self.metrics_export_path
+            await asyncio.get_running_loop().run_in_executor(None, JsonStore._write_atomic, path, data)
+            logger.info(f"📈 Метрики выгружены в {path}")
+            with open(path, 'rb') as f:
+                await update.message.reply_document(f, caption=f"📈 Метрики создания лобби: {path}")
+            return
+        
+        summary = self.lobby_metrics.summary()
+        if not summary:
+            await update.message.reply_text("📈 Замеров пока нет - создайте хотя бы одно лобби")
+            return
+        lines = ["<b>📈 Этапы создания лобби</b> (сек)", "<code>этап            n     p50    p95    p99</code>"]
+        for stage, stats in summary.items():
+            lines.append(
+                f"<code>{stage:<14}{stats['count']:>4}{stats['p50']:>8.2f}{stats['p95']:>7.2f}{stats['p99']:>7.2f}</code>"
+            )
+        lines.append("\nВыгрузка с гистограммами: /metrics export")
+        await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+    
     async def cmd_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id if hasattr(update, 'effective_user') else update.from_user.id
         
@@ -857,9 +3589,9 @@ class RealDota2BotV2:
                 await self.handle_back_to_main(query)
             elif data.startswith("close_lobby_"):
                 lobby_name = data.replace("close_lobby_", "")
-                await self.handle_close_lobby(query, lobby_name)
+                await self.handle_close_lobby(query, lobby_name, context.application)
             elif data == "destroy_all_lobbies":
-                await self.handle_destroy_all_lobbies(query)
+                await self.handle_destroy_all_lobbies(query, context.application)
             elif data.startswith("cancel_creation_"):
                 username = data.replace("cancel_creation_", "")
                 await self.handle_cancel_creation(query, username)
@@ -892,6 +3624,8 @@ class RealDota2BotV2:
         
         for idx, acc in enumerate(self.steam_accounts, 1):
             status = "🔴 Занят" if acc.is_busy else "🟢 Свободен"
+            if self.session_pool.is_warm(acc.username):
+                status += " 🔥"
             message += f"{idx}. <code>{acc.username}</code> - {status}\n"
             if acc.current_lobby:
                 message += f"   └ Лобби: {acc.current_lobby}\n"
@@ -902,7 +3636,8 @@ class RealDota2BotV2:
             ])
         
         message += f"\n<b>Всего:</b> {len(self.steam_accounts)}\n"
-        message += f"<b>Свободных:</b> {len(self.get_available_accounts())}"
+        message += f"<b>Свободных:</b> {self.steam_accounts.free_count}\n"
+        message += f"<b>Тёплых сессий 🔥:</b> {sum(1 for acc in self.steam_accounts if self.session_pool.is_warm(acc.username))}"
         
         keyboard.append([
             InlineKeyboardButton("➕ Добавить бота", callback_data="add_bot")
@@ -926,7 +3661,7 @@ class RealDota2BotV2:
     
     async def handle_delete_bot_confirm(self, query, username: str):
         """Подтверждение удаления"""
-        account = next((acc for acc in self.steam_accounts if acc.username == username), None)
+        account = self.steam_accounts.get(username)
         
         if not account:
             await query.answer("❌ Бот не найден", show_alert=True)
@@ -957,11 +3692,14 @@ class RealDota2BotV2:
     
     async def handle_delete_bot(self, query, username: str):
         """Удаление бота"""
-        account = next((acc for acc in self.steam_accounts if acc.username == username), None)
+        account = self.steam_accounts.get(username)
         
         if account:
-            self.steam_accounts.remove(account)
+            self.steam_accounts.remove(username)
             self.save_accounts()
+            self._forget_credentials(username)
+            # Тёплая сессия удалённого бота больше не нужна
+            self.session_pool.signal_stop(username)
             
             await query.answer(f"✅ Бот {username} удален!", show_alert=True)
             await self.handle_manage_bots(query)
@@ -972,7 +3710,7 @@ class RealDota2BotV2:
         """Запрос на редактирование бота"""
         query = update.callback_query
         username = query.data.replace("edit_bot_", "")
-        account = next((acc for acc in self.steam_accounts if acc.username == username), None)
+        account = self.steam_accounts.get(username)
         
         if not account:
             await query.answer("❌ Бот не найден", show_alert=True)
@@ -1017,24 +3755,28 @@ class RealDota2BotV2:
             
             new_username, new_password = parts
             
-            account = next((acc for acc in self.steam_accounts if acc.username == old_username), None)
+            account = self.steam_accounts.get(old_username)
             
             if not account:
                 await update.message.reply_text("❌ Бот не найден", reply_markup=self.get_main_keyboard())
                 return ConversationHandler.END
             
             # Проверка дубликата
-            if new_username != old_username and any(acc.username == new_username for acc in self.steam_accounts):
+            if new_username != old_username and new_username in self.steam_accounts:
                 await update.message.reply_text(
                     f"❌ Бот <code>{new_username}</code> уже существует!",
                     parse_mode='HTML'
                 )
                 return WAITING_EDIT_BOT_DATA
             
+            # Тёплая сессия залогинена со старыми данными - завершаем её
+            self.session_pool.signal_stop(old_username)
+            
             # Обновляем
-            account.username = new_username
-            account.password = new_password
+            self.steam_accounts.rename(old_username, new_username, new_password)
             self.save_accounts()
+            # Ключ входа выдан под старые логин/пароль
+            self._forget_credentials(old_username)
             
             await update.message.reply_text(
                 f"✅ <b>Бот обновлен!</b>\n\n"
@@ -1071,12 +3813,11 @@ class RealDota2BotV2:
             
             username, password = parts
             
-            if any(acc.username == username for acc in self.steam_accounts):
+            if username in self.steam_accounts:
                 await update.message.reply_text(f"❌ Бот <code>{username}</code> уже добавлен!", parse_mode='HTML')
                 return WAITING_ACCOUNT_DATA
             
-            account = SteamAccount(username, password)
-            self.steam_accounts.append(account)
+            self.steam_accounts.add(SteamAccount(username, password))
             self.save_accounts()
             
             await update.message.reply_text(
@@ -1098,7 +3839,7 @@ class RealDota2BotV2:
     
     async def handle_create_lobby_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        available = len(self.get_available_accounts())
+        available = self.steam_accounts.free_count
         
         if available == 0:
             await query.edit_message_text(
@@ -1276,6 +4017,18 @@ class RealDota2BotV2:
         # Получаем выбранные аккаунты
         selected_accounts = [acc for acc in self.steam_accounts if acc.username in selected]
         
+        # Создание идёт в фоновой задаче: обработчик апдейтов свободен, и кнопки
+        # отмены из прогресса (cancel_creation_*) срабатывают, пока лобби создаются
+        context.application.create_task(
+            self._create_lobby_batch(selected_accounts, status_msg, context, game_mode, series_type)
+        )
+        return ConversationHandler.END
+    
+    async def _create_lobby_batch(self, selected_accounts: List[SteamAccount], status_msg, context,
+                                  game_mode: str, series_type: str):
+        """Ручное создание нескольких лобби и итоговое сообщение (фоновая задача;
+        исключения логирует Application.create_task)"""
+        batch_started = time.monotonic()
         created_lobbies = await self.create_multiple_real_lobbies_from_accounts(
             selected_accounts,
             status_msg,
@@ -1285,18 +4038,20 @@ class RealDota2BotV2:
         )
         
         if not created_lobbies:
-            await status_msg.edit_text(
+            await self.status_updater.set_now(
+                status_msg,
                 "❌ <b>Не удалось создать лобби</b>\n\n"
                 "Проверьте логи для деталей",
                 parse_mode='HTML',
                 reply_markup=self.get_main_keyboard()
             )
-            return ConversationHandler.END
+            return
         
         # Результат
         message = f"✅ <b>Создано {len(created_lobbies)} лобби!</b>\n\n"
         message += f"🎮 Режим: <b>{game_mode}</b>\n"
-        message += f"🎯 Серия: <b>{series_type.upper()}</b>\n\n"
+        message += f"🎯 Серия: <b>{series_type.upper()}</b>\n"
+        message += f"⏱️ Время создания: {time.monotonic() - batch_started:.0f} сек\n\n"
         
         for idx, lobby in enumerate(created_lobbies, 1):
             message += f"<b>{idx}. {lobby.lobby_name}</b>\n"
@@ -1319,30 +4074,15 @@ class RealDota2BotV2:
         group_message += "🎮 Лобби созданы в игре!\n"
         group_message += "Игроки ищут по названию: wb cup 1, wb cup 2...</b>"
         
-        await status_msg.edit_text(
+        await self.status_updater.set_now(
+            status_msg,
             message,
             parse_mode='HTML',
             reply_markup=self.get_main_keyboard()
         )
         
-        # Уведомление в топик группы
-        if self.notification_chat_id:
-            try:
-                send_kwargs = {
-                    'chat_id': self.notification_chat_id,
-                    'text': group_message,
-                    'parse_mode': 'HTML'
-                }
-                # Если указан ID топика - отправляем в топик
-                if self.notification_thread_id:
-                    send_kwargs['message_thread_id'] = self.notification_thread_id
-                
-                await context.bot.send_message(**send_kwargs)
-                logger.info(f"✅ Уведомление отправлено в {'топик ' + str(self.notification_thread_id) if self.notification_thread_id else 'чат'}")
-            except Exception as e:
-                logger.error(f"Ошибка уведомления: {e}")
-        
-        return ConversationHandler.END
+        # Уведомление в топик группы (через общую очередь уведомлений)
+        self.notifier.notify(self.notification_chat_id, group_message, self.notification_thread_id)
     
     async def create_multiple_real_lobbies_from_accounts(
         self,
@@ -1352,52 +4092,116 @@ class RealDota2BotV2:
         game_mode: str = None,
         series_type: str = None
     ) -> List[LobbyInfo]:
-        """Создание лобби из выбранных аккаунтов"""
-        created = []
-        total = len(accounts)
+        """Параллельное создание лобби из выбранных аккаунтов.
         
-        for idx, account in enumerate(accounts, 1):
-            try:
-                await status_msg.edit_text(
-                    f"⏳ <b>Создание лобби {idx}/{total}</b>\n\n"
-                    f"🤖 Аккаунт: {account.username}\n"
-                    f"🔄 Подключение к Steam...",
-                    parse_mode='HTML'
-                )
-                
-                account.is_busy = True
-                lobby_info = await self.create_single_real_lobby(
-                    account, 
-                    status_msg,
-                    game_mode=game_mode,
-                    series_type=series_type
-                )
+        Все воркеры стартуют сразу (не более lobby_create_concurrency одновременно),
+        результаты показываются по мере готовности каждого лобби.
+        """
+        # Аккаунты занимаем через реестр сразу, чтобы их нельзя было выбрать повторно.
+        # Аккаунт, который с момента выбора занял прогрев расписания или другое
+        # создание, пропускаем: второй create на его сессии закрыл бы чужое лобби
+        skipped = [account for account in accounts if self.steam_accounts.acquire(account.username) is None]
+        accounts = [account for account in accounts if account not in skipped]
+        for account in skipped:
+            logger.warning(f"⚠️ Аккаунт {account.username} уже занят, лобби на нём не создаём")
+        
+        total = len(accounts)
+        if total == 0:
+            return []
+        
+        # Названия выдаём заранее, чтобы нумерация совпадала с порядком выбора ботов
+        lobby_names = {account.username: self.get_next_lobby_name() for account in accounts}
+        
+        semaphore = asyncio.Semaphore(self.lobby_create_concurrency)
+        silent_msg = SilentStatusMessage()
+        batch_started = time.monotonic()
+        
+        async def create_one(idx: int, account: SteamAccount):
+            if self.lobby_create_stagger > 0:
+                await asyncio.sleep(idx * self.lobby_create_stagger)
+            async with semaphore:
+                started = time.monotonic()
+                lobby_info = None
+                try:
+                    # Аккаунты выбраны вручную - повторяем только на том же аккаунте
+                    lobby_info = await self.create_lobby_with_failover(
+                        account,
+                        silent_msg,
+                        game_mode=game_mode,
+                        series_type=series_type,
+                        lobby_name=lobby_names[account.username],
+                        failover=False,
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка создания лобби для {account.username}: {e}", exc_info=True)
+                    account.is_busy = False
                 
+                # Неудачное создание освобождает аккаунт само
                 if lobby_info:
-                    created.append(lobby_info)
-                    logger.info(f"✅ Лобби {idx} создано: {lobby_info.lobby_name}")
-                    
-                    # ВАЖНО: Добавляем задержку между созданием лобби
-                    # чтобы дать первому лобби время стать видимым в поиске
-                    if idx < total:  # Не ждём после последнего лобби
-                        await asyncio.sleep(5)  # Задержка 5 секунд между созданием лобби
-                else:
-                    logger.error(f"❌ Не удалось создать лобби {idx}")
-                    account.is_busy = False
-                    
-            except Exception as e:
-                logger.error(f"Ошибка создания лобби {idx}: {e}", exc_info=True)
-                account.is_busy = False
+                    lobby_info.creation_seconds = time.monotonic() - started
+                return account, lobby_info
+        
+        tasks = [asyncio.create_task(create_one(idx, account)) for idx, account in enumerate(accounts)]
+        pending = {account.username for account in accounts}
+        lines = [f"⚠️ {account.username} занят — пропущен" for account in skipped]
+        created = []
+        
+        self._render_batch_progress(status_msg, total, lines, pending, batch_started)
+        
+        for future in asyncio.as_completed(tasks):
+            account, lobby_info = await future
+            pending.discard(account.username)
+            
+            if lobby_info:
+                created.append(lobby_info)
+                lines.append(f"✅ {lobby_info.lobby_name} — {account.username} ({lobby_info.creation_seconds:.0f} сек)")
+                logger.info(f"✅ Лобби создано: {lobby_info.lobby_name} за {lobby_info.creation_seconds:.1f} сек")
+            else:
+                lines.append(f"❌ {lobby_names[account.username]} — {account.username}")
+                logger.error(f"❌ Не удалось создать лобби {lobby_names[account.username]} ({account.username})")
+            
+            self._render_batch_progress(status_msg, total, lines, pending, batch_started)
+        
+        elapsed = time.monotonic() - batch_started
+        logger.info(f"⏱️ Создано {len(created)}/{total} лобби за {elapsed:.1f} сек "
+                    f"(параллельно до {self.lobby_create_concurrency})")
         
+        # Возвращаем в порядке выбора ботов
+        order = list(lobby_names.values())
+        created.sort(key=lambda lobby: order.index(lobby.lobby_name))
         return created
     
+    def _render_batch_progress(self, status_msg, total: int, lines: List[str],
+                               pending: set, batch_started: float):
+        """Прогресс параллельного создания: готовые лобби + кнопки отмены для ожидающих"""
+        elapsed = int(time.monotonic() - batch_started)
+        text = f"⏳ <b>Создание лобби: {total - len(pending)}/{total}</b>\n\n"
+        if lines:
+            text += "\n".join(lines) + "\n\n"
+        if pending:
+            text += f"🔄 В процессе: {len(pending)}\n"
+        text += f"⏱️ Прошло {elapsed} сек"
+        
+        keyboard = [
+            [InlineKeyboardButton(f"❌ Отменить {username}", callback_data=f"cancel_creation_{username}")]
+            for username in sorted(pending)
+        ]
+        self.status_updater.set(
+            status_msg,
+            text,
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+        )
+    
     async def create_single_real_lobby(self, account: SteamAccount, status_msg, 
                                        game_mode: str = None, series_type: str = None, 
-                                       lobby_name: str = None) -> Optional[LobbyInfo]:
-        """Создание лобби через Steam и Dota 2 в отдельном процессе"""
-        process = None
-        result_queue = None
-        shutdown_event = None
+                                       lobby_name: str = None, deadline: float = None,
+                                       password: str = None, max_wait: float = 180) -> Optional[LobbyInfo]:
+        """Создание лобби через тёплую Steam/GC сессию аккаунта (процесс из пула).
+        deadline - время старта матча: по нему вход в Steam встаёт в очередь допуска.
+        Причину неудачи кладёт в _create_errors[lobby_name] (для LobbyRetryPolicy)."""
+        session = None
+        create_started = time.monotonic()
         
         try:
             # Генерируем данные
@@ -1408,75 +4212,77 @@ class RealDota2BotV2:
             if not series_type:
                 series_type = "bo1"  # По умолчанию одна игра
             
-            password = self.generate_password()
+            if not password:
+                password = self.generate_password()
+            warm = self.session_pool.is_warm(account.username)
             
             # Обновляем статус с кнопкой отмены
             cancel_keyboard = InlineKeyboardMarkup([[
                 InlineKeyboardButton("❌ Отменить создание", callback_data=f"cancel_creation_{account.username}")
             ]])
-            await status_msg.edit_text(
+            self.status_updater.set(
+                status_msg,
                 f"⏳ <b>Создание реального лобби</b>\n\n"
                 f"🤖 Аккаунт: {account.username}\n"
                 f"🏷️ Название: {lobby_name}\n"
                 f"🔐 Пароль: {password}\n\n"
-                f"⏱️ Запуск Steam...",
+                f"⏱️ {'Сессия Steam уже готова...' if warm else 'Запуск Steam...'}",
                 parse_mode='HTML',
                 reply_markup=cancel_keyboard
             )
             
-            # Создаем очередь для результата и event для shutdown
-            result_queue = multiprocessing.Queue()
-            shutdown_event = multiprocessing.Event()
-            
-            # Запускаем Steam в отдельном процессе
-            process = Process(
-                target=steam_worker_process,
-                args=(
-                    account.username,
-                    account.password,
-                    lobby_name,
-                    password,
-                    self.server_region,
-                    game_mode,  # Режим игры
-                    series_type,  # Серия игр
-                    result_queue,
-                    shutdown_event,
-                )
+            # Берём тёплую сессию или запускаем новую и отправляем команду создания.
+            # Результат придёт через канал событий воркеров (см. _handle_worker_event)
+            session = self.session_pool.get_or_start(account, deadline)
+            result_future = asyncio.get_running_loop().create_future()
+            session.pending = result_future
+            session.pending_lobby = lobby_name
+            session.send(
+                'create',
+                lobby_name=lobby_name,
+                password=password,
+                server=self.server_region,
+                mode=game_mode,
+                series_type=series_type,
+                idle_timeout=self.lobby_idle_timeout,
+                max_lifetime=self.lobby_max_lifetime,
+                snapshot_interval=1 / self.lobby_snapshot_rate,
             )
-            process.start()
             
             # Сохраняем shutdown_event для возможности закрытия лобби
-            self.shutdown_events[account.username] = shutdown_event
+            self.shutdown_events[account.username] = session.shutdown_event
             
-            # Ждем результата (с таймаутом)
-            max_wait_time = 180  # 3 минуты (увеличено для медленных соединений)
+            # Ждем результата (с таймаутом), статус обновляем каждые 10 секунд
+            max_wait_time = max_wait  # 3 минуты по умолчанию (для медленных соединений)
             start_time = time.time()
-            result = None
             
-            while time.time() - start_time < max_wait_time:
-                await asyncio.sleep(2)
-                
-                # Обновляем статус каждые 10 секунд
-                elapsed = int(time.time() - start_time)
-                if elapsed % 10 == 0:
-                    await status_msg.edit_text(
-                        f"⏳ <b>Создание реального лобби</b>\n\n"
-                        f"🤖 Аккаунт: {account.username}\n"
-                        f"🏷️ Название: {lobby_name}\n"
-                        f"🔐 Пароль: {password}\n\n"
-                        f"⏱️ Прошло {elapsed} сек...",
-                        parse_mode='HTML',
-                        reply_markup=cancel_keyboard
-                    )
-                
-                # Проверяем очередь
-                if not result_queue.empty():
-                    result = result_queue.get()
+            while not result_future.done():
+                elapsed = time.time() - start_time
+                if elapsed >= max_wait_time:
                     break
+                await asyncio.wait({result_future}, timeout=min(10, max_wait_time - elapsed))
+                if result_future.done():
+                    break
+                
+                self.status_updater.set(
+                    status_msg,
+                    f"⏳ <b>Создание реального лобби</b>\n\n"
+                    f"🤖 Аккаунт: {account.username}\n"
+                    f"🏷️ Название: {lobby_name}\n"
+                    f"🔐 Пароль: {password}\n\n"
+                    f"⏱️ Прошло {int(time.time() - start_time)} сек...",
+                    parse_mode='HTML',
+                    reply_markup=cancel_keyboard
+                )
+            
+            result = result_future.result() if result_future.done() else None
+            session.pending = None
             
             # Анализируем результат
             if result and result.get('success'):
-                logger.info(f"✅ Лобби создано: {lobby_name}")
+                logger.info(f"✅ Лобби создано: {lobby_name} ({'тёплая сессия' if warm else 'новая сессия'})")
+                self.lobby_metrics.record('create_command', time.time() - start_time)
+                self.lobby_metrics.record('create_total', time.monotonic() - create_started)
                 
                 # Создаем объект лобби
                 lobby_info = LobbyInfo(
@@ -1484,13 +4290,18 @@ class RealDota2BotV2:
                     password=password,
                     account=account.username,
                 )
+                if session.last_snapshot and session.last_snapshot.get('lobby_name') == lobby_name:
+                    lobby_info.apply_snapshot(session.last_snapshot)
+                if session.phase_lobby == lobby_name:
+                    lobby_info.apply_phase(session.phase, session.phase_durations)
                 
-                # КРИТИЧЕСКИ ВАЖНО: Сохраняем процесс и очередь ПЕРВЫМИ для мониторинга
-                self.active_processes[account.username] = process
-                self.result_queues[account.username] = result_queue
+                # КРИТИЧЕСКИ ВАЖНО: Сохраняем процесс ПЕРВЫМ для мониторинга
+                self.active_processes[account.username] = session.process
                 
-                # Теперь обновляем статусы (после сохранения очереди!)
+                # Теперь обновляем статусы
                 self.active_lobbies[lobby_name] = lobby_info
+                self.store.record_lobby_created(lobby_info)
+                self._save_journal()
                 account.is_busy = True
                 account.current_lobby = lobby_name
                 
@@ -1498,25 +4309,15 @@ class RealDota2BotV2:
             else:
                 error_msg = result.get('error', 'Unknown error') if result else 'Timeout'
                 logger.error(f"❌ Не удалось создать лобби: {error_msg}")
+                self._create_errors[lobby_name] = error_msg
                 
                 # Освобождаем аккаунт
                 account.is_busy = False
                 
-                # Отправляем shutdown signal и останавливаем процесс
-                if process and process.is_alive():
-                    if shutdown_event:
-                        logger.info(f"Отправляем shutdown signal для {account.username}...")
-                        shutdown_event.set()
-                        process.join(timeout=10)  # Даём 10 сек на graceful shutdown
-                    
-                    if process.is_alive():
-                        logger.warning(f"Процесс {account.username} не завершился, принудительное завершение...")
-                        process.terminate()
-                        process.join(timeout=5)
-                    
-                    if process.is_alive():
-                        process.kill()
-                        process.join(timeout=2)
+                # Сломанную сессию не переиспользуем: останавливаем процесс
+                # (отменённое создание сессию не ломает)
+                if not (result and result.get('error') == 'Cancelled' and self.session_pool.persistent):
+                    await self.session_pool.stop_many_async([account.username], timeout=10)
                 
                 # Очистка
                 if account.username in self.active_processes:
@@ -1528,24 +4329,16 @@ class RealDota2BotV2:
             
         except Exception as e:
             logger.error(f"Ошибка создания РЕАЛЬНОГО лобби: {e}", exc_info=True)
+            if lobby_name:
+                self._create_errors[lobby_name] = str(e)
             
             # Освобождаем аккаунт
             account.is_busy = False
             
             # Останавливаем процесс
-            if process and process.is_alive():
+            if session:
                 try:
-                    if shutdown_event:
-                        shutdown_event.set()
-                        process.join(timeout=10)
-                    
-                    if process.is_alive():
-                        process.terminate()
-                        process.join(timeout=5)
-                    
-                    if process.is_alive():
-                        process.kill()
-                        process.join(timeout=2)
+                    await self.session_pool.stop_many_async([account.username], timeout=10)
                 except:
                     pass
             
@@ -1555,16 +4348,110 @@ class RealDota2BotV2:
             if account.username in self.shutdown_events:
                 del self.shutdown_events[account.username]
             
-            return None
+            return None
+    
+    async def create_lobby_with_failover(self, account: SteamAccount, status_msg,
+                                         game_mode: str = None, series_type: str = None,
+                                         lobby_name: str = None, deadline: float = None,
+                                         failover: bool = True) -> Optional[LobbyInfo]:
+        """create_single_real_lobby с повторами по LobbyRetryPolicy.
+        
+        Название и пароль лобби одни на все попытки, так что игроки получают то же лобби,
+        на каком бы аккаунте оно ни поднялось. account уже занят вызывающим;
+        failover=False - повторы только на этом аккаунте (ручной выбор аккаунтов).
+        """
+        policy = self.lobby_retry
+        if not lobby_name:
+            lobby_name = self.get_next_lobby_name()
+        password = self.generate_password()
+        started = time.monotonic()
+        tried: List[str] = []
+        self._cancelled_creations.discard(account.username)
+        
+        while True:
+            tried.append(account.username)
+            remaining = policy.budget - (time.monotonic() - started)
+            lobby_info = await self.create_single_real_lobby(
+                account,
+                status_msg,
+                game_mode=game_mode,
+                series_type=series_type,
+                lobby_name=lobby_name,
+                deadline=deadline,
+                password=password,
+                max_wait=max(policy.min_attempt, min(180, remaining)),
+            )
+            if lobby_info:
+                lobby_info.attempts = len(tried)
+                if len(tried) > 1:
+                    logger.info(f"🔁 Лобби {lobby_name} создано с попытки {len(tried)} (аккаунты: {', '.join(tried)})")
+                return lobby_info
+            
+            error = self._create_errors.pop(lobby_name, None)
+            kind = policy.classify(error)
+            if account.username in self._cancelled_creations:
+                self._cancelled_creations.discard(account.username)
+                kind = LobbyRetryPolicy.CANCELLED
+            if kind == LobbyRetryPolicy.CANCELLED:
+                return None
+            if len(tried) >= policy.max_attempts:
+                logger.error(f"❌ Лобби {lobby_name}: исчерпаны {policy.max_attempts} попытки (последняя ошибка: {error})")
+                return None
+            
+            delay = policy.delay(len(tried))
+            if policy.budget - (time.monotonic() - started) - delay < policy.min_attempt:
+                logger.error(f"❌ Лобби {lobby_name}: бюджет {policy.budget:.0f} сек на повторы исчерпан (последняя ошибка: {error})")
+                return None
+            await asyncio.sleep(delay)
+            if account.username in self._cancelled_creations:
+                self._cancelled_creations.discard(account.username)
+                return None
+            
+            # Временная ошибка - ещё раз на том же аккаунте (сессия уже перезапущена),
+            # ошибка входа или повторные сбои - на другом свободном, тёплые в приоритете
+            next_account = None
+            if kind == LobbyRetryPolicy.TRANSIENT and tried.count(account.username) <= policy.same_account_retries:
+                next_account = self.steam_accounts.acquire(account.username)
+            if next_account is None and failover:
+                candidates = [acc for acc in self.steam_accounts.free() if acc.username not in tried]
+                candidates.sort(key=lambda acc: not self.session_pool.is_warm(acc.username))
+                if candidates:
+                    next_account = self.steam_accounts.acquire(candidates[0].username)
+            if next_account is None:
+                logger.error(f"❌ Лобби {lobby_name}: нет аккаунта для повтора после ошибки '{error}' ({account.username})")
+                return None
             
+            if next_account is account:
+                logger.warning(f"🔁 Лобби {lobby_name}: повтор на {account.username} через {delay:.1f} сек после '{error}'")
+            else:
+                logger.warning(
+                    f"🔀 Лобби {lobby_name}: {account.username} не смог ('{error}'), "
+                    f"переключаемся на {next_account.username} через {delay:.1f} сек"
+                )
+            account = next_account
+    
+    async def _stop_lobby_workers(self, usernames: List[str], timeout: float = 20):
+        """Удаляет лобби аккаунтов, не блокируя event loop.
+        Тёплые сессии получают команду destroy и остаются в пуле,
+        одноразовые - завершаются параллельно (shutdown → terminate → kill).
+        """
+        to_stop = []
+        for username in usernames:
+            if self.session_pool.persistent and self.session_pool.destroy_lobby(username):
+                logger.info(f"Отправлена команда удаления лобби для {username}, сессия остаётся активной")
+            else:
+                logger.info(f"Останавливаем процесс для {username}, отправляем сигнал shutdown...")
+                to_stop.append(username)
+        
+        try:
+            if to_stop:
+                await self.session_pool.stop_many_async(to_stop, timeout=timeout)
+        except Exception as e:
+            logger.error(f"Ошибка остановки процессов {to_stop}: {e}")
         finally:
-            # ВАЖНО: Всегда закрываем result_queue для предотвращения утечек ресурсов
-            if result_queue is not None:
-                try:
-                    result_queue.close()
-                    result_queue.join_thread()
-                except Exception as cleanup_error:
-                    logger.debug(f"Ошибка очистки result_queue: {cleanup_error}")
+            for username in usernames:
+                self.active_processes.pop(username, None)
+                self.shutdown_events.pop(username, None)
     
     # ==================== СПИСОК ЛОББИ ====================
     
@@ -1583,11 +4470,14 @@ class RealDota2BotV2:
         message = "<b>📋 Активные лобби:</b>\n\n"
         keyboard = []
         
+        total_players = sum(lobby.players_count for lobby in self.active_lobbies.values())
+        message += f"👥 Всего игроков в лобби: {total_players}\n\n"
+        
         for idx, (lobby_name, lobby) in enumerate(self.active_lobbies.items(), 1):
-            message += f"✅ <b>{idx}. {lobby_name}</b>\n"
+            message += f"{lobby.fill_emoji()} <b>{idx}. {lobby_name}</b>\n"
             message += f"🔒 Пароль: <code>{lobby.password}</code>\n"
             message += f"🤖 Бот: {lobby.account}\n"
-            message += f"👥 Игроков: {lobby.players_count}/10\n\n"
+            message += f"{lobby.players_line()}\n\n"
             
             keyboard.append([
                 InlineKeyboardButton(f"❌ Закрыть {idx}", callback_data=f"close_lobby_{lobby_name}")
@@ -1601,204 +4491,120 @@ class RealDota2BotV2:
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     
-    async def handle_close_lobby(self, query, lobby_name: str):
-        """Закрытие лобби и остановка процесса"""
-        if lobby_name in self.active_lobbies:
-            lobby = self.active_lobbies[lobby_name]
+    async def handle_close_lobby(self, query, lobby_name: str, application: Application):
+        """Закрытие лобби. Удаление в Steam идёт в фоновой задаче: обработчик апдейтов
+        не ждёт воркер, и бот отвечает остальным админам, пока лобби закрывается."""
+        if lobby_name not in self.active_lobbies:
+            await query.answer("❌ Лобби не найдено", show_alert=True)
+            return
+        if lobby_name in self._closing_lobbies:
+            await query.answer("⏳ Лобби уже закрывается", show_alert=True)
+            return
+        
+        self._closing_lobbies.add(lobby_name)
+        await query.answer("⏳ Закрываем лобби...", show_alert=True)
+        application.create_task(self._close_lobby(query, lobby_name))
+    
+    async def _close_lobby(self, query, lobby_name: str):
+        try:
+            lobby = self.active_lobbies.get(lobby_name)
+            if lobby is None:
+                return
             
-            # Останавливаем процесс Steam (если запущен)
-            if lobby.account in self.active_processes:
-                process = self.active_processes[lobby.account]
-                try:
-                    if process.is_alive():
-                        logger.info(f"Останавливаем процесс для {lobby.account}, отправляем сигнал shutdown...")
-                        
-                        # Устанавливаем shutdown_event для graceful shutdown
-                        if lobby.account in self.shutdown_events:
-                            shutdown_event = self.shutdown_events[lobby.account]
-                            shutdown_event.set()
-                            logger.info(f"Ждём удаления лобби (макс 20 секунд)...")
-                            
-                            # Даём процессу 20 секунд на удаление лобби
-                            process.join(timeout=20)
-                        
-                        # Если процесс не завершился - принудительно
-                        if process.is_alive():
-                            logger.warning(f"Процесс не завершился, принудительное завершение...")
-                            process.terminate()
-                            process.join(timeout=2)
-                        
-                        if process.is_alive():
-                            logger.warning(f"Убиваем процесс...")
-                            process.kill()
-                            process.join(timeout=2)
-                        
-                        logger.info(f"✅ Процесс {lobby.account} остановлен")
-                        
-                except Exception as e:
-                    logger.error(f"Ошибка остановки процесса: {e}")
-                finally:
-                    if lobby.account in self.active_processes:
-                        del self.active_processes[lobby.account]
-                    if lobby.account in self.shutdown_events:
-                        del self.shutdown_events[lobby.account]
-                    if lobby.account in self.result_queues:
-                        del self.result_queues[lobby.account]
+            # Удаляем лобби в Steam (тёплая сессия остаётся в пуле)
+            await self._stop_lobby_workers([lobby.account], timeout=20)
             
             # Освобождаем аккаунт
-            for account in self.steam_accounts:
-                if account.username == lobby.account:
-                    account.is_busy = False
-                    account.current_lobby = None
-                    account.bot_instance = None
-                    break
+            self.steam_accounts.release(lobby.account)
             
-            # Удаляем лобби
-            del self.active_lobbies[lobby_name]
+            # Удаляем лобби (если его ещё не убрало событие lobby_closed воркера)
+            if self.active_lobbies.get(lobby_name) is lobby:
+                del self.active_lobbies[lobby_name]
+                self.store.record_lobby_closed(lobby_name, 'manual')
+                self._save_journal()
             logger.info(f"✅ Лобби {lobby_name} закрыто")
             
-            await query.answer("✅ Лобби закрыто!", show_alert=True)
             await self.handle_list_lobbies(query)
-        else:
-            await query.answer("❌ Лобби не найдено", show_alert=True)
+        except Exception as e:
+            logger.error(f"Ошибка закрытия лобби {lobby_name}: {e}", exc_info=True)
+        finally:
+            self._closing_lobbies.discard(lobby_name)
     
-    async def handle_destroy_all_lobbies(self, query):
-        """Удаление ВСЕХ активных лобби"""
-        if not self.active_lobbies:
+    async def handle_destroy_all_lobbies(self, query, application: Application):
+        """Удаление ВСЕХ активных лобби (в фоновой задаче, см. handle_close_lobby)"""
+        # Копируем список лобби (чтобы избежать изменения во время итерации)
+        lobbies_to_close = [(lobby_name, lobby) for lobby_name, lobby in self.active_lobbies.items()
+                            if lobby_name not in self._closing_lobbies]
+        if not lobbies_to_close:
             await query.answer("❌ Нет активных лобби", show_alert=True)
             return
         
-        lobby_count = len(self.active_lobbies)
+        self._closing_lobbies.update(lobby_name for lobby_name, _ in lobbies_to_close)
         
         # Показываем прогресс
         await query.edit_message_text(
             f"🔥 <b>Удаление всех лобби...</b>\n\n"
-            f"Найдено лобби: {lobby_count}\n"
+            f"Найдено лобби: {len(lobbies_to_close)}\n"
             f"⏳ Останавливаем процессы...",
             parse_mode='HTML'
         )
-        
-        import subprocess
+        application.create_task(self._destroy_lobbies(query, lobbies_to_close))
+    
+    async def _destroy_lobbies(self, query, lobbies_to_close: List[tuple]):
+        lobby_count = len(lobbies_to_close)
         closed_count = 0
-        
-        # Копируем список лобби (чтобы избежать изменения во время итерации)
-        lobbies_to_close = list(self.active_lobbies.items())
-        
-        for lobby_name, lobby in lobbies_to_close:
-            try:
-                # Останавливаем процесс Steam (если запущен)
-                if lobby.account in self.active_processes:
-                    process = self.active_processes[lobby.account]
-                    try:
-                        if process.is_alive():
-                            logger.info(f"Останавливаем процесс для {lobby.account}, отправляем сигнал shutdown...")
-                            
-                            # Устанавливаем shutdown_event для graceful shutdown
-                            if lobby.account in self.shutdown_events:
-                                shutdown_event = self.shutdown_events[lobby.account]
-                                shutdown_event.set()
-                                logger.info(f"Ждём удаления лобби {lobby_name} (макс 20 секунд)...")
-                                
-                                # Даём процессу 20 секунд на удаление лобби
-                                process.join(timeout=20)
-                            
-                            # Если процесс не завершился - принудительно
-                            if process.is_alive():
-                                logger.warning(f"Процесс {lobby.account} не завершился, принудительное завершение...")
-                                process.terminate()
-                                process.join(timeout=2)
-                            
-                            if process.is_alive():
-                                logger.warning(f"Убиваем процесс {lobby.account}...")
-                                process.kill()
-                                process.join(timeout=2)
-                            
-                            logger.info(f"✅ Процесс {lobby.account} остановлен")
-                            
-                    except Exception as e:
-                        logger.error(f"Ошибка остановки процесса {lobby.account}: {e}")
-                    finally:
-                        if lobby.account in self.active_processes:
-                            del self.active_processes[lobby.account]
-                        if lobby.account in self.shutdown_events:
-                            del self.shutdown_events[lobby.account]
-                        if lobby.account in self.result_queues:
-                            del self.result_queues[lobby.account]
-                
+        try:
+            # Сигнал всем сессиям сразу, ожидание - параллельно (~один таймаут на всех)
+            started = time.monotonic()
+            await self._stop_lobby_workers([lobby.account for _, lobby in lobbies_to_close], timeout=20)
+            
+            for lobby_name, lobby in lobbies_to_close:
                 # Освобождаем аккаунт
-                for account in self.steam_accounts:
-                    if account.username == lobby.account:
-                        account.is_busy = False
-                        account.current_lobby = None
-                        account.bot_instance = None
-                        break
+                self.steam_accounts.release(lobby.account)
                 
                 # Удаляем лобби
-                if lobby_name in self.active_lobbies:
+                if self.active_lobbies.get(lobby_name) is lobby:
                     del self.active_lobbies[lobby_name]
+                    self.store.record_lobby_closed(lobby_name, 'destroy_all')
                 
                 closed_count += 1
-                logger.info(f"✅ Лобби {lobby_name} удалено ({closed_count}/{lobby_count})")
-                
-            except Exception as e:
-                logger.error(f"Ошибка удаления лобби {lobby_name}: {e}")
-        
-        # Дополнительная очистка всех процессов steam/dota
-        logger.info("🔪 Финальная очистка всех процессов...")
-        try:
-            subprocess.run(['pkill', '-9', '-f', 'steam'], stderr=subprocess.DEVNULL)
-            subprocess.run(['pkill', '-9', '-f', 'dota'], stderr=subprocess.DEVNULL)
-        except:
-            pass
-        
-        # Показываем результат
-        await query.edit_message_text(
-            f"✅ <b>Все лобби удалены!</b>\n\n"
-            f"🔥 Закрыто: {closed_count}\n"
-            f"💚 Все боты освобождены\n"
-            f"🧹 Процессы очищены",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("◀️ Назад", callback_data="manage_bots")
-            ]])
-        )
+            self._save_journal()
+            
+            # Зависшие процессы хостов _stop_lobby_workers уже добил по их pid (terminate → kill).
+            # pkill -f по имени не используем: под него попадают forkserver (в его командной
+            # строке модули steam.client/dota2.client) и сам бот
+            logger.info(f"✅ Удалено лобби: {closed_count}/{lobby_count} за {time.monotonic() - started:.1f} сек")
+            
+            # Показываем результат
+            await query.edit_message_text(
+                f"✅ <b>Все лобби удалены!</b>\n\n"
+                f"🔥 Закрыто: {closed_count}\n"
+                f"💚 Все боты освобождены\n"
+                f"🧹 Процессы очищены",
+                parse_mode='HTML',
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("◀️ Назад", callback_data="manage_bots")
+                ]])
+            )
+        except Exception as e:
+            logger.error(f"Ошибка удаления всех лобби: {e}", exc_info=True)
+        finally:
+            self._closing_lobbies.difference_update(lobby_name for lobby_name, _ in lobbies_to_close)
     
     async def handle_cancel_creation(self, query, username: str):
         """Отмена создания лобби"""
         await query.answer("🛑 Отменяем создание...", show_alert=True)
         
-        # Отправляем shutdown signal процессу
+        # Повторы создания на этом аккаунте тоже отменяются
+        self._cancelled_creations.add(username)
+        
+        # Отправляем команду отмены сессии
         if username in self.shutdown_events:
             logger.info(f"Отмена создания лобби для {username}")
-            self.shutdown_events[username].set()
-            
-            # Останавливаем процесс
-            if username in self.active_processes:
-                process = self.active_processes[username]
-                try:
-                    if process.is_alive():
-                        process.join(timeout=10)
-                        if process.is_alive():
-                            process.terminate()
-                            process.join(timeout=2)
-                        if process.is_alive():
-                            process.kill()
-                            process.join(timeout=2)
-                except Exception as e:
-                    logger.error(f"Ошибка остановки процесса при отмене: {e}")
-                finally:
-                    if username in self.active_processes:
-                        del self.active_processes[username]
-                    if username in self.shutdown_events:
-                        del self.shutdown_events[username]
-            
-            # Освобождаем аккаунт
-            for account in self.steam_accounts:
-                if account.username == username:
-                    account.is_busy = False
-                    account.current_lobby = None
-                    account.bot_instance = None
-                    break
+            await self._stop_lobby_workers([username], timeout=10)
+            # Аккаунт здесь не освобождаем: создание ещё ждёт ответа воркера и само
+            # освободит аккаунт, получив 'Cancelled'. Иначе аккаунт успеет занять
+            # другое создание, а первое по таймауту убьёт его сессию
         
         # Возвращаемся в главное меню
         await query.edit_message_text(
@@ -1921,7 +4727,7 @@ class RealDota2BotV2:
             if lobby_name in self.active_lobbies:
                 lobby = self.active_lobbies[lobby_name]
                 message += f"🔒 Пароль: <code>{lobby.password}</code>\n"
-                message += f"👥 Игроков: {lobby.players_count}/10\n"
+                message += f"{lobby.fill_emoji()} {lobby.players_line()}\n"
             
             message += "\n"
         
@@ -1940,9 +4746,6 @@ class RealDota2BotV2:
             self.schedule_config['enabled'] = not self.schedule_config.get('enabled', False)
             self.save_schedule()
             
-            # Перезапускаем планировщик
-            self.setup_scheduler()
-            
             await query.answer(
                 f"✅ Расписание {'включено' if self.schedule_config['enabled'] else 'выключено'}!",
                 show_alert=True
@@ -1955,15 +4758,11 @@ class RealDota2BotV2:
         data = query.data
         
         if data == "match_add":
-            # Проверяем лимит матчей
-            matches = self.schedule_config.get('matches', [])
-            total_accounts = len(self.steam_accounts)
-            
-            if len(matches) >= total_accounts:
+            # Пересечения по времени проверяются при сохранении матча (нужна серия)
+            if not len(self.steam_accounts):
                 await query.answer(
-                    f"❌ Нельзя добавить больше {total_accounts} матчей!\n"
-                    f"У вас только {total_accounts} аккаунтов Steam.\n"
-                    f"Добавьте ещё аккаунты через 'Управление ботами'",
+                    "❌ Нет аккаунтов Steam!\n"
+                    "Добавьте аккаунты через 'Управление ботами'",
                     show_alert=True
                 )
                 return
@@ -2154,21 +4953,8 @@ class RealDota2BotV2:
             )
             return WAITING_MATCH_LIST
         
-        # Проверяем лимит
-        total_accounts = len(self.steam_accounts)
-        existing_matches = len(self.schedule_config.get('matches', []))
-        
-        if existing_matches + len(lines) > total_accounts:
-            await update.message.reply_text(
-                f"❌ Слишком много матчей!\n\n"
-                f"У вас {total_accounts} аккаунтов\n"
-                f"Уже запланировано: {existing_matches}\n"
-                f"Вы пытаетесь добавить: {len(lines)}\n"
-                f"Доступно мест: {total_accounts - existing_matches}\n\n"
-                f"Удалите лишние строки или добавьте больше аккаунтов.",
-                parse_mode='HTML'
-            )
-            return WAITING_MATCH_LIST
+        # Пересечения матчей по времени проверяются после выбора серии
+        # (от неё зависит, как долго матч держит аккаунт)
         
         # Парсим матчи
         added_matches = []
@@ -2307,13 +5093,25 @@ class RealDota2BotV2:
                 match['enabled'] = True
                 match['status'] = 'scheduled'
             
+            overcommit = self._schedule_overcommit(bulk_matches)
+            if overcommit:
+                await query.edit_message_text(
+                    overcommit + "\n\nМатчи не добавлены.",
+                    parse_mode='HTML',
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("◀️ К расписанию", callback_data="schedule")
+                    ]])
+                )
+                for key in ('bulk_matches', 'bulk_errors', 'match_game_mode'):
+                    context.user_data.pop(key, None)
+                return ConversationHandler.END
+            
             # Сохраняем все матчи
             if 'matches' not in self.schedule_config:
                 self.schedule_config['matches'] = []
             
             self.schedule_config['matches'].extend(bulk_matches)
             self.save_schedule()
-            self.setup_scheduler()
             
             # Формируем отчёт
             result_message = "<b>✅ Матчи добавлены в расписание!</b>\n\n"
@@ -2358,6 +5156,28 @@ class RealDota2BotV2:
         # Проверяем, редактируем или создаём
         editing_match_id = context.user_data.get('editing_match_id')
         
+        candidate = {
+            'id': editing_match_id if editing_match_id else None,
+            'team1': team1,
+            'team2': team2,
+            'date': date,
+            'time': time_str,
+            'series_type': series_type,
+        }
+        overcommit = self._schedule_overcommit([candidate])
+        if overcommit:
+            await query.edit_message_text(
+                overcommit + "\n\nМатч не сохранён.",
+                parse_mode='HTML',
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("◀️ К расписанию", callback_data="schedule")
+                ]])
+            )
+            context.user_data.pop('editing_match_id', None)
+            for key in ['match_team1', 'match_team2', 'match_date', 'match_time', 'match_game_mode', 'match_series_type']:
+                context.user_data.pop(key, None)
+            return ConversationHandler.END
+        
         if editing_match_id:
             # Редактирование существующего матча
             matches = self.schedule_config.get('matches', [])
@@ -2418,7 +5238,7 @@ class RealDota2BotV2:
     
     async def handle_status(self, query):
         total = len(self.steam_accounts)
-        available = len(self.get_available_accounts())
+        available = self.steam_accounts.free_count
         
         message = f"""
 <b>📊 Статус</b>
@@ -2430,6 +5250,25 @@ class RealDota2BotV2:
 
 🎯 Лобби: {len(self.active_lobbies)}
         """
+        # Индексные выборки есть только у SQLite-хранилища
+        tz = pytz.timezone(self.schedule_config.get('timezone', 'Europe/Moscow'))
+        upcoming = self.store.count_upcoming_matches(datetime.now(tz).replace(tzinfo=None), timedelta(hours=1))
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        lobbies_today = self.store.count_lobbies_since(today)
+        if upcoming is not None:
+            message += f"⏰ Матчей в ближайший час: {upcoming}\n"
+        if lobbies_today is not None:
+            message += f"📈 Лобби за сегодня: {lobbies_today}\n"
+        if self.session_pool.admission is not None:
+            message += f"🚦 Входы в Steam: {self.session_pool.admission.describe()}\n"
+        message += f"🔁 Повторы создания: {self.lobby_retry.describe()}\n"
+        if self.cm_cache is not None:
+            message += f"🛰️ CM-серверы: {self.cm_cache.describe()}\n"
+        if self.credential_cache is not None:
+            message += f"🔑 Кэш входа: {self.credential_cache.describe()}\n"
+        host_loads = self._format_host_loads()
+        if host_loads:
+            message += f"\n🧩 Хосты воркеров:\n{host_loads}\n"
         try:
             await query.edit_message_text(
                 message,
@@ -2461,67 +5300,233 @@ class RealDota2BotV2:
             from apscheduler.schedulers.asyncio import AsyncIOScheduler
             self.scheduler = AsyncIOScheduler(timezone=self.schedule_config.get('timezone', 'Europe/Moscow'))
         
-        # Очищаем старые задачи
-        self.scheduler.remove_all_jobs()
+        # ВАЖНО: задача мониторинга активных лобби (работает всегда, независимо от расписания).
+        # Добавляется один раз и при изменениях расписания не пересоздаётся.
+        # Это только страховка: закрытие лобби и выход процессов приходят через канал событий
+        if self.scheduler.get_job('monitor_lobbies') is None:
+            self.scheduler.add_job(
+                self.monitor_active_lobbies,
+                'interval',
+                seconds=60,
+                id='monitor_lobbies',
+                replace_existing=True
+            )
+            logger.info("👁️ Добавлена задача мониторинга активных лобби (каждые 60 сек)")
         
-        # ВАЖНО: Добавляем задачу мониторинга активных лобби (работает всегда, независимо от расписания)
-        self.scheduler.add_job(
-            self.monitor_active_lobbies,
-            'interval',
-            seconds=10,
-            id='monitor_lobbies',
-            replace_existing=True
-        )
-        logger.info("👁️ Добавлена задача мониторинга активных лобби (каждые 10 сек)")
+        active_count = self.reconcile_schedule_jobs()
         
-        # Если расписание выключено - не добавляем задачи матчей
-        if not self.schedule_config.get('enabled', False):
-            logger.info("📅 Расписание выключено, задачи матчей не добавлены")
-            return
+        # Запускаем планировщик всегда (для мониторинга), только если event loop уже запущен
+        if not self.scheduler.running:
+            try:
+                self.scheduler.start()
+                logger.info(f"✅ Планировщик запущен, задач матчей: {active_count}")
+            except RuntimeError:
+                # Event loop еще не запущен, планировщик запустится позже
+                logger.info(f"📅 Планировщик будет запущен при старте event loop, задач матчей: {active_count}")
+    
+    def reconcile_schedule_jobs(self) -> int:
+        """Приводит задачи матчей в планировщике к расписанию.
         
-        # Добавляем задачи для каждого активного матча
-        matches = self.schedule_config.get('matches', [])
-        active_matches = [m for m in matches if m.get('enabled', False)]
+        Сравнивает желаемый набор задач (по id матча) с уже добавленными и
+        трогает только изменившиеся: новые добавляет, изменённые переносит,
+        удалённые/выключенные снимает. Возвращает число активных матчей.
+        """
+        if self.scheduler is None:
+            return 0
         
-        for match in active_matches:
-            try:
-                # Парсим дату и время
-                date_str = match.get('date')  # "26.10.2025"
-                time_str = match.get('time')  # "18:00"
-                
-                day, month, year = map(int, date_str.split('.'))
-                hour, minute = map(int, time_str.split(':'))
-                
-                # Создаем задачу на конкретную дату и время
-                run_date = datetime(year, month, day, hour, minute)
-                
-                # Добавляем задачу
+        # Желаемое состояние: match_<id> -> (сигнатура, дата запуска, матч)
+        desired = {}
+        if self.schedule_config.get('enabled', False):
+            for match in self.schedule_config.get('matches', []):
+                if not match.get('enabled', False):
+                    continue
+                job_id = f"match_{match.get('id')}"
+                signature = (match.get('date'), match.get('time'), id(match))
+                known = self._match_jobs.get(job_id)
+                if known and known[0] == signature:
+                    desired[job_id] = known
+                    continue
+                try:
+                    # Парсим дату и время: "26.10.2025" "18:00"
+                    day, month, year = map(int, match.get('date').split('.'))
+                    hour, minute = map(int, match.get('time').split(':'))
+                    desired[job_id] = (signature, datetime(year, month, day, hour, minute), match)
+                except Exception as e:
+                    logger.error(f"Ошибка разбора даты матча {match.get('id')}: {e}")
+        
+        added = changed = removed = 0
+        
+        # Снимаем задачи удалённых/выключенных матчей
+        for job_id in list(self._match_jobs):
+            if job_id in desired:
+                continue
+            del self._match_jobs[job_id]
+            if self.scheduler.get_job(job_id) is not None:
+                self.scheduler.remove_job(job_id)
+            self._drop_prewarm(job_id[len('match_'):])
+            removed += 1
+        
+        for job_id, entry in desired.items():
+            signature, run_date, match = entry
+            known = self._match_jobs.get(job_id)
+            if known and known[0] == signature:
+                continue  # не изменился (в т.ч. уже выполненная задача не пересоздаётся)
+            
+            job = self.scheduler.get_job(job_id)
+            if job is not None and known and known[1] == run_date:
+                # Время то же, поменялся только объект матча (например, после редактирования)
+                job.modify(args=[match])
+            elif job is not None:
+                job.modify(args=[match])
+                job.reschedule('date', run_date=run_date)
+            else:
                 self.scheduler.add_job(
                     self.execute_scheduled_match,
                     'date',
                     run_date=run_date,
                     args=[match],
-                    id=f"match_{match['id']}",
+                    id=job_id,
                     replace_existing=True,
-                    max_instances=10  # Разрешаем до 10 одновременных создания лобби
+                    max_instances=10,  # Разрешаем до 10 одновременных создания лобби
+                    misfire_grace_time=60,  # Занятый event loop не должен пропускать матч
+                    coalesce=True
                 )
-                
-                logger.info(f"📅 Добавлена задача: {match['team1']} vs {match['team2']} на {date_str} {time_str}")
+            self._sync_prewarm_job(match, run_date)
             
-            except Exception as e:
-                logger.error(f"Ошибка добавления задачи для матча {match.get('id')}: {e}")
+            if known:
+                changed += 1
+            else:
+                added += 1
+                logger.info(f"📅 Добавлена задача: {match['team1']} vs {match['team2']} на {match.get('date')} {match.get('time')}")
+            self._match_jobs[job_id] = entry
         
-        # Запускаем планировщик если есть задачи (только если event loop уже запущен)
-        if active_matches or True:  # Запускаем всегда для мониторинга
-            if not self.scheduler.running:
-                try:
-                    self.scheduler.start()
-                    logger.info(f"✅ Планировщик запущен, задач: {len(active_matches)}")
-                except RuntimeError:
-                    # Event loop еще не запущен, планировщик запустится позже
-                    logger.info(f"📅 Планировщик будет запущен при старте event loop, задач: {len(active_matches)}")
-        else:
-            logger.info("📅 Нет активных матчей в расписании")
+        self._drop_stale_prewarms()
+        
+        self._account_plan, overflow = self.schedule_allocator.plan(
+            self.schedule_config.get('matches', []), [acc.username for acc in self.steam_accounts], self._scheduler_now()
+        )
+        if overflow:
+            logger.warning(f"⚠️ Аккаунтов не хватит на {len(overflow)} матч(ей): "
+                           + ", ".join(f"{m.get('team1')} vs {m.get('team2')} ({m.get('date')} {m.get('time')})" for m in overflow[:5]))
+        
+        if added or changed or removed:
+            logger.info(f"📅 Расписание синхронизировано: +{added} ~{changed} -{removed}, активных матчей: {len(desired)}")
+        elif not self.schedule_config.get('enabled', False):
+            logger.debug("📅 Расписание выключено, задач матчей нет")
+        
+        return len(desired)
+    
+    def _schedule_overcommit(self, candidates: List[dict]) -> Optional[str]:
+        """Проверяет, хватит ли аккаунтов на расписание вместе с candidates
+        (новые или изменённые матчи). Текст ошибки или None."""
+        candidate_ids = {m.get('id') for m in candidates}
+        existing = {m.get('id'): m for m in self.schedule_config.get('matches', [])}
+        matches = [m for m in existing.values() if m.get('id') not in candidate_ids]
+        # Изменённый матч сохраняет свои enabled/status, новый - включён
+        matches += [{'enabled': True, 'status': 'scheduled', **existing.get(m.get('id'), {}), **m} for m in candidates]
+        tz = pytz.timezone(self.schedule_config.get('timezone', 'Europe/Moscow'))
+        now = datetime.now(tz).replace(tzinfo=None)
+        _, overflow = self.schedule_allocator.plan(matches, [acc.username for acc in self.steam_accounts], now)
+        if not overflow:
+            return None
+        first = overflow[0]
+        return (
+            f"❌ Не хватает аккаунтов: на {first.get('date')} {first.get('time')} "
+            f"({first.get('team1')} vs {first.get('team2')}) пересекается больше матчей, "
+            f"чем аккаунтов ({len(self.steam_accounts)}).\n"
+            f"Не помещается матчей: {len(overflow)}. Сдвиньте время или добавьте аккаунты."
+        )
+    
+    def _scheduler_now(self) -> datetime:
+        """Текущее время в часовом поясе планировщика (naive, как даты матчей)"""
+        return datetime.now(self.scheduler.timezone).replace(tzinfo=None)
+    
+    def _sync_prewarm_job(self, match: dict, run_date: datetime):
+        """Ставит (или переносит) прогрев матча на run_date - SCHEDULE_PREWARM_LEAD"""
+        job_id = f"prewarm_{match.get('id')}"
+        now = self._scheduler_now()
+        if self.schedule_prewarm_lead <= 0 or run_date <= now:
+            if self.scheduler.get_job(job_id) is not None:
+                self.scheduler.remove_job(job_id)
+            return
+        
+        # Если до матча меньше lead - греем сразу
+        prewarm_at = max(run_date - timedelta(seconds=self.schedule_prewarm_lead), now)
+        self.scheduler.add_job(
+            self.prewarm_scheduled_match,
+            'date',
+            run_date=prewarm_at,
+            args=[match],
+            id=job_id,
+            replace_existing=True,
+            misfire_grace_time=60
+        )
+    
+    def _drop_prewarm(self, match_id: str):
+        """Снимает прогрев матча и освобождает зарезервированный аккаунт"""
+        job_id = f"prewarm_{match_id}"
+        if self.scheduler.get_job(job_id) is not None:
+            self.scheduler.remove_job(job_id)
+        
+        username = self._prewarmed.pop(str(match_id), None)
+        if not username:
+            return
+        account = self.steam_accounts.get(username)
+        if account and not account.current_lobby:
+            account.is_busy = False
+        if not self.session_pool.persistent:
+            self.session_pool.signal_stop(username)
+        logger.info(f"🧊 Прогрев матча {match_id} отменён, аккаунт {username} освобождён")
+    
+    def _drop_stale_prewarms(self):
+        """Освобождает резервы прогрева, чей матч так и не запустился
+        (задача пропущена планировщиком или снята): иначе аккаунт и его
+        тёплая сессия остаются занятыми до правки расписания"""
+        if self.scheduler is None:
+            return
+        now = self._scheduler_now()
+        for match_id in list(self._prewarmed):
+            job_id = f"match_{match_id}"
+            entry = self._match_jobs.get(job_id)
+            # Запуск матча сам забирает резерв, так что резерв, оставшийся после
+            # run_date + misfire_grace_time без задачи, - пропуск
+            if entry is None or (entry[1] + timedelta(seconds=60) <= now and self.scheduler.get_job(job_id) is None):
+                logger.warning(f"⏰ Матч {match_id} не запустился в срок, снимаем резерв прогрева")
+                self._drop_prewarm(match_id)
+    
+    async def prewarm_scheduled_match(self, match: dict):
+        """Резервирует аккаунт под матч и поднимает его сессию Steam/GC заранее"""
+        match_id = str(match.get('id'))
+        if match_id in self._prewarmed:
+            return
+        
+        # Аккаунт по плану расписания, иначе свободный с уже тёплой сессией
+        preferred = self._account_plan.get(match_id)
+        if not (preferred and self.steam_accounts.is_free(preferred)):
+            preferred = next(
+                (username for username in self.session_pool.sessions
+                 if self.steam_accounts.is_free(username) and self.session_pool.is_warm(username)),
+                None
+            )
+        account = self.steam_accounts.acquire(preferred)
+        if account is None:
+            logger.warning(f"🔥 Нет свободных аккаунтов для прогрева: {match.get('team1')} vs {match.get('team2')}")
+            return
+        self._prewarmed[match_id] = account.username
+        
+        # Вход в очереди допуска встаёт по времени старта матча
+        job_entry = self._match_jobs.get(f"match_{match_id}")
+        deadline = None
+        if job_entry:
+            deadline = time.time() + (job_entry[1] - self._scheduler_now()).total_seconds()
+        
+        try:
+            self.session_pool.get_or_start(account, deadline)
+            logger.info(f"🔥 Прогрев: {match.get('team1')} vs {match.get('team2')} → {account.username}")
+        except Exception as e:
+            logger.error(f"Ошибка прогрева матча {match_id}: {e}")
+            self._prewarmed.pop(match_id, None)
+            account.is_busy = False
     
     async def execute_scheduled_match(self, match: dict):
         """Выполнение создания лобби для запланированного матча"""
@@ -2535,180 +5540,328 @@ class RealDota2BotV2:
             
             logger.info(f"🎮 Создание лобби по расписанию: {lobby_name}")
             
-            # Ищем свободный аккаунт
-            available_accounts = self.get_available_accounts()
+            # Когда матч должен был стартовать (для отчёта о прогреве)
+            started = time.time()
+            job_entry = self._match_jobs.get(f"match_{match.get('id')}")
+            scheduled_ts = started
+            if job_entry and self.scheduler is not None:
+                scheduled_ts = started - (self._scheduler_now() - job_entry[1]).total_seconds()
+            
+            # Аккаунт, зарезервированный прогревом, аккаунт по плану или первый свободный
+            account = None
+            username = self._prewarmed.pop(str(match.get('id')), None)
+            if username:
+                account = self.steam_accounts.get(username)
+            if account is None:
+                planned = self._account_plan.get(str(match.get('id')))
+                account = self.steam_accounts.acquire(planned if planned and self.steam_accounts.is_free(planned) else None)
+            
+            # Предыдущий матч на аккаунте может затянуться - ждём освобождения, а не отменяем матч
+            deadline = time.monotonic() + self.schedule_account_wait
+            while account is None and time.monotonic() < deadline:
+                logger.info(f"⏳ Нет свободных аккаунтов для {lobby_name}, ждём освобождения...")
+                if not await self.steam_accounts.wait_free(deadline - time.monotonic()):
+                    break
+                account = self.steam_accounts.acquire()
             
-            if not available_accounts:
+            if account is None:
                 logger.error(f"❌ Нет свободных аккаунтов для создания лобби: {lobby_name}")
                 
                 # Отправляем уведомление в Telegram
-                if self.notification_chat_id:
-                    message = f"❌ <b>Ошибка создания лобби по расписанию!</b>\n\n"
-                    message += f"<b>{lobby_name}</b>\n"
-                    message += f"Причина: нет свободных аккаунтов"
-                    
-                    send_kwargs = {
-                        'chat_id': self.notification_chat_id,
-                        'text': message,
-                        'parse_mode': 'HTML'
-                    }
-                    
-                    if self.notification_thread_id:
-                        send_kwargs['message_thread_id'] = self.notification_thread_id
-                    
-                    await self.telegram_app.bot.send_message(**send_kwargs)
+                message = f"❌ <b>Ошибка создания лобби по расписанию!</b>\n\n"
+                message += f"<b>{lobby_name}</b>\n"
+                message += f"Причина: нет свободных аккаунтов"
+                self.notifier.notify(self.notification_chat_id, message, self.notification_thread_id)
                 
                 return
             
-            # Берем первый свободный аккаунт
-            account = available_accounts[0]
             account.is_busy = True
             
-            # Создаем фейковый status_msg для create_single_real_lobby
-            class FakeMessage:
-                async def edit_text(self, *args, **kwargs):
-                    pass
-            
-            fake_msg = FakeMessage()
-            
-            # Создаем лобби
-            lobby_info = await self.create_single_real_lobby(
+            # Создаем лобби (прогресс в Telegram не показываем); при сбое - повтор
+            # и переключение на другой свободный аккаунт с тем же названием и паролем
+            lobby_info = await self.create_lobby_with_failover(
                 account,
-                fake_msg,
+                SilentStatusMessage(),
                 game_mode=game_mode,
                 series_type=series_type,
-                lobby_name=lobby_name
+                lobby_name=lobby_name,
+                deadline=scheduled_ts,
             )
             
             if lobby_info:
-                logger.info(f"✅ Лобби создано по расписанию: {lobby_name}")
+                # Отклонение от времени старта: < 0 - сессия была готова заранее
+                created_skew = time.time() - scheduled_ts
+                session = self.session_pool.sessions.get(lobby_info.account)
+                ready_at = session.ready_at if session else None
+                if ready_at:
+                    ready_line = f"готова {ready_at - scheduled_ts:+.1f} сек"
+                else:
+                    ready_line = "без прогрева"
+                logger.info(
+                    f"✅ Лобби создано по расписанию: {lobby_name} "
+                    f"(сессия {ready_line}, лобби {created_skew:+.1f} сек от старта)"
+                )
                 
                 # Меняем статус матча на "active"
                 match['status'] = 'active'
                 self.save_schedule()
                 
-                # Отправляем уведомление в личку администратору
-                for admin_id in self.admin_ids:
-                    admin_message = f"✅ <b>Лобби создано по расписанию!</b>\n\n"
-                    admin_message += f"<b>{lobby_name}</b>\n"
-                    admin_message += f"🔒 Пароль: <code>{lobby_info.password}</code>\n"
-                    admin_message += f"🎮 Режим: {game_mode}\n"
-                    admin_message += f"🎯 Серия: {series_type.upper()}"
-                    
-                    try:
-                        await self.telegram_app.bot.send_message(
-                            chat_id=admin_id,
-                            text=admin_message,
-                            parse_mode='HTML'
-                        )
-                    except Exception as e:
-                        logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+                # Уведомления админам и в группу уходят через очередь:
+                # матчи, стартующие одновременно, склеиваются в один дайджест
+                admin_message = f"✅ <b>Лобби создано по расписанию!</b>\n\n"
+                admin_message += f"<b>{lobby_name}</b>\n"
+                admin_message += f"🔒 Пароль: <code>{lobby_info.password}</code>\n"
+                admin_message += f"🎮 Режим: {game_mode}\n"
+                admin_message += f"🎯 Серия: {series_type.upper()}\n"
+                admin_message += f"⏱️ Сессия {ready_line}, лобби {created_skew:+.1f} сек от старта"
+                if lobby_info.attempts > 1:
+                    admin_message += f"\n🔁 Попыток: {lobby_info.attempts}, аккаунт {lobby_info.account}"
+                self.notifier.notify_admins(self.admin_ids, admin_message)
                 
-                # Отправляем уведомление в группу
-                if self.notification_chat_id:
-                    group_message = f"<b>{lobby_name}</b>\n\n"
-                    group_message += f"<b>🔒 Пароль: </b><code>{lobby_info.password}</code>\n"
-                    group_message += f"<b>🎮 Режим: {game_mode}</b>\n"
-                    group_message += f"<b>🎯 Серия: {series_type.upper()}</b>"
-                    
-                    send_kwargs = {
-                        'chat_id': self.notification_chat_id,
-                        'text': group_message,
-                        'parse_mode': 'HTML'
-                    }
-                    
-                    if self.notification_thread_id:
-                        send_kwargs['message_thread_id'] = self.notification_thread_id
-                    
-                    await self.telegram_app.bot.send_message(**send_kwargs)
+                group_message = f"<b>{lobby_name}</b>\n\n"
+                group_message += f"<b>🔒 Пароль: </b><code>{lobby_info.password}</code>\n"
+                group_message += f"<b>🎮 Режим: {game_mode}</b>\n"
+                group_message += f"<b>🎯 Серия: {series_type.upper()}</b>"
+                self.notifier.notify(self.notification_chat_id, group_message, self.notification_thread_id)
             else:
                 logger.error(f"❌ Не удалось создать лобби по расписанию: {lobby_name}")
-                account.is_busy = False
                 
                 # Отправляем уведомление об ошибке
-                if self.notification_chat_id:
-                    message = f"❌ <b>Ошибка создания лобби по расписанию!</b>\n\n"
-                    message += f"<b>{lobby_name}</b>\n"
-                    message += f"Проверьте логи для деталей"
-                    
-                    send_kwargs = {
-                        'chat_id': self.notification_chat_id,
-                        'text': message,
-                        'parse_mode': 'HTML'
-                    }
-                    
-                    if self.notification_thread_id:
-                        send_kwargs['message_thread_id'] = self.notification_thread_id
-                    
-                    await self.telegram_app.bot.send_message(**send_kwargs)
+                message = f"❌ <b>Ошибка создания лобби по расписанию!</b>\n\n"
+                message += f"<b>{lobby_name}</b>\n"
+                message += f"Проверьте логи для деталей"
+                self.notifier.notify(self.notification_chat_id, message, self.notification_thread_id)
         
         except Exception as e:
             logger.error(f"Ошибка выполнения запланированного матча: {e}", exc_info=True)
     
-    def _cleanup_lobby_for_username(self, username: str):
+    def _cleanup_lobby_for_username(self, username: str, reason: str = 'closed'):
         """Очищает все данные для указанного username и обновляет статус в Telegram"""
         try:
             # Находим аккаунт и лобби
-            for account in self.steam_accounts:
-                if account.username == username:
-                    lobby_name = account.current_lobby
-                    
-                    logger.info(f"🔄 Обновление статуса: аккаунт {username}, лобби {lobby_name}")
-                    
-                    # Освобождаем аккаунт
-                    account.is_busy = False
-                    account.current_lobby = None
-                    
-                    # Удаляем лобби из активных
-                    if lobby_name and lobby_name in self.active_lobbies:
-                        del self.active_lobbies[lobby_name]
-                        logger.info(f"✅ Лобби {lobby_name} удалено из активных")
-                    else:
-                        if lobby_name:
-                            logger.warning(f"⚠️ Лобби {lobby_name} не найдено в active_lobbies")
-                    
-                    # Очищаем процесс
-                    if username in self.active_processes:
-                        del self.active_processes[username]
-                        logger.info(f"🧹 Процесс {username} удален")
-                    if username in self.shutdown_events:
-                        del self.shutdown_events[username]
-                    if username in self.result_queues:
-                        del self.result_queues[username]
-                    
-                    logger.info(f"✅ Статус бота {username} успешно обновлен в Telegram!")
-                    break
+            account = self.steam_accounts.get(username)
+            if account is None:
+                return
+            lobby_name = account.current_lobby
+            
+            logger.info(f"🔄 Обновление статуса: аккаунт {username}, лобби {lobby_name}")
+            
+            # Освобождаем аккаунт
+            self.steam_accounts.release(username)
+            
+            # Удаляем лобби из активных
+            if lobby_name and lobby_name in self.active_lobbies:
+                del self.active_lobbies[lobby_name]
+                self.store.record_lobby_closed(lobby_name, reason)
+                self._save_journal()
+                logger.info(f"✅ Лобби {lobby_name} удалено из активных")
+            else:
+                if lobby_name:
+                    logger.warning(f"⚠️ Лобби {lobby_name} не найдено в active_lobbies")
+            
+            # Очищаем процесс
+            if username in self.active_processes:
+                del self.active_processes[username]
+                logger.info(f"🧹 Процесс {username} удален")
+            if username in self.shutdown_events:
+                del self.shutdown_events[username]
+            
+            logger.info(f"✅ Статус бота {username} успешно обновлен в Telegram!")
         except Exception as e:
             logger.error(f"❌ Ошибка очистки для {username}: {e}", exc_info=True)
     
+    async def _dispatch_worker_events(self):
+        """Разбирает события воркеров по мере поступления"""
+        while True:
+            host, message = await self.worker_events.queue.get()
+            if message.get('event') == 'worker_exited':
+                # Процесс хоста вышел - это касается всех его сессий
+                sessions = list(host.sessions.values())
+            else:
+                session = host.sessions.get(message.get('account'))
+                sessions = [session] if session else []
+            for session in sessions:
+                try:
+                    self._handle_worker_event(session, message)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработки события {message} от {session.username}: {e}", exc_info=True)
+            if message.get('event') == 'worker_exited':
+                self.session_pool.forget_host(host)
+                if sessions:
+                    self._rebalance_after_host_exit(host, [session.username for session in sessions])
+    
+    def _handle_worker_event(self, session: SteamSession, message: dict):
+        """Одно событие воркера: готовность сессии, результат создания, закрытие лобби, выход процесса"""
+        username = session.username
+        event = message.get('event')
+        
+        if event == 'lobby_snapshot':
+            # Снимок может обогнать регистрацию лобби в боте - запоминаем последний
+            session.last_snapshot = message
+            lobby_info = self.active_lobbies.get(message.get('lobby_name'))
+            if lobby_info and lobby_info.account == username:
+                lobby_info.apply_snapshot(message)
+            return
+        
+        if event == 'lobby_phase':
+            self._handle_lobby_phase(session, message)
+            return
+        
+        if event == 'worker_started':
+            # От допуска (отправки start), а не от get_or_start: очередь входов - не запуск
+            latency_ms = (message['login_started_at'] - (session.admitted_at or session.started_at)) * 1000
+            if not message.get('spawned', True):
+                logger.info(f"🚀 Сессия {username} на хосте {session.host.name}: старт→вход {latency_ms:.0f} мс")
+                return
+            rss_mb = (message.get('rss_kb') or 0) / 1024
+            self.worker_start_stats.append((latency_ms, rss_mb))
+            del self.worker_start_stats[:-50]
+            avg_latency = sum(item[0] for item in self.worker_start_stats) / len(self.worker_start_stats)
+            avg_rss = sum(item[1] for item in self.worker_start_stats) / len(self.worker_start_stats)
+            logger.info(
+                f"🚀 Воркер {username} ({message.get('start_method')}): запуск→вход {latency_ms:.0f} мс "
+                f"(импорт {message.get('imports_ms', 0):.0f} мс), RSS {rss_mb:.0f} МБ; "
+                f"в среднем по {len(self.worker_start_stats)}: {avg_latency:.0f} мс, {avg_rss:.0f} МБ"
+            )
+            return
+        
+        if event == 'cm_connected':
+            if self.cm_cache is not None:
+                if message.get('servers'):
+                    self.cm_cache.merge(message['servers'])
+                self.cm_cache.record(message.get('server'), message.get('connect_ms'),
+                                     message.get('source'), message.get('failed') or [])
+                self.store.save('cm_servers.json', self.cm_cache.to_dict)
+            if message.get('connect_ms') is not None:
+                self.lobby_metrics.record('cm_connect', message['connect_ms'] / 1000)
+                logger.info(f"🛰️ {username}: CM {message.get('server')} за {message['connect_ms']:.0f} мс "
+                            f"({'кэш' if message.get('source') == 'cache' else 'бутстрап'})"
+                            + (f", не ответили: {', '.join(message['failed'])}" if message.get('failed') else ""))
+            return
+        
+        if event == 'credentials':
+            if self.credential_cache is not None:
+                fields = {name: message[name] for name in ('login_key', 'sentry') if name in message}
+                self.credential_cache.update(username, **fields)
+                self._save_credentials()
+                if 'login_key' in fields:
+                    logger.info(f"🔑 {username}: login key " + ("обновлён" if fields['login_key'] else "отклонён Steam, сброшен"))
+            return
+        
+        if event == 'login_throttled':
+            logger.warning(f"🚦 Steam ограничил вход {username} ({message.get('eresult')}), повтор через очередь")
+            self.session_pool.login_throttled(session)
+            return
+        
+        if event == 'session_ready':
+            self.session_pool.login_succeeded()
+            session.ready_at = time.time()
+            self.lobby_metrics.record('session_start', session.ready_at - session.started_at)
+            if message.get('login_ms') is not None:
+                self.lobby_metrics.record('login', message['login_ms'] / 1000)
+            if message.get('gc_ready_ms') is not None:
+                self.lobby_metrics.record('gc_ready', message['gc_ready_ms'] / 1000)
+            if self.credential_cache is not None and message.get('login_ms') is not None:
+                self.credential_cache.record_login(message.get('login_method', 'password'), message['login_ms'])
+            logger.info(f"🔥 Сессия {username} готова за {session.ready_at - session.started_at:.1f} сек")
+            return
+        
+        # Лобби этой сессии сейчас активно в боте? (на том же хосте может уже жить
+        # новая сессия этого аккаунта - тогда лобби принадлежит ей)
+        owns_lobby = (self.active_processes.get(username) is session.process
+                      and self.session_pool.sessions.get(username) in (None, session))
+        
+        if event in ('worker_exited', 'account_stopped'):
+            if event == 'worker_exited':
+                error = f'Worker exited ({session.process.exitcode})'
+                logger.info(f"💀 Процесс {session.host.name} ({username}) завершился (код {session.process.exitcode})")
+            else:
+                error = 'Session stopped'
+                logger.info(f"💤 Сессия {username} на хосте {session.host.name} завершилась")
+            if session.pending and not session.pending.done():
+                session.pending.set_result({'success': False, 'error': error})
+            if owns_lobby:
+                self._cleanup_lobby_for_username(username, 'worker_exited')
+            self.session_pool.forget(session)
+            return
+        
+        if message.get('lobby_closed'):
+            account = self.steam_accounts.get(username)
+            current_lobby = account.current_lobby if account else None
+            if owns_lobby and message.get('lobby_name') in (None, current_lobby):
+                logger.info(f"🏁 Лобби {current_lobby} ({username}) закрылось")
+                self._cleanup_lobby_for_username(username, message.get('reason', 'closed'))
+            return
+        
+        if 'success' in message:
+            # Ошибки входа приходят без lobby_name и относятся к текущему ожиданию
+            pending = session.pending
+            if pending and not pending.done() and message.get('lobby_name') in (None, session.pending_lobby):
+                pending.set_result(message)
+            elif not message.get('success'):
+                logger.warning(f"⚠️ Сессия {username}: {message.get('error')}")
+    
+    def _record_login_queue(self, session: SteamSession):
+        self.lobby_metrics.record('login_queue', session.admitted_at - session.started_at)
+    
+    def _handle_lobby_phase(self, session: SteamSession, message: dict):
+        """Переход лобби в новую фазу: запоминаем длительности и пишем разбивку по фазам"""
+        lobby_name = message.get('lobby_name')
+        if session.phase_lobby != lobby_name:
+            session.phase_lobby = lobby_name
+            session.phase_durations = {}
+        session.phase = message['phase']
+        previous = message.get('previous')
+        if previous and message.get('previous_ms') is not None:
+            session.phase_durations[previous] = message['previous_ms'] / 1000
+            if previous in LobbyMetrics.STAGES:
+                self.lobby_metrics.record(previous, session.phase_durations[previous])
+        
+        lobby_info = self.active_lobbies.get(lobby_name)
+        if lobby_info and lobby_info.account == session.username:
+            lobby_info.apply_phase(session.phase, session.phase_durations)
+        
+        if session.phase in ('open', 'in_game', 'closed'):
+            breakdown = ", ".join(f"{phase} {seconds * 1000:.0f}" for phase, seconds in session.phase_durations.items())
+            logger.info(f"⏱️ Лобби {lobby_name} ({session.username}) → {session.phase}: {breakdown} (мс)")
+    
+    def _rebalance_after_host_exit(self, host: SteamHost, usernames: List[str]):
+        """Шард упал вместе с сессиями: свободные аккаунты заново прогреваем
+        на оставшихся шардах (упавший слот перезапустится при размещении)"""
+        if not (self.session_pool.shards and self.session_pool.persistent):
+            return
+        moved = []
+        for username in usernames:
+            account = self.steam_accounts.get(username)
+            if account is None or not self.steam_accounts.is_free(username) or self.session_pool.get(username):
+                continue
+            try:
+                # Фоновый прогрев - в конец очереди входов, после матчей и ручных лобби
+                self.session_pool.get_or_start(account, time.time() + 3600)
+                moved.append(username)
+            except Exception as e:
+                logger.error(f"❌ Не удалось перенести сессию {username}: {e}")
+        logger.warning(f"🧩 Шард {host.name} завершился с {len(usernames)} сессиями, "
+                       f"перенесены: {', '.join(moved) or 'нет'}")
+    
+    def _format_host_loads(self) -> str:
+        lines = []
+        for host, load in self.session_pool.host_loads():
+            cpu = f"{load['cpu']:.0f}%" if load['cpu'] is not None else "—"
+            rss = f"{load['rss_mb']:.0f} МБ" if load['rss_mb'] is not None else "—"
+            lines.append(f"   {host.name}: сессий {load['sessions']}, лобби {load['lobbies']}, CPU {cpu}, RSS {rss}")
+        return "\n".join(lines)
+    
     async def monitor_active_lobbies(self):
-        """Периодически проверяет активные лобби на предмет завершения игры"""
+        """Страховка: события воркеров приходят сами, здесь только редкая сверка живости процессов"""
         try:
-            active_count = len(self.result_queues)
-            if active_count > 0:
-                logger.info(f"👁️ Мониторинг: проверка {active_count} активных лобби...")
-            
-            for username, queue in list(self.result_queues.items()):
-                try:
-                    # Проверяем, жив ли процесс (вместо проверки очереди!)
-                    process = self.active_processes.get(username)
-                    if process and not process.is_alive():
-                        logger.info(f"💀 Процесс {username} завершился - обновляем статус")
-                        # Процесс завершился, обновляем статус
-                        self._cleanup_lobby_for_username(username)
-                        continue
-                    
-                    # Проверяем очередь без блокировки (только если процесс жив!)
-                    if not queue.empty():
-                        result = queue.get_nowait()
-                        logger.info(f"📨 Получено сообщение из очереди для {username}: {result}")
-                        
-                        # Если получили сообщение о закрытии лобби
-                        if result.get('lobby_closed'):
-                            logger.info(f"🏁 Лобби для {username} закрылось (игра завершена)")
-                            self._cleanup_lobby_for_username(username)
-                except Exception as queue_error:
-                    logger.error(f"❌ Ошибка проверки очереди для {username}: {queue_error}", exc_info=True)
+            for username, process in list(self.active_processes.items()):
+                if not process.is_alive():
+                    logger.info(f"💀 Процесс {username} завершился - обновляем статус")
+                    self._cleanup_lobby_for_username(username, 'worker_exited')
+            self._drop_stale_prewarms()
+            if self.session_pool.shards:
+                logger.info(f"🧩 Нагрузка шардов:\n{self._format_host_loads()}")
         except Exception as e:
             logger.error(f"❌ Критическая ошибка мониторинга лобби: {e}", exc_info=True)
     
@@ -2716,14 +5869,56 @@ class RealDota2BotV2:
     
     async def post_init(self, application: Application) -> None:
         """Вызывается после инициализации Application"""
+        self.notifier.bot = application.bot
+        
+        # Живые воркеры прошлого запуска подхватываем до запуска канала событий:
+        # их накопленные события разбираются, когда лобби уже восстановлены
+        await self.adopt_surviving_workers()
+        self._mark_startup('workers')
+        
+        # Старые воркеры добиваем в фоне - polling их не ждёт
+        if self._stale_workers:
+            self._reap_task = asyncio.create_task(self._reap_stale_workers(self._stale_workers))
+            self._stale_workers = []
+        
+        # Шаблонный процесс forkserver поднимаем заранее и в фоне,
+        # чтобы первый воркер не ждал импорта steam/dota2
+        if multiprocessing.get_start_method(allow_none=True) == 'forkserver':
+            import multiprocessing.forkserver
+            asyncio.get_running_loop().run_in_executor(None, multiprocessing.forkserver.ensure_running)
+        
+        # Канал событий воркеров работает в event loop бота
+        self.worker_events.start(asyncio.get_running_loop())
+        self._worker_events_task = asyncio.create_task(self._dispatch_worker_events())
+        
         # Запускаем планировщик если он не запущен и есть задачи
         if self.scheduler and not self.scheduler.running:
             if self.scheduler.get_jobs():
                 self.scheduler.start()
                 logger.info(f"✅ Планировщик запущен в post_init, задач: {len(self.scheduler.get_jobs())}")
+        
+        self._mark_startup('polling')
+        self._log_startup_timing()
+    
+    async def post_shutdown(self, application: Application) -> None:
+        """Вызывается при остановке Application: досылаем уведомления и дописываем файлы"""
+        await self.notifier.flush_all()
+        self.store.flush_all()
+        if self.lobby_metrics.summary():
+            try:
+                JsonStore._write_atomic(self.metrics_export_path,
+                                        json.dumps(self.lobby_metrics.export(), ensure_ascii=False, indent=2))
+            except OSError as e:
+                logger.warning(f"Метрики не выгружены: {e}")
     
     def setup_telegram_bot(self):
-        self.telegram_app = Application.builder().token(self.telegram_token).post_init(self.post_init).build()
+        self.telegram_app = (
+            Application.builder()
+            .token(self.telegram_token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         
         # Handler создания лобби с выбором ботов, режима и серии
         create_handler = ConversationHandler(
@@ -2785,6 +5980,7 @@ class RealDota2BotV2:
         )
         
         self.telegram_app.add_handler(CommandHandler("start", self.cmd_start))
+        self.telegram_app.add_handler(CommandHandler("metrics", self.cmd_metrics))
         self.telegram_app.add_handler(create_handler)
         self.telegram_app.add_handler(add_bot_handler)
         self.telegram_app.add_handler(edit_bot_handler)
@@ -2793,31 +5989,39 @@ class RealDota2BotV2:
     
     def shutdown_all_lobbies(self, signum=None, frame=None):
         """Graceful shutdown - удаляет все активные лобби"""
+        if self.detach_on_exit and self.session_pool.sessions:
+            self.detach_workers_and_exit()
+        
         logger.info("=" * 50)
         logger.info("🛑 Получен сигнал завершения работы, закрываем все лобби...")
         logger.info("=" * 50)
         
-        # Отправляем shutdown signal всем активным процессам
-        for username, event in list(self.shutdown_events.items()):
-            logger.info(f"Отправка shutdown signal для {username}...")
-            event.set()
+        # Завершаем все сессии (активные лобби и тёплые): сначала сигнал всем, потом ожидание
+        self.session_pool.stop_all(timeout=20)
+        self.active_processes.clear()
+        self.shutdown_events.clear()
         
-        # Ждем завершения всех процессов (даём время на cleanup)
-        import time
-        time.sleep(1)  # Даём время процессам получить сигнал
-        
-        for username, process in list(self.active_processes.items()):
-            if process.is_alive():
-                logger.info(f"Ожидание завершения процесса {username}...")
-                process.join(timeout=20)  # Увеличено до 20 секунд
-                
-                if process.is_alive():
-                    logger.warning(f"⚠️ Процесс {username} не завершился, принудительное завершение...")
-                    process.terminate()
-                    process.join(timeout=5)
+        # Отложенные записи JSON не должны потеряться
+        self.store.flush_all()
         
         logger.info("✅ Все лобби закрыты")
     
+    def detach_workers_and_exit(self):
+        """Перезапуск без потери лобби: журнал на диск, воркеры отпускаем, выходим.
+        
+        os._exit - потому что multiprocessing при обычном выходе ждёт (join)
+        дочерние процессы, а они должны пережить бота.
+        """
+        logger.info("=" * 50)
+        logger.info(f"🔌 Остановка бота: {len(self.session_pool.sessions)} сессий продолжают работать "
+                    f"и будут подхвачены после перезапуска (лобби: {len(self.active_lobbies)})")
+        logger.info("=" * 50)
+        self._save_journal()
+        self.store.flush_all()
+        self.session_pool.detach_all()
+        logging.shutdown()
+        os._exit(0)
+    
     def start_sync(self):
         logger.info("=" * 50)
         logger.info("🚀 REAL Dota 2 Lobby Bot v2")
@@ -2829,7 +6033,9 @@ class RealDota2BotV2:
         
         logger.info("Настройка...")
         self.setup_telegram_bot()
+        self._mark_startup('telegram')
         self.setup_scheduler()
+        self._mark_startup('scheduler')
         
         # Регистрируем обработчики сигналов для graceful shutdown
         signal.signal(signal.SIGINT, self.shutdown_all_lobbies)
@@ -2847,51 +6053,35 @@ class RealDota2BotV2:
 
 
 def main():
-    # Настройка multiprocessing для Windows/Linux
+    # Настройка multiprocessing для Windows/Linux.
+    # forkserver: воркеры форкаются из чистого шаблонного процесса, в котором
+    # steam/dota2/gevent уже импортированы (без monkey-patch и без состояния бота).
+    # WORKER_START_METHOD=spawn - старое поведение (каждый воркер импортирует всё заново)
+    default_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    start_method = os.getenv('WORKER_START_METHOD', default_method)
     try:
+        multiprocessing.set_start_method(start_method, force=True)
+        if start_method == 'forkserver':
+            multiprocessing.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+    except (RuntimeError, ValueError) as e:
+        logger.warning(f"Метод запуска воркеров {start_method} недоступен ({e}), используем spawn")
         multiprocessing.set_start_method('spawn', force=True)
-    except RuntimeError:
-        pass  # Уже установлен
+    logger.info(f"⚙️ Запуск воркеров: {multiprocessing.get_start_method()}")
     
     bot = RealDota2BotV2()
     try:
         bot.start_sync()
     except KeyboardInterrupt:
-        logger.info("⏹️ Остановка бота...")
+        if bot.detach_on_exit and bot.session_pool.sessions:
+            bot.detach_workers_and_exit()
         
-        # Отправляем сигнал shutdown всем процессам
-        for username in list(bot.shutdown_events.keys()):
-            if username in bot.shutdown_events:
-                logger.info(f"Отправляем сигнал shutdown для {username}...")
-                bot.shutdown_events[username].set()
+        logger.info("⏹️ Остановка бота...")
         
-        # Ждём завершения всех процессов (макс 25 секунд)
+        # Отправляем сигнал shutdown всем сессиям и ждём (макс 25 секунд);
+        # не завершившиеся хосты stop_all убивает по их pid (без pkill по имени,
+        # который задел бы forkserver и другие процессы)
         logger.info("Ожидание завершения всех процессов (макс 25 секунд)...")
-        for username, process in list(bot.active_processes.items()):
-            try:
-                if process.is_alive():
-                    process.join(timeout=25)
-                    
-                    if process.is_alive():
-                        logger.warning(f"Процесс {username} не завершился, принудительное завершение...")
-                        process.terminate()
-                        process.join(timeout=2)
-                    
-                    if process.is_alive():
-                        logger.warning(f"Убиваем {username}...")
-                        process.kill()
-                        process.join()
-            except Exception as e:
-                logger.error(f"Ошибка остановки процесса {username}: {e}")
-        
-        # УБИВАЕМ ВСЕ ОСТАВШИЕСЯ ПРОЦЕССЫ Steam/Dota/Python
-        logger.info("🔪 Очистка всех оставшихся процессов...")
-        import subprocess
-        try:
-            subprocess.run(['pkill', '-9', '-f', 'steam'], stderr=subprocess.DEVNULL)
-            subprocess.run(['pkill', '-9', '-f', 'dota'], stderr=subprocess.DEVNULL)
-        except:
-            pass
+        bot.session_pool.stop_all(timeout=25)
         
         logger.info("✅ Все процессы остановлены")
     except Exception as e: